@@ -6,6 +6,7 @@ import logging
 import os
 import ssl
 import sys
+import time
 import traceback
 from typing import *
 
@@ -28,7 +29,11 @@ except ImportError:
 from aiohttp import web
 
 from libhusky import HuskyConfig
+from libhusky import HuskyDatabase
 from libhusky import HuskyHTTP
+from libhusky import HuskyHTTPClient
+from libhusky import HuskyMetrics
+from libhusky import HuskyScheduler
 from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
 from libhusky.discord.HuskyHelpFormatter import HuskyHelpFormatter
@@ -77,6 +82,18 @@ class HuskyBot(commands.Bot, metaclass=HuskyUtils.Singleton):
             help_command=HuskyHelpFormatter()
         )
 
+        # Shared outgoing HTTP client. Plugins should borrow a client from this instead of creating their own session.
+        self.http_client = HuskyHTTPClient.HTTPClientService(self.loop)
+
+        # Operational metrics (see HuskyMetrics), exported at /metrics.
+        self.http.request = self.__instrument_rest(self.http.request)
+        logging.getLogger('discord.http').addHandler(
+            HuskyMetrics.RateLimitLogCounter(HuskyMetrics.REST_RATE_LIMITS)
+        )
+
+        HuskyMetrics.get_registry().register_collector("httpClient", self.http_client.collect_metrics)
+        HuskyMetrics.get_registry().register_collector("gateway", self.__collect_gateway_metrics)
+
         self.init_stage = 0
 
     def entrypoint(self):
@@ -124,6 +141,83 @@ class HuskyBot(commands.Bot, metaclass=HuskyUtils.Singleton):
 
         await super().logout()
 
+    async def close(self):
+        # Plugins are unloaded first, so nothing is still using the shared HTTP client when it closes. Scheduled
+        # callbacks (mute expiry, debounces, etc.) would use it too, so they're stopped before it closes.
+        await super().close()
+        HuskyScheduler.get_scheduler().shutdown()
+        await self.http_client.close()
+
+        # Managers queue their database writes, so let the last of them land before the loop goes away.
+        await HuskyDatabase.get_writer().flush()
+
+    def add_cog(self, cog):
+        super().add_cog(cog)
+        HuskyHTTP.get_router().bind_plugin(cog)
+
+    def remove_cog(self, name):
+        HuskyHTTP.get_router().unbind_plugin(name)
+        super().remove_cog(name)
+
+    def dispatch(self, event_name, *args, **kwargs):
+        HuskyMetrics.GATEWAY_EVENTS.inc(event_name)
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        # discord.py runs every listener (the bot's own, cogs', and managers') through here.
+        start = time.perf_counter()
+
+        try:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            owner = getattr(coro, '__self__', None)
+            HuskyMetrics.LISTENER_LATENCY.observe(time.perf_counter() - start,
+                                                  type(owner).__name__ if owner is not None else "None", event_name)
+
+    async def invoke(self, ctx: commands.Context):
+        if ctx.command is None:
+            await super().invoke(ctx)
+            return
+
+        start = time.perf_counter()
+        await super().invoke(ctx)
+
+        # Command errors are handled (and dispatched) inside invoke, so they're only visible on the context.
+        command_name = ctx.command.qualified_name
+        HuskyMetrics.COMMAND_INVOCATIONS.inc(command_name, "error" if ctx.command_failed else "success")
+        HuskyMetrics.COMMAND_LATENCY.observe(time.perf_counter() - start, command_name)
+
+    @staticmethod
+    def __instrument_rest(request):
+        async def instrumented_request(route: discord.http.Route, **kwargs):
+            start = time.perf_counter()
+            outcome = "success"
+
+            try:
+                return await request(route, **kwargs)
+            except discord.HTTPException as e:
+                outcome = str(e.status)
+                raise
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                HuskyMetrics.REST_REQUESTS.inc(route.method, route.path, outcome)
+                HuskyMetrics.REST_LATENCY.observe(time.perf_counter() - start, route.method, route.path)
+
+        return instrumented_request
+
+    def __collect_gateway_metrics(self):
+        latency = HuskyMetrics.Gauge("huskybot_gateway_latency_seconds", "Latest gateway heartbeat latency.")
+        latency.set(self.latency if self.latency == self.latency else 0.0)  # NaN before the first heartbeat
+
+        guilds = HuskyMetrics.Gauge("huskybot_guild_members", "Member count of each guild the bot is in.",
+                                    ("guild",))
+        for guild in self.guilds:
+            guilds.set(guild.member_count, guild.id)
+
+        return [latency, guilds]
+
     def __check_developer_mode(self):
         return bool(os.environ.get('HUSKYBOT_DEVMODE', self.config.get('developerMode', False)))
 
@@ -207,9 +301,8 @@ class HuskyBot(commands.Bot, metaclass=HuskyUtils.Singleton):
                 ssl_context = ssl.SSLContext()
                 ssl_context.load_cert_chain(cert.read())
 
-        for method in ["GET", "HEAD", "POST", "PATCH", "PUT", "DELETE", "VIEW"]:
-            # Abuse the hell out of aiohttp's own router to load in HuskyRouter.
-            self.webapp.router.add_route(method, '/{tail:.*}', HuskyHTTP.get_router().handle(self))
+        # Abuse the hell out of aiohttp's own router to load in HuskyRouter, which does its own method dispatch.
+        self.webapp.router.add_route('*', '/{tail:.*}', HuskyHTTP.get_router().handle(self))
 
         runner = web.AppRunner(self.webapp)
         await runner.setup()
@@ -224,14 +317,19 @@ class HuskyBot(commands.Bot, metaclass=HuskyUtils.Singleton):
             return
 
         try:
-            c = f"postgresql://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}" \
+            # DATABASE_URL allows any SQLAlchemy URL (e.g. sqlite:///config/huskybot.db for local testing)
+            c = os.environ.get('DATABASE_URL') or \
+                f"postgresql://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}" \
                 f"@db:5432/{os.environ['POSTGRES_DB']}"
             self.db = sqlalchemy.create_engine(c)
+            HuskyDatabase.create_tables(self.db)
         except KeyError:
             LOG.warning("No database configuration was set for Husky. Database support is disabled.")
             return
         except DatabaseError as s:
             LOG.error(f"Could not connect to the database! The error is as follows: \n{s}")
+            self.db = None
+            return
 
         self.session_factory = sqlalchemy.orm.sessionmaker(bind=self.db)
 
@@ -320,6 +418,8 @@ class HuskyBot(commands.Bot, metaclass=HuskyUtils.Singleton):
             await self.__init_guild_lock()
 
         await self.__initialize_webserver()
+        self.loop.create_task(HuskyMetrics.monitor_loop_lag(HuskyMetrics.LOOP_LAG, HuskyMetrics.LOOP_LAG_SUMMARY))
+
         await self.__initialize_database()
         await self.__init_load_plugins()
 
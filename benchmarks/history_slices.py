@@ -0,0 +1,56 @@
+"""
+Benchmark HuskyUtils.iter_history_slices against a simulated channel with a fixed round trip per page.
+
+Run from the repository root: python -m benchmarks.history_slices [message count] [slices]
+"""
+import asyncio
+import bisect
+import datetime
+import random
+import sys
+import time
+
+import discord
+
+from libhusky import HuskyUtils
+
+
+class SimulatedHistoryChannel:
+    """
+    A stand-in for a TextChannel with a fixed history and a fixed round trip per page.
+    """
+
+    def __init__(self, message_ids: list, latency: float):
+        self.message_ids = message_ids
+        self.latency = latency
+
+    async def history(self, limit: int, after: discord.Object, oldest_first: bool):
+        await asyncio.sleep(self.latency)
+
+        index = bisect.bisect_right(self.message_ids, after.id)
+
+        for message_id in self.message_ids[index:index + limit]:
+            yield discord.Object(id=message_id)
+
+
+async def benchmark(message_count: int = 20000, slices: int = 4, latency: float = 0.02):
+    before = datetime.datetime.utcnow()
+    after = before - datetime.timedelta(days=1)
+
+    (start_id, end_id) = (HuskyUtils.get_snowflake_for_time(after), HuskyUtils.get_snowflake_for_time(before))
+    message_ids = sorted(random.sample(range(start_id, end_id), message_count))
+    channel = SimulatedHistoryChannel(message_ids, latency)
+
+    for (slice_count, ordered) in ((1, True), (slices, True), (slices, False)):
+        count = 0
+        start = time.perf_counter()
+
+        # noinspection PyTypeChecker
+        async for _ in HuskyUtils.iter_history_slices(channel, after, before, slices=slice_count, ordered=ordered):
+            count += 1
+
+        print(f"slices={slice_count} ordered={ordered!s:<5}  {count} messages in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(benchmark(*[int(a) for a in sys.argv[1:3]]))
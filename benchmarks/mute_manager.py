@@ -0,0 +1,110 @@
+"""
+Benchmark MuteManager loading, lookups and the overdue catch-up against a simulated bot.
+
+Run from the repository root: python -m benchmarks.mute_manager [lookups]
+
+Every store the benchmark touches is written under a throwaway config prefix (see HUSKYBOT_CONFIG_PREFIX), and
+removed again afterwards, so the real mutes.json is never read or changed.
+"""
+import asyncio
+import glob
+import os
+import sys
+import time
+
+from libhusky import HuskyConfig, HuskyScheduler
+from libhusky.managers.MuteManager import MuteManager
+
+
+class SimulatedMember:
+    def __init__(self, user_id: int, latency: float):
+        self.id = user_id
+        self._latency = latency
+
+    async def remove_roles(self, *roles, reason=None):
+        await asyncio.sleep(self._latency)
+
+
+class SimulatedBot:
+    """
+    A stand-in for the bot (which also acts as its only guild) with a fixed round trip per request.
+    """
+
+    def __init__(self, latency: float):
+        self.loop = asyncio.get_event_loop()
+        self.config = HuskyConfig.get_session_store("mute_benchmark")
+        self.session_factory = None
+        self._latency = latency
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_guild(self, guild_id: int):
+        return self
+
+    def get_member(self, user_id: int):
+        return SimulatedMember(user_id, self._latency)
+
+    def get_role(self, role_id):
+        return object()
+
+
+async def benchmark(mute_counts: tuple = (100, 1000, 10000), overdue_ratio: float = 0.1, lookups: int = 100000,
+                    latency: float = 0.05):
+    """
+    Lookups should take roughly the same time at every size, and the catch-up should take about
+    (overdue mutes / CATCHUP_CONCURRENCY) round trips.
+    """
+    bot = SimulatedBot(latency)
+    now = HuskyScheduler.get_current_time()
+
+    for count in mute_counts:
+        overdue = int(count * overdue_ratio)
+
+        # Overdue mutes are all guild mutes, and the rest are split between the guild and a handful of channels.
+        HuskyConfig.get_config('mutes').set("mutes", [{
+            "user_id": i,
+            "reason": "Benchmark",
+            "guild": 0,
+            "channel": None if i < overdue or i % 2 else 1000 + i % 50,
+            "expiry": now - 60 if i < overdue else now + 3600 + i,
+            "perms_cache": None
+        } for i in range(count)])
+
+        start = time.perf_counter()
+        manager = MuteManager(bot)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if manager.__catchup_task__ is not None:
+            await manager.__catchup_task__
+        catchup_time = time.perf_counter() - start
+
+        members = [SimulatedMember(i, latency) for i in range(overdue, count)]
+
+        start = time.perf_counter()
+        for i in range(lookups):
+            await manager.find_user_mute_record(members[i % len(members)], None)
+        lookup_time = time.perf_counter() - start
+
+        print(f"{count:>6} mutes  load {load_time:.3f}s  catch-up of {overdue} {catchup_time:.2f}s  "
+              f"{lookup_time / lookups * 1e6:.3f} us/lookup")
+
+        manager.cleanup()
+
+
+def main():
+    prefix = f"benchmark{os.getpid()}"
+    os.environ['HUSKYBOT_CONFIG_PREFIX'] = prefix
+
+    try:
+        asyncio.get_event_loop().run_until_complete(benchmark(
+            lookups=int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+        ))
+    finally:
+        for path in glob.glob(f"config/{prefix}_*"):
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
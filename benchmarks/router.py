@@ -0,0 +1,36 @@
+"""
+Benchmark HuskyRouter route matching as the routing table grows. Matching should take roughly the same time at every
+size.
+
+Run from the repository root: python -m benchmarks.router [iterations]
+"""
+import sys
+import timeit
+
+from libhusky.HuskyHTTP import HuskyRouter
+
+
+def benchmark(route_counts: tuple = (10, 100, 1000, 10000), iterations: int = 100000):
+    async def handler(self, request):
+        pass
+
+    for count in route_counts:
+        router = HuskyRouter()
+
+        for i in range(count):
+            router.add_route("GET", f"/static/{i}/hook", "Bench", handler)
+            router.add_route("POST", f"/param/{i}/hook/{{guild}}", "Bench", handler)
+            router.add_route("GET", f"/mount/{i}", "Bench", handler, prefix=True)
+
+        router.compile()
+
+        last = count - 1
+        for path in (f"/static/{last}/hook", f"/param/{last}/hook/123456", f"/mount/{last}/some/file.txt"):
+            method = "POST" if path.startswith("/param/") else "GET"
+            seconds = timeit.timeit(lambda: router.match(method, path), number=iterations)
+
+            print(f"{count * 3:>6} routes  {path:<32} {seconds / iterations * 1e6:.3f} us/match")
+
+
+if __name__ == '__main__':
+    benchmark(iterations=int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -2,6 +2,8 @@ import json
 import os
 from threading import Lock
 
+from libhusky import HuskyMetrics
+
 
 def override_dumper(obj):
     if hasattr(obj, "toJSON"):
@@ -83,6 +85,8 @@ class WolfConfig:
         with open(self._path, 'w') as config_file:
             json.dump(self._config, config_file, sort_keys=True, default=override_dumper, indent=2)
 
+        HuskyMetrics.CONFIG_SAVES.inc(os.path.basename(self._path))
+
 
 __cache__ = {}
 
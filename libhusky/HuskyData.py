@@ -144,3 +144,47 @@ class GiveawayObject:
 
     def is_over(self):
         return self.end_time <= datetime.datetime.utcnow().timestamp()
+
+
+class ScheduledJob:
+    def __getitem__(self, item):
+        return getattr(self, item)
+
+    def __init__(self, data: dict = None):
+        self.payload = {}
+
+        if data is not None:
+            self.load_dict(data)
+
+    # Idempotency key. Scheduling a job with an existing key replaces the old job.
+    key = ""
+
+    # The handler type registered with the JobManager (e.g. "mute.expire")
+    job_type = ""
+
+    # UTC timestamp to run the job at.
+    run_at = None
+
+    # Number of failed executions so far.
+    attempts = 0
+
+    def load_dict(self, data: dict):
+        self.key = data.get('key')
+        self.job_type = data.get('job_type')
+        self.run_at = data.get('run_at')
+        self.attempts = data.get('attempts', 0)
+        self.payload = data.get('payload', {})
+
+        return self
+
+    def to_data(self):
+        return {
+            "key": self.key,
+            "job_type": self.job_type,
+            "run_at": self.run_at,
+            "attempts": self.attempts,
+            "payload": self.payload
+        }
+
+    def to_json(self):
+        return self.to_data()
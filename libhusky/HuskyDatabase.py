@@ -0,0 +1,374 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import logging
+
+# Database imports
+try:
+    import sqlalchemy
+    from sqlalchemy import Column, BigInteger, Float, Integer, String, Text, Index
+    from sqlalchemy.ext.declarative import declarative_base
+except ImportError:
+    sqlalchemy = None
+
+from libhusky import HuskyConfig, HuskyData
+
+LOG = logging.getLogger("HuskyBot.Database")
+
+# Set in the JSON stores once their records have been copied into the database, so the import only ever runs once.
+IMPORTED_FLAG_KEY = "importedToDatabase"
+
+# The most user IDs to put in a single IN clause when writing entrant changes.
+ENTRANT_CHUNK_SIZE = 500
+
+
+def is_enabled(bot) -> bool:
+    """
+    Check if database-backed storage should be used for managers.
+
+    Database storage is opt-in (via the `databaseStorage` config key), and requires a working database connection.
+    """
+    return sqlalchemy is not None \
+        and getattr(bot, 'session_factory', None) is not None \
+        and bool(bot.config.get('databaseStorage', False))
+
+
+@contextlib.contextmanager
+def session_scope(session_factory):
+    """
+    Provide a transactional scope around a series of database operations.
+    """
+    session = session_factory()
+
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+if sqlalchemy is not None:
+    Base = declarative_base()
+
+    class MuteRecord(Base):
+        __tablename__ = 'mutes'
+        __table_args__ = (
+            Index('ix_mutes_user_channel', 'user_id', 'channel'),
+        )
+
+        id = Column(Integer, primary_key=True, autoincrement=True)
+
+        user_id = Column(BigInteger, nullable=False, index=True)
+        guild = Column(BigInteger, nullable=False)
+        channel = Column(BigInteger, nullable=True)
+
+        reason = Column(Text)
+        expiry = Column(Float, nullable=True, index=True)
+        perms_cache = Column(Integer, nullable=True)
+
+        @staticmethod
+        def from_mute(mute: HuskyData.Mute) -> 'MuteRecord':
+            return MuteRecord(**mute.to_data())
+
+        def to_mute(self) -> HuskyData.Mute:
+            return HuskyData.Mute({
+                "user_id": self.user_id,
+                "reason": self.reason,
+                "guild": self.guild,
+                "channel": self.channel,
+                "expiry": self.expiry,
+                "perms_cache": self.perms_cache
+            })
+
+    class GiveawayRecord(Base):
+        __tablename__ = 'giveaways'
+
+        register_message_id = Column(BigInteger, primary_key=True, autoincrement=False)
+        register_channel_id = Column(BigInteger, nullable=False)
+
+        name = Column(String(512))
+        end_time = Column(Float, nullable=True, index=True)
+        winner_count = Column(Integer, nullable=False, default=1)
+
+        @staticmethod
+        def from_giveaway(giveaway: HuskyData.GiveawayObject) -> 'GiveawayRecord':
+            return GiveawayRecord(
+                register_message_id=giveaway.register_message_id,
+                register_channel_id=giveaway.register_channel_id,
+                name=giveaway.name,
+                end_time=giveaway.end_time,
+                winner_count=giveaway.winner_count
+            )
+
+        def to_giveaway(self) -> HuskyData.GiveawayObject:
+            return HuskyData.GiveawayObject({
+                "name": self.name,
+                "end_time": self.end_time,
+                "register_channel_id": self.register_channel_id,
+                "register_message_id": self.register_message_id,
+                "winner_count": self.winner_count
+            })
+
+    class GiveawayEntrantRecord(Base):
+        __tablename__ = 'giveaway_entrants'
+
+        giveaway_id = Column(BigInteger, primary_key=True, autoincrement=False)
+        user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+
+
+class StoreWriter:
+    """
+    Runs database writes on a single background thread, in the order they were submitted.
+
+    Store writes are blocking SQLAlchemy calls, and running them on the event loop would hold up every gateway event
+    behind a commit. Writes are fire-and-forget: callers don't wait for them, and failures are logged. Reads that
+    need to see those writes go through the same thread (see read), so they always run after every earlier write.
+    """
+
+    def __init__(self):
+        self._executor = None
+
+    def submit(self, func, *args) -> asyncio.Future:
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="HuskyDatabase")
+
+        future = asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(func, *args))
+        future.add_done_callback(_log_write_failure)
+
+        return future
+
+    async def read(self, func, *args):
+        """
+        Run a query on the writer thread, once every write submitted before it has finished.
+
+        :return: Returns the query's result. Unlike writes, failures are raised to the caller.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="HuskyDatabase")
+
+        return await asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def flush(self) -> None:
+        """
+        Wait for every write submitted so far to finish.
+        """
+        if self._executor is not None:
+            await asyncio.get_event_loop().run_in_executor(self._executor, lambda: None)
+
+
+writer = StoreWriter()
+
+
+def get_writer() -> StoreWriter:
+    return writer
+
+
+def _log_write_failure(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        LOG.error("A background database write failed.", exc_info=future.exception())
+
+
+def create_tables(engine) -> None:
+    """
+    Create all HuskyBot tables that do not yet exist. Existing tables are left alone.
+
+    :param engine: The SQLAlchemy engine to create tables on.
+    """
+    if sqlalchemy is None:
+        return
+
+    Base.metadata.create_all(engine)
+
+
+class MuteStore:
+    """
+    Relational storage for mute records.
+
+    Mutes are identified by their (user_id, channel) pair, matching the MuteManager's own index. Every write touches a
+    single row, and runs on the StoreWriter thread. Only mutes that expire need to be loaded up front (to schedule
+    their expiry), and everything else is looked up per user as it's needed.
+    """
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+
+    @staticmethod
+    def __find(session, user_id: int, channel):
+        return session.query(MuteRecord).filter(MuteRecord.user_id == user_id, MuteRecord.channel == channel)
+
+    def get_next_expiring(self, count: int = None) -> list:
+        """
+        Load the mutes that expire next, soonest (or most overdue) first. Permanent mutes are never returned.
+
+        :param count: The maximum number of mutes to load, or None to load every mute that expires.
+        :return: Returns a list of Mutes.
+        """
+        with session_scope(self._session_factory) as session:
+            records = session.query(MuteRecord) \
+                .filter(MuteRecord.expiry.isnot(None)) \
+                .order_by(MuteRecord.expiry.asc()) \
+                .limit(count)
+
+            return [r.to_mute() for r in records]
+
+    async def get_mutes_for_user(self, user_id: int) -> list:
+        """
+        Look up every mute (guild and channel) held by a user.
+
+        :param user_id: The user ID to look up.
+        :return: Returns a list of Mutes.
+        """
+        return await writer.read(self.__get_mutes_for_user, user_id)
+
+    def __get_mutes_for_user(self, user_id: int) -> list:
+        with session_scope(self._session_factory) as session:
+            return [r.to_mute() for r in session.query(MuteRecord).filter(MuteRecord.user_id == user_id)]
+
+    def save(self, mute: HuskyData.Mute) -> None:
+        # Snapshot the record now, as it may be changed again before the write runs.
+        writer.submit(self.__save, mute.to_data())
+
+    def delete(self, mute: HuskyData.Mute) -> None:
+        writer.submit(self.__delete, [(mute.user_id, mute.channel)])
+
+    def delete_many(self, mutes: list) -> None:
+        writer.submit(self.__delete, [(mute.user_id, mute.channel) for mute in mutes])
+
+    def __save(self, data: dict) -> None:
+        with session_scope(self._session_factory) as session:
+            updated = self.__find(session, data['user_id'], data['channel']).update({
+                MuteRecord.guild: data['guild'],
+                MuteRecord.reason: data['reason'],
+                MuteRecord.expiry: data['expiry'],
+                MuteRecord.perms_cache: data['perms_cache']
+            }, synchronize_session=False)
+
+            if not updated:
+                session.add(MuteRecord(**data))
+
+    def __delete(self, keys: list) -> None:
+        with session_scope(self._session_factory) as session:
+            for (user_id, channel) in keys:
+                self.__find(session, user_id, channel).delete(synchronize_session=False)
+
+    def import_from_json(self) -> int:
+        """
+        Copy all mutes out of mutes.json into the database. This will only ever run once per JSON store.
+
+        :return: Returns the number of mutes imported.
+        """
+        # Imports run before the first load, so they're written immediately rather than queued.
+        return _import_json_store('mutes', 'mutes', HuskyData.Mute, lambda m: self.__save(m.to_data()))
+
+
+class GiveawayStore:
+    """
+    Relational storage for giveaways, keyed by the giveaway's registration message ID. Writes run on the StoreWriter
+    thread.
+    """
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+
+    def load_all(self) -> list:
+        with session_scope(self._session_factory) as session:
+            records = session.query(GiveawayRecord).order_by(GiveawayRecord.end_time.asc())
+
+            return [r.to_giveaway() for r in records]
+
+    def save(self, giveaway: HuskyData.GiveawayObject) -> None:
+        writer.submit(self.__save, GiveawayRecord.from_giveaway(giveaway))
+
+    def delete(self, giveaway: HuskyData.GiveawayObject) -> None:
+        writer.submit(self.__delete, giveaway.register_message_id)
+
+    def __save(self, record: 'GiveawayRecord') -> None:
+        with session_scope(self._session_factory) as session:
+            session.merge(record)
+
+    def __delete(self, giveaway_id: int) -> None:
+        with session_scope(self._session_factory) as session:
+            session.query(GiveawayRecord) \
+                .filter(GiveawayRecord.register_message_id == giveaway_id) \
+                .delete(synchronize_session=False)
+            session.query(GiveawayEntrantRecord) \
+                .filter(GiveawayEntrantRecord.giveaway_id == giveaway_id) \
+                .delete(synchronize_session=False)
+
+    def load_entrants(self) -> dict:
+        """
+        Load every tracked giveaway entrant.
+
+        :return: Returns a dict of {giveaway message ID: set of entrant user IDs}.
+        """
+        entrants = {}
+
+        with session_scope(self._session_factory) as session:
+            for record in session.query(GiveawayEntrantRecord):
+                entrants.setdefault(record.giveaway_id, set()).add(record.user_id)
+
+        return entrants
+
+    def apply_entrant_changes(self, changes: dict) -> None:
+        """
+        Write a batch of entrant changes in a single transaction.
+
+        :param changes: A dict of {giveaway message ID: {user ID: True if the user entered, False if they left}}. The
+                        store takes ownership of this dict.
+        """
+        writer.submit(self.__apply_entrant_changes, changes)
+
+    def replace_entrants(self, giveaway_id: int, user_ids) -> None:
+        writer.submit(self.__replace_entrants, giveaway_id, list(user_ids))
+
+    def __apply_entrant_changes(self, changes: dict) -> None:
+        with session_scope(self._session_factory) as session:
+            for (giveaway_id, users) in changes.items():
+                user_ids = list(users.keys())
+
+                # Clear every changed row, then re-add the entrants. Chunked to stay under SQL variable limits.
+                for i in range(0, len(user_ids), ENTRANT_CHUNK_SIZE):
+                    session.query(GiveawayEntrantRecord) \
+                        .filter(GiveawayEntrantRecord.giveaway_id == giveaway_id,
+                                GiveawayEntrantRecord.user_id.in_(user_ids[i:i + ENTRANT_CHUNK_SIZE])) \
+                        .delete(synchronize_session=False)
+
+                session.bulk_save_objects([GiveawayEntrantRecord(giveaway_id=giveaway_id, user_id=u)
+                                           for (u, entered) in users.items() if entered])
+
+    def __replace_entrants(self, giveaway_id: int, user_ids: list) -> None:
+        with session_scope(self._session_factory) as session:
+            session.query(GiveawayEntrantRecord) \
+                .filter(GiveawayEntrantRecord.giveaway_id == giveaway_id) \
+                .delete(synchronize_session=False)
+            session.bulk_save_objects([GiveawayEntrantRecord(giveaway_id=giveaway_id, user_id=u) for u in user_ids])
+
+    def import_from_json(self) -> int:
+        """
+        Copy all giveaways out of giveaways.json into the database. This will only ever run once per JSON store.
+
+        :return: Returns the number of giveaways imported.
+        """
+        return _import_json_store('giveaways', 'giveaways', HuskyData.GiveawayObject,
+                                  lambda g: self.__save(GiveawayRecord.from_giveaway(g)))
+
+
+def _import_json_store(config_name: str, key: str, data_class, save_func) -> int:
+    json_store = HuskyConfig.get_config(config_name, create_if_nonexistent=True)
+
+    if json_store.get(IMPORTED_FLAG_KEY, False):
+        return 0
+
+    records = json_store.get(key, [])
+
+    for raw_record in records:
+        save_func(data_class(raw_record))
+
+    json_store.set(IMPORTED_FLAG_KEY, True)
+    LOG.info(f"Imported {len(records)} records from {config_name}.json into the database.")
+
+    return len(records)
@@ -5,16 +5,68 @@ from discord.ext import commands
 
 LOG = logging.getLogger("HuskyBot.HttpServer")
 
+# The match_info key that holds the rest of the path below a prefix mount.
+MOUNT_SUBPATH_KEY = "subpath"
+
+
+class Endpoint:
+    """
+    A single routed method: the handler, the plugin that owns it, and (while the plugin is loaded) the plugin's cog.
+    """
+
+    __slots__ = ('func', 'plugin', 'cog')
+
+    def __init__(self, func, plugin: str):
+        self.func = func
+        self.plugin = plugin
+        self.cog = None
+
+
+class RouteNode:
+    """
+    One path segment of the compiled routing tree.
+    """
+
+    __slots__ = ('children', 'param_name', 'param_child', 'methods', 'allowed', 'mount_methods', 'mount_allowed')
+
+    def __init__(self):
+        self.children = {}
+        self.param_name = None
+        self.param_child = None
+
+        # Endpoints for a path ending at this node, and for a prefix mounted at this node.
+        self.methods = None
+        self.allowed = None
+        self.mount_methods = None
+        self.mount_allowed = None
+
 
 class HuskyRouter:
     """
     A simple dynamic router that allows methods to be added/removed freely.
+
+    Paths may contain parameter segments (e.g. `/gatekeeper/hook/{guild}`), which are matched against a single path
+    segment and exposed to handlers through `request.match_info`. A path may also be added as a prefix mount, which
+    handles the path itself and everything below it (the remainder is in `request.match_info["subpath"]`).
+
+    Routes are kept in a registration table, which is compiled into a tree of path segments the next time a request
+    comes in after it changes. Static paths are looked up directly, so matching cost depends only on the depth of the
+    path and never on the number of routes.
     """
 
     def __init__(self):
         self.routes = {}
+        self.mounts = {}
 
-    def add_route(self, method: str, path: str, plugin: str, handler):
+        # Cogs of loaded plugins, by plugin name. Bound by the bot as plugins are added, so handlers don't need to look
+        # up their cog on every request.
+        self.__cogs__ = {}
+
+        self._static = {}
+        self._tree = RouteNode()
+        self._dirty = True
+
+    def add_route(self, method: str, path: str, plugin: str, handler, prefix: bool = False):
         """
         Add a new route to the internal routing table.
 
@@ -22,15 +74,17 @@ class HuskyRouter:
         :param path: The path that this route should handle.
         :param plugin: The plugin name this works on
         :param handler: The function/def that will handle this route.
+        :param prefix: If true, handle every path under this path as well.
         """
-        path_route = self.routes.setdefault(path, {})
-        path_route[method.upper()] = {}
+        path = normalize_path(path, prefix)
+
+        endpoint = Endpoint(handler, plugin)
+        endpoint.cog = self.__cogs__.get(plugin)
 
-        path_route[method.upper()]['func'] = handler
+        table = self.mounts if prefix else self.routes
+        table.setdefault(path, {})[method.upper()] = endpoint
 
-        # This is discordpy related bullshit, because we need to be able to
-        # pass a self()
-        path_route[method.upper()]['plugin'] = plugin
+        self._dirty = True
 
     def remove_method(self, path: str, method: str):
         """
@@ -46,6 +100,11 @@ class HuskyRouter:
 
         del path_route[method.upper()]
 
+        if len(path_route) == 0:
+            del self.routes[path]
+
+        self._dirty = True
+
     def remove_path(self, path: str):
         """
         Remove a specific path from our routing table.
@@ -53,48 +112,241 @@ class HuskyRouter:
         :param path: The path (and methods) to remove.
         """
         del self.routes[path]
+        self._dirty = True
 
     def remove_paths(self, path: str):
         """
-        Remove all paths that start with the specified path string.
+        Remove all paths (and prefix mounts) that start with the specified path string.
 
         :param path: The starting string to find and delete.
         """
 
-        for p in list(self.routes.keys()):
-            if p.startswith(path):
-                del self.routes[p]
+        for table in (self.routes, self.mounts):
+            for p in list(table.keys()):
+                if p.startswith(path):
+                    del table[p]
+
+        self._dirty = True
+
+    def bind_plugin(self, instance):
+        """
+        Bind a loaded plugin's cog to its routes. Called by the bot when a cog is added.
+        """
+        plugin_name = instance.__class__.__name__
+        self.__cogs__[plugin_name] = instance
+
+        for endpoint in self.__endpoints(plugin_name):
+            endpoint.cog = instance
+
+    def unbind_plugin(self, plugin_name: str):
+        """
+        Release a plugin's cog without removing its routes. Called by the bot when a cog is removed. Until the plugin
+        is loaded again, its routes respond with a 404.
+        """
+        self.__cogs__.pop(plugin_name, None)
+
+        for endpoint in self.__endpoints(plugin_name):
+            endpoint.cog = None
 
     def unload_plugin(self, instance):
         plugin_name = instance.__class__.__name__
+        self.unbind_plugin(plugin_name)
+
+        for table in (self.routes, self.mounts):
+            for path in list(table.keys()):
+                path_o = table[path]
 
-        for path in list(self.routes.keys()):
-            path_o = self.routes[path]
+                for method in list(path_o.keys()):
+                    if path_o[method].plugin == plugin_name:
+                        del path_o[method]
 
-            for method in list(path_o.keys()):
-                method_o = path_o[method]
+                if len(path_o.keys()) == 0:
+                    del table[path]
 
-                if method_o['plugin'] == plugin_name:
-                    del self.routes[path][method]
+        self._dirty = True
 
-            if len(path_o.keys()) == 0:
-                del self.routes[path]
+    def compile(self):
+        """
+        Rebuild the routing tree from the registration table. This is done automatically when a request comes in after
+        the table has changed.
+        """
+        static = {}
+        tree = RouteNode()
+
+        for (path, methods) in self.routes.items():
+            if not methods:
+                continue
+
+            allowed = tuple(methods.keys())
+
+            if '{' not in path:
+                static[path] = (methods.copy(), allowed)
+                continue
+
+            node = self.__build_node(tree, path)
+            node.methods = methods.copy()
+            node.allowed = allowed
+
+        for (path, methods) in self.mounts.items():
+            if not methods:
+                continue
+
+            node = self.__build_node(tree, path)
+            node.mount_methods = methods.copy()
+            node.mount_allowed = tuple(methods.keys())
+
+        self._static = static
+        self._tree = tree
+        self._dirty = False
+
+    def match(self, method: str, path: str):
+        """
+        Find the endpoint that handles a request.
+
+        Routes that don't handle the request method are skipped, so e.g. a static `GET /hook/static` doesn't hide a
+        `POST /hook/{guild}` from `POST /hook/static`.
+
+        :param method: The request method.
+        :param path: The (decoded) request path.
+        :return: Returns a tuple of the matching Endpoint and a dict of path parameters.
+        :raises web.HTTPNotFound: If no route matches the path.
+        :raises web.HTTPMethodNotAllowed: If a route matches the path, but not the method.
+        """
+        if self._dirty:
+            self.compile()
+
+        allowed = set()
+        static = self._static.get(path)
+
+        if static is not None:
+            (methods, static_allowed) = static
+            endpoint = methods.get(method)
+
+            if endpoint is not None:
+                return endpoint, {}
+
+            allowed.update(static_allowed)
+
+        found = _match_node(self._tree, path.split('/')[1:], 0, {}, method, allowed)
+
+        if found is not None:
+            return found
+
+        if allowed:
+            raise web.HTTPMethodNotAllowed(method=method, allowed_methods=sorted(allowed))
+
+        raise web.HTTPNotFound()
 
     def handle(self, bot: commands.Bot):
         async def wrapped(request: web.BaseRequest):
-            if request.path not in self.routes:
-                raise web.HTTPNotFound()
+            (endpoint, params) = self.match(request.method, request.path)
 
-            path_routes = self.routes[request.path]
+            cog = endpoint.cog
 
-            if request.method not in path_routes:
-                raise web.HTTPMethodNotAllowed(method=request.method, allowed_methods=path_routes.keys())
+            if cog is None:
+                # Plugins that were loaded before this router existed, or that were added without the bot knowing.
+                cog = bot.get_cog(name=endpoint.plugin)
 
-            method = path_routes[request.method]
-            result = await method['func'](bot.get_cog(name=method['plugin']), request=request)
+                if cog is None:
+                    raise web.HTTPNotFound()
+
+                self.bind_plugin(cog)
+
+            if params:
+                request.match_info.update(params)
+
+            result = await endpoint.func(cog, request=request)
             return result
         return wrapped
 
+    def __endpoints(self, plugin_name: str):
+        for table in (self.routes, self.mounts):
+            for methods in table.values():
+                for endpoint in methods.values():
+                    if endpoint.plugin == plugin_name:
+                        yield endpoint
+
+    @staticmethod
+    def __build_node(tree: RouteNode, path: str) -> RouteNode:
+        node = tree
+
+        for segment in path.split('/')[1:]:
+            if segment.startswith('{') and segment.endswith('}'):
+                name = segment[1:-1]
+
+                if node.param_child is None:
+                    node.param_name = name
+                    node.param_child = RouteNode()
+                elif node.param_name != name:
+                    raise ValueError(f"Path {path} names parameter {{{name}}}, but another route already uses "
+                                     f"{{{node.param_name}}} in the same position.")
+
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+
+        return node
+
+
+def normalize_path(path: str, prefix: bool = False) -> str:
+    if not path.startswith('/'):
+        raise ValueError(f"The path {path} must start with a /.")
+
+    # A mount at /foo/ is the same as a mount at /foo, and a root mount is stored as "".
+    if prefix:
+        path = path.rstrip('/')
+
+    return path
+
+
+def _match_node(node: RouteNode, segments: list, index: int, params: dict, method: str, allowed: set):
+    """
+    Match the remaining path segments against the tree. Static segments are preferred over parameters, and a full
+    route is preferred over a prefix mount; the deepest matching mount wins. Candidates that don't handle the method
+    are skipped, and their methods are collected into `allowed`.
+    """
+    if index == len(segments):
+        if node.methods is not None:
+            endpoint = node.methods.get(method)
+
+            if endpoint is not None:
+                return endpoint, params
+
+            allowed.update(node.allowed)
+
+        return _match_mount(node, segments, index, params, method, allowed)
+
+    segment = segments[index]
+
+    child = node.children.get(segment)
+    if child is not None:
+        found = _match_node(child, segments, index + 1, params, method, allowed)
+
+        if found is not None:
+            return found
+
+    if node.param_child is not None and segment != "":
+        found = _match_node(node.param_child, segments, index + 1, dict(params, **{node.param_name: segment}),
+                            method, allowed)
+
+        if found is not None:
+            return found
+
+    return _match_mount(node, segments, index, params, method, allowed)
+
+
+def _match_mount(node: RouteNode, segments: list, index: int, params: dict, method: str, allowed: set):
+    if node.mount_methods is None:
+        return None
+
+    endpoint = node.mount_methods.get(method)
+
+    if endpoint is None:
+        allowed.update(node.mount_allowed)
+        return None
+
+    return endpoint, dict(params, **{MOUNT_SUBPATH_KEY: "/".join(segments[index:])})
+
 
 router = HuskyRouter()
 
@@ -103,16 +355,18 @@ def get_router():
     return router
 
 
-def register(path: str, methods: list):
+def register(path: str, methods: list, prefix: bool = False):
     def decorator(f):
         """
         This is a ***dangerously ugly*** way of registering things with an otherwise pretty HTTP router.
 
-        We need to be able to access plugin instance selfs, and decorators can't get those. Boo.
+        We need to be able to access plugin instance selfs, and decorators can't get those. Boo. The bot binds the
+        plugin's cog to these routes once the plugin is loaded.
         """
         for method in methods:
             plugin = f.__qualname__.split('.')[-2]
-            router.add_route(method, path, plugin, f)
-            LOG.debug(f'Registered HTTP endpoint "{method} {path}" for plugin {plugin}')
+            router.add_route(method, path, plugin, f, prefix=prefix)
+            LOG.debug(f'Registered HTTP {"mount" if prefix else "endpoint"} "{method} {path}" for plugin {plugin}')
 
     return decorator
+
@@ -0,0 +1,418 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import time
+
+import aiohttp
+
+from libhusky import HuskyMetrics
+
+LOG = logging.getLogger("HuskyBot.HTTPClient")
+
+# Default request timeout (in seconds) for plugins that don't ask for their own.
+DEFAULT_TIMEOUT = 30
+
+# Connection pool settings, shared by every plugin.
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 10
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+
+# Response cache limits. Entries are evicted least-recently-used once either limit is hit.
+CACHE_MAX_ENTRIES = 500
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+class ClientMetrics:
+    """
+    Running request statistics for a single named client.
+    """
+
+    __slots__ = ('requests', 'errors', 'total_time', 'statuses', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.statuses = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "totalTime": self.total_time,
+            "statuses": dict(self.statuses),
+            "cacheHits": self.cache_hits,
+            "cacheMisses": self.cache_misses
+        }
+
+
+class CachedResponse:
+    """
+    A fully-read HTTP response, as stored in the response cache.
+    """
+
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status: int, headers: dict, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self, encoding: str = 'utf-8') -> str:
+        return self.body.decode(encoding)
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class ResponseCache:
+    """
+    A size-bounded LRU cache of responses, with an optional on-disk store for responses that never change.
+
+    Entries in memory expire after their TTL, but are kept (until evicted) so that they can still be served if the
+    upstream fails. Persisted entries don't expire, and are read back from disk after an eviction or restart.
+
+    Concurrent lookups of the same key share a single fetch.
+    """
+
+    def __init__(self, loop, path: str = None, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self._loop = loop
+        self._path = path
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+        # Entries are stored as {key: (expires_at, CachedResponse)}, least recently used first. A persisted entry
+        # never expires, and has an expiry of None.
+        self.__entries__ = collections.OrderedDict()
+        self.__size = 0
+
+        self.__in_flight__ = {}
+
+    async def get_or_fetch(self, key: str, fetch, ttl: float, persist: bool = False, cacheable=None,
+                           metrics: ClientMetrics = None) -> CachedResponse:
+        """
+        Get a response from the cache, or fetch (and cache) it.
+
+        :param key: The cache key for this response.
+        :param fetch: An async function returning a CachedResponse, called on a miss.
+        :param ttl: How long (in seconds) the response stays fresh. A TTL of 0 only shares concurrent fetches.
+        :param persist: If True, the response is immutable and is also stored on disk. TTL is ignored.
+        :param cacheable: A function deciding whether a response may be cached. By default, only HTTP 200 is cached.
+        :param metrics: The client metrics to record the hit (or miss) against.
+        :return: Returns the cached or newly fetched response.
+        """
+        entry = self.__get_entry(key)
+        if entry is None and persist:
+            entry = await self._loop.run_in_executor(None, self.__read_disk, key)
+
+            if entry is not None:
+                self.__put(key, entry)
+
+        if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+            if metrics is not None:
+                metrics.cache_hits += 1
+
+            return entry[1]
+
+        if metrics is not None:
+            metrics.cache_misses += 1
+
+        future = self.__in_flight__.get(key)
+        if future is None:
+            future = self._loop.create_task(self.__fetch(key, fetch, ttl, persist, cacheable or _is_ok))
+            self.__in_flight__[key] = future
+
+        try:
+            # Shielded, so one caller being cancelled doesn't cancel the fetch for everyone else.
+            return await asyncio.shield(future)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if entry is None:
+                raise
+
+            LOG.warning(f"Upstream request for {key} failed. Serving a stale cached response instead.")
+            return entry[1]
+
+    def invalidate(self, key: str) -> None:
+        entry = self.__entries__.pop(key, None)
+
+        if entry is not None:
+            self.__size -= len(entry[1].body)
+
+        if self._path is not None:
+            try:
+                os.remove(self.__get_disk_path(key))
+            except FileNotFoundError:
+                pass
+
+    async def __fetch(self, key: str, fetch, ttl: float, persist: bool, cacheable) -> CachedResponse:
+        try:
+            response = await fetch()
+        finally:
+            self.__in_flight__.pop(key, None)
+
+        if not cacheable(response):
+            return response
+
+        if persist:
+            self.__put(key, (None, response))
+
+            if self._path is not None:
+                await self._loop.run_in_executor(None, self.__write_disk, key, response)
+        elif ttl > 0:
+            self.__put(key, (time.monotonic() + ttl, response))
+
+        return response
+
+    def __get_entry(self, key: str):
+        entry = self.__entries__.get(key)
+
+        if entry is not None:
+            self.__entries__.move_to_end(key)
+
+        return entry
+
+    def __put(self, key: str, entry) -> None:
+        old = self.__entries__.pop(key, None)
+        if old is not None:
+            self.__size -= len(old[1].body)
+
+        # Anything too big to ever fit is just not kept in memory.
+        if len(entry[1].body) > self._max_bytes:
+            return
+
+        self.__entries__[key] = entry
+        self.__size += len(entry[1].body)
+
+        while len(self.__entries__) > self._max_entries or self.__size > self._max_bytes:
+            (_, evicted) = self.__entries__.popitem(last=False)
+            self.__size -= len(evicted[1].body)
+
+    def __get_disk_path(self, key: str) -> str:
+        return os.path.join(self._path, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def __read_disk(self, key: str):
+        if self._path is None:
+            return None
+
+        try:
+            with open(self.__get_disk_path(key), 'rb') as f:
+                header = json.loads(f.readline())
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            LOG.warning(f"Could not read the cached response for {key}. Ignoring it.")
+            return None
+
+        # Guard against (very unlikely) hash collisions.
+        if header.get('key') != key:
+            return None
+
+        return None, CachedResponse(header['status'], header['headers'], body)
+
+    def __write_disk(self, key: str, response: CachedResponse) -> None:
+        os.makedirs(self._path, exist_ok=True)
+
+        path = self.__get_disk_path(key)
+        temp_path = path + ".tmp"
+
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps({"key": key, "status": response.status, "headers": response.headers}).encode('utf-8'))
+            f.write(b'\n')
+            f.write(response.body)
+
+        os.replace(temp_path, path)
+
+
+def _is_ok(response: CachedResponse) -> bool:
+    return response.status == 200
+
+
+def _get_request_key(method: str, url: str, kwargs: dict) -> str:
+    key = f"{method.upper()} {url}"
+
+    # Requests with a query string or body are keyed on those too.
+    parts = {k: kwargs[k] for k in ('params', 'data', 'json') if kwargs.get(k) is not None}
+    if parts:
+        key += " " + json.dumps(parts, sort_keys=True, default=str)
+
+    return key
+
+
+class HTTPClientService:
+    """
+    The HTTP Client Service owns the single aiohttp session (and connection pool) that all of HuskyBot's outgoing HTTP
+    requests go through.
+
+    Sharing one session means connections, DNS lookups and TLS sessions are reused across plugins, and there's only one
+    thing to close on shutdown. Plugins don't get the session itself - they borrow a named client (see get_client),
+    which applies the plugin's own timeout and tracks its usage.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._session = None
+
+        self.__metrics__ = {}
+
+        config_prefix = os.environ.get('HUSKYBOT_CONFIG_PREFIX', '')
+        if config_prefix:
+            config_prefix += "_"
+
+        self.cache = ResponseCache(loop, f'config/{config_prefix}http_cache')
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared session, creating it on first use.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CONNECTION_LIMIT,
+                limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                loop=self._loop
+            )
+
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self.__on_request_start)
+            trace_config.on_request_end.append(self.__on_request_end)
+            trace_config.on_request_exception.append(self.__on_request_exception)
+
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config], loop=self._loop)
+
+        return self._session
+
+    def get_client(self, name: str, timeout: float = DEFAULT_TIMEOUT) -> 'HTTPClient':
+        """
+        Borrow a client for a plugin (or other component). Clients are cheap, and don't need to be closed.
+
+        :param name: The name to track this client's usage under (generally the plugin name).
+        :param timeout: The total timeout (in seconds) for this client's requests, unless overridden per request.
+        :return: Returns a named client backed by the shared session.
+        """
+        self.__metrics__.setdefault(name, ClientMetrics())
+
+        return HTTPClient(self, name, timeout)
+
+    def get_metrics(self) -> dict:
+        """
+        Get request statistics for every client, as {name: ClientMetrics}.
+        """
+        return self.__metrics__
+
+    def collect_metrics(self) -> list:
+        """
+        Build metrics for every client's usage. Registered as a collector with HuskyMetrics.
+        """
+        requests = HuskyMetrics.Gauge("huskybot_http_client_requests", "Outgoing HTTP requests, by client and status.",
+                                      ("client", "status"))
+        errors = HuskyMetrics.Gauge("huskybot_http_client_errors", "Outgoing HTTP requests that failed outright.",
+                                    ("client",))
+        seconds = HuskyMetrics.Gauge("huskybot_http_client_seconds", "Total time spent on outgoing HTTP requests.",
+                                     ("client",))
+        cache = HuskyMetrics.Gauge("huskybot_http_cache_lookups", "Response cache lookups, by client and result.",
+                                   ("client", "result"))
+
+        for (name, metrics) in self.__metrics__.items():
+            for (status, count) in metrics.statuses.items():
+                requests.set(count, name, status)
+
+            errors.set(metrics.errors, name)
+            seconds.set(metrics.total_time, name)
+            cache.set(metrics.cache_hits, name, "hit")
+            cache.set(metrics.cache_misses, name, "miss")
+
+        return [requests, errors, seconds, cache]
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            LOG.debug("Shared HTTP session closed.")
+
+        self._session = None
+
+    def __get_metrics(self, trace_config_ctx) -> ClientMetrics:
+        return self.__metrics__.setdefault(trace_config_ctx.trace_request_ctx or "unknown", ClientMetrics())
+
+    async def __on_request_start(self, session, trace_config_ctx, params):
+        trace_config_ctx.start = time.monotonic()
+
+    async def __on_request_end(self, session, trace_config_ctx, params: aiohttp.TraceRequestEndParams):
+        metrics = self.__get_metrics(trace_config_ctx)
+        metrics.requests += 1
+        metrics.total_time += time.monotonic() - trace_config_ctx.start
+        metrics.statuses[params.response.status] = metrics.statuses.get(params.response.status, 0) + 1
+
+    async def __on_request_exception(self, session, trace_config_ctx, params):
+        metrics = self.__get_metrics(trace_config_ctx)
+        metrics.requests += 1
+        metrics.errors += 1
+        metrics.total_time += time.monotonic() - trace_config_ctx.start
+
+
+class HTTPClient:
+    """
+    A named handle to the shared HTTP session. Requests behave exactly like aiohttp.ClientSession requests (they may
+    be awaited or used with `async with`).
+    """
+
+    def __init__(self, service: HTTPClientService, name: str, timeout: float):
+        self._service = service
+        self.name = name
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+    def request(self, method: str, url: str, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs['trace_request_ctx'] = self.name
+
+        return self._service.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def head(self, url: str, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    async def fetch(self, method: str, url: str, ttl: float, persist: bool = False, cacheable=None,
+                    **kwargs) -> CachedResponse:
+        """
+        Make a request through the shared response cache. The response is read fully, so there's nothing to release.
+
+        :param method: The HTTP method to use.
+        :param url: The URL to request.
+        :param ttl: How long (in seconds) to cache the response for. See ResponseCache.get_or_fetch.
+        :param persist: If True, the response never changes and is also cached on disk.
+        :param cacheable: A function deciding whether a response may be cached. By default, only HTTP 200 is cached.
+        :return: Returns the (possibly cached) response.
+        """
+
+        async def do_request():
+            async with self.request(method, url, **kwargs) as resp:
+                return CachedResponse(resp.status, dict(resp.headers), await resp.read())
+
+        return await self._service.cache.get_or_fetch(_get_request_key(method, url, kwargs), do_request, ttl,
+                                                      persist=persist, cacheable=cacheable,
+                                                      metrics=self.__get_metrics())
+
+    async def cached(self, key: str, fetch, ttl: float, persist: bool = False, cacheable=None) -> CachedResponse:
+        """
+        Cache the result of a custom fetch (e.g. one spanning several requests) under a key private to this client.
+
+        See ResponseCache.get_or_fetch for the parameters.
+        """
+        return await self._service.cache.get_or_fetch(f"{self.name}:{key}", fetch, ttl, persist=persist,
+                                                      cacheable=cacheable, metrics=self.__get_metrics())
+
+    def __get_metrics(self) -> ClientMetrics:
+        return self._service.get_metrics().setdefault(self.name, ClientMetrics())
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import re
+import time
+
+LOG = logging.getLogger("HuskyBot.Metrics")
+
+# How often (in seconds) the event loop lag monitor wakes up.
+LOOP_LAG_INTERVAL = 1.0
+
+
+class Metric:
+    """
+    Base class for a metric family. A family has a fixed set of label names, and one value per combination of label
+    values.
+
+    Updates are a single dict operation, so metrics are safe to use from hot paths (event dispatch, every HTTP call,
+    etc). Label values should be kept to a small, bounded set (event names, command names, route templates) - never
+    IDs or free text.
+    """
+
+    metric_type = None
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+
+        self._values = {}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+
+        for (label_values, value) in sorted(self._values.items()):
+            lines.extend(self._render_value(label_values, value))
+
+        return lines
+
+    def _render_value(self, label_values: tuple, value) -> list:
+        return [f"{self.name}{self._format_labels(label_values)} {_format_number(value)}"]
+
+    def _format_labels(self, label_values: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.labels, label_values)) + list((extra or {}).items())
+
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(f'{k}="{_escape_label(v)}"' for (k, v) in pairs) + "}"
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value: float, *label_values) -> None:
+        self._values[label_values] = value
+
+
+class Summary(Metric):
+    """
+    A count and running total of observations (e.g. latencies), plus the largest observation seen. Quantiles aren't
+    tracked, as they'd cost far more than the counters themselves.
+
+    A summary family may only hold _count, _sum and quantile samples, so the largest observation is exported as its own
+    gauge family, named <name>_max.
+    """
+
+    metric_type = "summary"
+
+    def observe(self, value: float, *label_values) -> None:
+        entry = self._values.get(label_values)
+
+        if entry is None:
+            self._values[label_values] = [1, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            if value > entry[2]:
+                entry[2] = value
+
+    def render(self) -> list:
+        lines = super().render()
+        lines.extend([f"# HELP {self.name}_max Largest single observation of {self.name}.",
+                      f"# TYPE {self.name}_max gauge"])
+
+        for (label_values, value) in sorted(self._values.items()):
+            lines.append(f"{self.name}_max{self._format_labels(label_values)} {_format_number(value[2])}")
+
+        return lines
+
+    def _render_value(self, label_values: tuple, value) -> list:
+        labels = self._format_labels(label_values)
+
+        return [
+            f"{self.name}_count{labels} {value[0]}",
+            f"{self.name}_sum{labels} {_format_number(value[1])}"
+        ]
+
+
+class MetricsRegistry:
+    """
+    The registry of every metric the bot exports.
+
+    Metrics are created once and kept for the life of the process, so getting a metric that already exists (e.g. when
+    a plugin reloads) returns the existing one. Values that are cheaper to read on demand than to track can be added
+    with a collector, which is called at render time.
+    """
+
+    def __init__(self):
+        self.__metrics__ = {}
+        self.__collectors__ = {}
+
+    def counter(self, name: str, description: str, labels: tuple = ()) -> Counter:
+        return self.__get_or_create(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str, labels: tuple = ()) -> Gauge:
+        return self.__get_or_create(Gauge, name, description, labels)
+
+    def summary(self, name: str, description: str, labels: tuple = ()) -> Summary:
+        return self.__get_or_create(Summary, name, description, labels)
+
+    def register_collector(self, name: str, collector) -> None:
+        """
+        Register (or replace) a collector.
+
+        :param name: A unique name for the collector.
+        :param collector: A function returning a list of metrics (generally fresh Gauges) to render.
+        """
+        self.__collectors__[name] = collector
+
+    def unregister_collector(self, name: str) -> None:
+        self.__collectors__.pop(name, None)
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+
+        for metric in self.__metrics__.values():
+            lines.extend(metric.render())
+
+        for (name, collector) in list(self.__collectors__.items()):
+            # noinspection PyBroadException
+            try:
+                for metric in collector():
+                    lines.extend(metric.render())
+            except Exception:
+                LOG.exception(f"Metrics collector {name} failed.")
+
+        return "\n".join(lines) + "\n"
+
+    def __get_or_create(self, clazz, name: str, description: str, labels: tuple):
+        metric = self.__metrics__.get(name)
+
+        if metric is None:
+            metric = self.__metrics__[name] = clazz(name, description, labels)
+        elif not isinstance(metric, clazz) or metric.labels != labels:
+            raise ValueError(f"Metric {name} is already registered with a different type or labels.")
+
+        return metric
+
+
+class RateLimitLogCounter(logging.Handler):
+    """
+    Counts discord.py's REST rate limit (HTTP 429) retries by route.
+
+    discord.py handles 429s internally and only reports them in a log message, so this handler watches the
+    `discord.http` logger for them. The bucket in the message is "<channel>:<guild>:<route>", of which only the route
+    template is kept.
+    """
+
+    RATE_LIMIT_PREFIX = "We are being rate limited"
+
+    def __init__(self, counter: Counter):
+        super().__init__(level=logging.WARNING)
+        self._counter = counter
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not isinstance(record.msg, str) or not record.msg.startswith(self.RATE_LIMIT_PREFIX):
+            return
+
+        bucket = record.args[-1] if record.args else ""
+        self._counter.inc(str(bucket).split(":", 2)[-1])
+
+
+async def monitor_loop_lag(gauge: Gauge, summary: Summary) -> None:
+    """
+    Measure how late the event loop is to wake a sleeping task. Anything over a few milliseconds means something is
+    blocking the loop.
+    """
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+
+        lag = max(time.monotonic() - start - LOOP_LAG_INTERVAL, 0.0)
+        gauge.set(lag)
+        summary.observe(lag)
+
+
+def _format_number(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+def _escape_label(value) -> str:
+    return re.sub(r'(["\\])', r'\\\1', str(value)).replace("\n", "\\n")
+
+
+registry = MetricsRegistry()
+
+# Core metrics, updated by the bot itself.
+GATEWAY_EVENTS = registry.counter("huskybot_events_total", "Events dispatched, by event name.", ("event",))
+COMMAND_INVOCATIONS = registry.counter("huskybot_commands_total", "Command invocations, by command and outcome.",
+                                       ("command", "outcome"))
+COMMAND_LATENCY = registry.summary("huskybot_command_seconds", "Time taken to run commands.", ("command",))
+LISTENER_LATENCY = registry.summary("huskybot_listener_seconds", "Time taken to run event listeners, by cog and "
+                                                                 "event.", ("cog", "event"))
+LOOP_LAG = registry.gauge("huskybot_event_loop_lag_seconds", "Most recently measured event loop lag.")
+LOOP_LAG_SUMMARY = registry.summary("huskybot_event_loop_lag_summary_seconds", "Measured event loop lag.")
+REST_REQUESTS = registry.counter("huskybot_discord_requests_total", "Discord REST API calls, by route and outcome.",
+                                 ("method", "route", "outcome"))
+REST_LATENCY = registry.summary("huskybot_discord_request_seconds",
+                                "Time taken by Discord REST API calls (including rate limit waits).",
+                                ("method", "route"))
+REST_RATE_LIMITS = registry.counter("huskybot_discord_rate_limits_total", "Discord REST API 429 responses, by route.",
+                                    ("route",))
+CONFIG_SAVES = registry.counter("huskybot_config_saves_total", "Config store writes to disk, by store.", ("store",))
+
+
+def get_registry() -> MetricsRegistry:
+    return registry
@@ -0,0 +1,205 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+
+LOG = logging.getLogger("HuskyBot.Scheduler")
+
+
+def get_current_time() -> float:
+    """
+    Get the current time on the same clock used by mute expiries and giveaway end times.
+
+    All deadlines in HuskyBot are stored as `datetime.utcnow().timestamp()` values, so the scheduler has to compare
+    against that exact clock (and not `time.time()`) to fire at the right moment.
+    """
+    return datetime.datetime.utcnow().timestamp()
+
+
+class ScheduledEntry:
+    """
+    A single pending item in the scheduler heap.
+
+    Entries are never removed from the middle of the heap. Instead, they are flagged as cancelled and skipped when they
+    reach the top (the "lazy deletion" strategy from the `heapq` docs).
+    """
+
+    __slots__ = ('when', 'seq', 'owner', 'key', 'callback', 'cancelled')
+
+    def __init__(self, when: float, seq: int, owner: str, key, callback):
+        self.when = when
+        self.seq = seq
+        self.owner = owner
+        self.key = key
+        self.callback = callback
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class HuskyScheduler:
+    """
+    A shared min-heap timer scheduler.
+
+    Managers register (owner, key) pairs with a deadline and an async callback. A single background task sleeps until
+    the earliest deadline (or until something earlier is scheduled), so an idle bot does no periodic wakeups at all.
+    Scheduling, rescheduling and cancelling an item are all O(log n) or better.
+
+    Each due callback runs in its own task, so a slow callback (REST calls, waiting on a lock) never delays other
+    entries that come due while it runs.
+    """
+
+    # Rebuild the heap once more than this fraction of it is dead (cancelled) entries.
+    COMPACT_RATIO = 0.5
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._cancelled_count = 0
+
+        self._wakeup = None
+        self.__task__ = None
+        self.__running__ = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, owner: str, key, when: float, callback) -> None:
+        """
+        Schedule (or reschedule) a callback to run at a specific time.
+
+        If the (owner, key) pair is already scheduled, the old entry is cancelled and replaced.
+
+        :param owner: The name of the manager/plugin that owns this entry. Used for bulk cancellation.
+        :param key: Any hashable identifier, unique within the owner.
+        :param when: The UTC timestamp (see `get_current_time`) at which the callback should run.
+        :param callback: A zero-argument callable returning an awaitable.
+        """
+        self.cancel(owner, key)
+
+        entry = ScheduledEntry(when, next(self._counter), owner, key, callback)
+        self._entries[(owner, key)] = entry
+        heapq.heappush(self._heap, entry)
+
+        self.__ensure_running()
+
+        # Only wake the runner if this entry is now the next thing due.
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, owner: str, key) -> bool:
+        """
+        Cancel a scheduled entry.
+
+        :param owner: The owner of the entry.
+        :param key: The key of the entry.
+        :return: Returns True if an entry was cancelled, False if nothing was scheduled.
+        """
+        entry = self._entries.pop((owner, key), None)
+
+        if entry is None:
+            return False
+
+        entry.cancelled = True
+        self._cancelled_count += 1
+        self.__maybe_compact()
+
+        return True
+
+    def cancel_owner(self, owner: str) -> None:
+        """
+        Cancel every entry registered by a specific owner. Generally used when a plugin unloads.
+
+        :param owner: The owner to purge from the scheduler.
+        """
+        for (entry_owner, key) in list(self._entries.keys()):
+            if entry_owner == owner:
+                self.cancel(entry_owner, key)
+
+    def is_scheduled(self, owner: str, key) -> bool:
+        return (owner, key) in self._entries
+
+    def get_deadline(self, owner: str, key):
+        entry = self._entries.get((owner, key))
+
+        if entry is None:
+            return None
+
+        return entry.when
+
+    def __maybe_compact(self):
+        if self._cancelled_count <= len(self._heap) * self.COMPACT_RATIO:
+            return
+
+        self._heap = [e for e in self._heap if not e.cancelled]
+        heapq.heapify(self._heap)
+        self._cancelled_count = 0
+
+    def __pop_cancelled(self):
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled_count -= 1
+
+    def __ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+
+        if self.__task__ is None or self.__task__.done():
+            self.__task__ = asyncio.get_event_loop().create_task(self.__run())
+
+    async def __run(self):
+        while True:
+            self._wakeup.clear()
+            self.__pop_cancelled()
+
+            if not self._heap:
+                # Nothing to do, so sleep until something is scheduled.
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0].when - get_current_time()
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._heap)
+            del self._entries[(entry.owner, entry.key)]
+
+            task = asyncio.get_event_loop().create_task(self.__invoke(entry))
+            self.__running__.add(task)
+            task.add_done_callback(self.__running__.discard)
+
+    @staticmethod
+    async def __invoke(entry: ScheduledEntry):
+        # noinspection PyBroadException
+        try:
+            await entry.callback()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            LOG.exception(f"Scheduled task {entry.key} for {entry.owner} raised an exception.")
+
+    def shutdown(self):
+        """
+        Stop waking up for scheduled callbacks, and cancel any that are running. Called when the bot closes.
+        """
+        if self.__task__ is not None:
+            self.__task__.cancel()
+            self.__task__ = None
+
+        for task in list(self.__running__):
+            task.cancel()
+
+
+scheduler = HuskyScheduler()
+
+
+def get_scheduler() -> HuskyScheduler:
+    return scheduler
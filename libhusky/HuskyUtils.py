@@ -1,10 +1,14 @@
+import asyncio
+import bisect
 import collections
 import datetime
 import gzip
 import hashlib
+import heapq
 import imghdr
 import logging
 import os
+import random
 import re
 import struct
 import subprocess
@@ -16,6 +20,9 @@ import unicodedata
 
 from libhusky import HuskyStatics, HuskyConfig
 
+# How many messages each slice of iter_history_slices may fetch ahead of the consumer.
+HISTORY_SLICE_BUFFER = 500
+
 
 def member_has_role(member, role_id):
     for r in member.roles:
@@ -159,6 +166,134 @@ def get_sort_index(target_list: list, new_object, attribute: str):
     return len(target_list)
 
 
+async def reservoir_sample(iterator, k: int, rng: random.Random):
+    """
+    Uniformly pick up to k items from an async iterator in a single pass (Algorithm R).
+
+    Only the k chosen items are ever held in memory, so this is safe to use on very large streams (e.g. the entrants
+    of a giant giveaway).
+
+    :param iterator: An async iterator to consume.
+    :param k: The maximum number of items to pick.
+    :param rng: The random number generator to use.
+    :return: Returns a tuple of (the picked items in random order, the total number of items seen).
+    """
+    reservoir = []
+    seen = 0
+
+    async for item in iterator:
+        if seen < k:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(seen + 1)
+
+            if j < k:
+                reservoir[j] = item
+
+        seen += 1
+
+    # The first k items land in the reservoir in stream order, so shuffle to make the ordering fair too.
+    rng.shuffle(reservoir)
+
+    return reservoir, seen
+
+
+def get_snowflake_for_time(when: datetime.datetime) -> int:
+    """
+    Get the lowest possible Discord snowflake for a (naive, UTC) point in time. Messages created at or after this time
+    will always have an ID greater than or equal to it.
+    """
+    timestamp = when.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    return TwitterSnowflake.new(timestamp, 0, 0, HuskyStatics.DISCORD_EPOCH).flake
+
+
+async def iter_history_slices(channel: discord.TextChannel, after: datetime.datetime, before: datetime.datetime = None,
+                              slices: int = 4, ordered: bool = True):
+    """
+    Iterate over a channel's history between two points in time.
+
+    The time range is split into equal snowflake ranges, which are all paged through at the same time. This overlaps
+    the round trips of one busy channel, but every slice still shares the channel's rate limit bucket (which discord.py
+    enforces), so more slices than that bucket allows will just queue up.
+
+    In ordered mode, messages are yielded oldest first. Each slice buffers at most HISTORY_SLICE_BUFFER messages ahead
+    of the consumer, so later slices stall until the earlier ones are consumed - on a long, busy range this approaches
+    a serial fetch. Consumers that don't care about order (e.g. counting messages) should pass ordered=False, which
+    yields messages from whichever slice has them.
+
+    :param channel: The channel to read history from.
+    :param after: The (naive, UTC) start of the time range.
+    :param before: The (naive, UTC) end of the time range. Defaults to now.
+    :param slices: The number of slices to fetch concurrently.
+    :param ordered: Whether messages must be yielded oldest first.
+    """
+    start_id = get_snowflake_for_time(after)
+    end_id = get_snowflake_for_time(before or datetime.datetime.utcnow())
+
+    if end_id <= start_id:
+        return
+
+    slices = max(1, min(slices, (end_id - start_id) >> 22))  # no point in slices shorter than a millisecond
+    bounds = [start_id + ((end_id - start_id) * i) // slices for i in range(slices + 1)]
+
+    if ordered:
+        queues = [asyncio.Queue(maxsize=HISTORY_SLICE_BUFFER) for _ in range(slices)]
+    else:
+        queues = [asyncio.Queue(maxsize=HISTORY_SLICE_BUFFER * slices)] * slices
+
+    async def fetch_slice(queue: asyncio.Queue, slice_start: int, slice_end: int):
+        # discord.py's history iterator won't stop at a `before` bound when paging forward, so page by hand instead.
+        # Slices cover [slice_start, slice_end), and `after` is exclusive, so start just below the slice.
+        cursor = slice_start - 1
+        done = False
+
+        try:
+            while not done:
+                page_size = 0
+
+                async for message in channel.history(limit=100, after=discord.Object(id=cursor), oldest_first=True):
+                    page_size += 1
+                    cursor = message.id
+
+                    if message.id >= slice_end:
+                        break
+
+                    await queue.put(message)
+
+                done = page_size < 100 or cursor >= slice_end
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Hand the error to the consumer, so it's raised in order.
+            await queue.put(e)
+            return
+
+        await queue.put(None)
+
+    tasks = [asyncio.ensure_future(fetch_slice(queues[i], bounds[i], bounds[i + 1])) for i in range(slices)]
+
+    try:
+        # In unordered mode every slice shares one queue, which is done once every slice has finished.
+        for queue in (queues if ordered else queues[:1]):
+            remaining = 1 if ordered else slices
+
+            while remaining > 0:
+                message = await queue.get()
+
+                if message is None:
+                    remaining -= 1
+                    continue
+
+                if isinstance(message, Exception):
+                    raise message
+
+                yield message
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 def get_image_size(fname):
     """
     Determine the image type of fhandle and return its size.
@@ -395,6 +530,289 @@ class TwitterSnowflake:
         return datetime.datetime.fromtimestamp(self.timestamp)
 
 
+class JoinOrderIndex:
+    """
+    Tracks the join order of a guild's members, for "Member #n" style lookups.
+
+    Members are kept in slots sorted by (joined_at, id), with a Fenwick tree over the slots counting which ones are
+    still occupied. New joins are almost always the newest member, so they're appended to the end. Adding, removing and
+    ranking a member are all O(log n). The index is rebuilt from scratch if a join arrives out of order, or once most of
+    the slots are empty.
+    """
+
+    # Rebuild once more than this fraction of slots belong to members who left.
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, members=()):
+        self._tree = [0]
+        self._keys = []
+        self._slots = {}
+
+        self.rebuild(members)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, member):
+        return member.id in self._slots
+
+    @staticmethod
+    def __get_key(member):
+        return member.joined_at or datetime.datetime.min, member.id
+
+    def rebuild(self, members) -> None:
+        """
+        Rebuild the index from a full member list. This is O(n log n), and should only happen rarely.
+        """
+        self.__build(sorted(self.__get_key(m) for m in members))
+
+    def add(self, member) -> None:
+        if member.id in self._slots:
+            return
+
+        key = self.__get_key(member)
+
+        if self._keys and key < self._keys[-1]:
+            self.__build(sorted(self.__live_keys() + [key]))
+            return
+
+        # Appending to a Fenwick tree: the new node covers slots (i - lowbit(i), i], so its value is 1 plus the number
+        # of live slots it covers (which all come before it).
+        i = len(self._tree)
+        self._tree.append(1 + self.__prefix_sum(i - 1) - self.__prefix_sum(i - (i & -i)))
+        self._keys.append(key)
+        self._slots[member.id] = i
+
+    def remove(self, member) -> None:
+        slot = self._slots.pop(member.id, None)
+
+        if slot is None:
+            return
+
+        i = slot
+        while i < len(self._tree):
+            self._tree[i] -= 1
+            i += i & -i
+
+        if len(self._keys) - len(self._slots) > len(self._keys) * self.COMPACT_RATIO:
+            self.__build(self.__live_keys())
+
+    def get_rank(self, member):
+        """
+        Get the 1-based join position of a member, or None if the member isn't in the index.
+        """
+        slot = self._slots.get(member.id)
+
+        if slot is None:
+            return None
+
+        return self.__prefix_sum(slot)
+
+    def __build(self, keys: list) -> None:
+        self._keys = keys
+        self._slots = {member_id: i + 1 for (i, (_, member_id)) in enumerate(keys)}
+
+        # Linear-time Fenwick tree construction, with every slot occupied.
+        self._tree = [0] + [1] * len(keys)
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __live_keys(self) -> list:
+        return [key for (i, key) in enumerate(self._keys) if self._slots.get(key[1]) == i + 1]
+
+    def __prefix_sum(self, i: int) -> int:
+        total = 0
+
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+
+        return total
+
+
+class RankedCounter:
+    """
+    A counter that can list its highest counts without sorting everything.
+
+    Keys are grouped into buckets by count, and the distinct counts are kept in a sorted list. Counts usually move one
+    step at a time, so an update only touches neighbouring buckets. Listing the top k walks the buckets from the top
+    down, and doesn't look at anything below the k-th key.
+    """
+
+    def __init__(self, counts: dict = None):
+        self._counts = {}
+        self._buckets = {}
+        self._order = []
+
+        for (key, count) in (counts or {}).items():
+            self.add(key, count)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __getitem__(self, key):
+        return self._counts.get(key, 0)
+
+    def items(self):
+        return self._counts.items()
+
+    def add(self, key, amount: int = 1) -> int:
+        """
+        Change the count of a key. Keys whose count drops to zero (or below) are removed.
+
+        :return: Returns the key's new count.
+        """
+        old_count = self._counts.get(key, 0)
+        new_count = old_count + amount
+
+        if old_count > 0:
+            self.__remove_from_bucket(key, old_count)
+
+        if new_count > 0:
+            self._counts[key] = new_count
+
+            bucket = self._buckets.get(new_count)
+            if bucket is None:
+                bucket = self._buckets[new_count] = set()
+                bisect.insort(self._order, new_count)
+
+            bucket.add(key)
+        else:
+            self._counts.pop(key, None)
+
+        return max(new_count, 0)
+
+    def top(self, k: int) -> list:
+        """
+        Get the k highest counts, as a list of (key, count) tuples. Ties are broken by key.
+        """
+        result = []
+
+        for count in reversed(self._order):
+            if len(result) >= k:
+                break
+
+            # A tie bucket can be huge (e.g. everyone on 1), so only pick out the keys we need from it.
+            for key in heapq.nsmallest(k - len(result), self._buckets[count]):
+                result.append((key, count))
+
+        return result
+
+    def __remove_from_bucket(self, key, count: int):
+        bucket = self._buckets[count]
+        bucket.discard(key)
+
+        if not bucket:
+            del self._buckets[count]
+            del self._order[bisect.bisect_left(self._order, count)]
+
+
+class GifScanner:
+    """
+    Walks the block structure of a GIF as it arrives, without decoding any image data.
+
+    Only the logical screen descriptor and each frame's image descriptor are read; everything else (color tables,
+    extensions and compressed image data) is skipped over by length. Feed the file in with `feed` as it downloads, and
+    check the screen size and frame extents as they become known.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+        self.screen_size = None
+        self.frame_count = 0
+        self.max_frame_extent = (0, 0)
+
+        # Set once the trailer is reached, or once the data turns out not to be a valid GIF.
+        self.complete = False
+        self.error = None
+
+        self._pos = 0
+        self._in_sub_blocks = False
+
+    def feed(self, chunk: bytes) -> None:
+        self.data += chunk
+
+        if not self.complete and self.error is None:
+            self.__parse()
+
+    def __parse(self):
+        data = self.data
+
+        while True:
+            if self._in_sub_blocks:
+                # Extension and image data are chains of length-prefixed sub-blocks, ending with an empty one.
+                if self._pos >= len(data):
+                    return
+
+                size = data[self._pos]
+                if self._pos + 1 + size > len(data):
+                    return
+
+                self._pos += 1 + size
+                self._in_sub_blocks = size != 0
+                continue
+
+            if self.screen_size is None:
+                if len(data) < 13:
+                    return
+
+                if bytes(data[:6]) not in (b'GIF87a', b'GIF89a'):
+                    self.error = "Not a GIF file"
+                    return
+
+                (width, height, flags) = struct.unpack_from('<HHB', data, 6)
+                self.screen_size = (width, height)
+                self._pos = 13 + self.__get_color_table_size(flags)
+                continue
+
+            if self._pos >= len(data):
+                return
+
+            block = data[self._pos]
+
+            if block == 0x3B:
+                self.complete = True
+                return
+            elif block == 0x21:
+                # Extension: introducer, label, then sub-blocks.
+                if self._pos + 2 > len(data):
+                    return
+
+                self._pos += 2
+                self._in_sub_blocks = True
+            elif block == 0x2C:
+                # Image descriptor: left, top, width, height, flags, then a local color table, the LZW minimum code
+                # size, and the image data sub-blocks.
+                if self._pos + 10 > len(data):
+                    return
+
+                (left, top, width, height, flags) = struct.unpack_from('<HHHHB', data, self._pos + 1)
+                header_size = 10 + self.__get_color_table_size(flags) + 1
+
+                if self._pos + header_size > len(data):
+                    return
+
+                self.frame_count += 1
+                self.max_frame_extent = (max(self.max_frame_extent[0], left + width),
+                                         max(self.max_frame_extent[1], top + height))
+
+                self._pos += header_size
+                self._in_sub_blocks = True
+            else:
+                self.error = f"Unknown block 0x{block:02x} at offset {self._pos}"
+                return
+
+    @staticmethod
+    def __get_color_table_size(flags: int) -> int:
+        if not flags & 0x80:
+            return 0
+
+        return 3 * (2 ** ((flags & 0x07) + 1))
+
+
 class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
     # Code source: https://stackoverflow.com/a/35547094/1817097
     # Modified by Kaz Wolfe
@@ -448,3 +866,4 @@ class Singleton(type):
         if cls not in cls._instances:
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
+
@@ -1,23 +1,103 @@
 #   This Source Code Form is "Incompatible With Secondary Licenses", as
 #   defined by the Mozilla Public License, v. 2.0.
 
+import asyncio
+import collections
 import datetime
+import hashlib
 import logging
 
+import aiohttp
 import discord
 from discord.ext import commands
 
+from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
 from libhusky.antispam import AntiSpamModule
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin.AntiSpam." + __name__.split('.')[-1])
 
 defaults = {
     'seconds': 15,  # Cooldown timer (reset)
     'warnLimit': 3,  # Number of attachment messages before warning the user
-    'banLimit': 5  # Number of attachment messages before banning the user
+    'banLimit': 5,  # Number of attachment messages before banning the user
+    'payloadSeconds': 120,  # How long a posted file counts towards a repeated payload
+    'payloadAuthorLimit': 4,  # Number of distinct users posting the same file before staff are alerted
+    'payloadDelete': False  # Whether to delete repeated payloads once detected
 }
 
+# Files are identified by their size and a hash of their first PAYLOAD_HASH_BYTES.
+PAYLOAD_HASH_BYTES = 64 * 1024
+
+# Memory bounds for the repeated payload index (sightings kept, and attachment hashes remembered).
+PAYLOAD_INDEX_SIZE = 5000
+PAYLOAD_HASH_CACHE_SIZE = 1000
+
+
+class PayloadIndex:
+    """
+    A time-windowed index of which users have posted which files, per guild.
+
+    Sightings are kept in a ring buffer, so the index never holds more than a fixed number of them no matter how busy
+    the guild is. Each payload keeps a count of sightings per author, which is updated as sightings enter and leave
+    the buffer.
+    """
+
+    def __init__(self, max_size: int = PAYLOAD_INDEX_SIZE):
+        self._max_size = max_size
+
+        # Sightings as (time, guild_id, payload_key, author_id, message), oldest first.
+        self._sightings = collections.deque()
+        self._authors = {}
+
+    def __len__(self):
+        return len(self._sightings)
+
+    def add(self, guild_id: int, payload_key, author_id: int, message: discord.Message) -> int:
+        """
+        Record a sighting of a payload.
+
+        :return: Returns the number of distinct authors that have posted the payload in the window.
+        """
+        if len(self._sightings) >= self._max_size:
+            self.__drop_oldest()
+
+        self._sightings.append((datetime.datetime.utcnow(), guild_id, payload_key, author_id, message))
+
+        authors = self._authors.setdefault((guild_id, payload_key), collections.Counter())
+        authors[author_id] += 1
+
+        return len(authors)
+
+    def get_messages(self, guild_id: int, payload_key) -> list:
+        return [s[4] for s in self._sightings if s[1] == guild_id and s[2] == payload_key]
+
+    def get_authors(self, guild_id: int, payload_key) -> list:
+        return list(self._authors.get((guild_id, payload_key), {}).keys())
+
+    def expire(self, window: datetime.timedelta) -> None:
+        cutoff = datetime.datetime.utcnow() - window
+
+        while self._sightings and self._sightings[0][0] < cutoff:
+            self.__drop_oldest()
+
+    def clear(self) -> None:
+        self._sightings.clear()
+        self._authors.clear()
+
+    def __drop_oldest(self):
+        (_, guild_id, payload_key, author_id, _) = self._sightings.popleft()
+
+        authors = self._authors[(guild_id, payload_key)]
+        authors[author_id] -= 1
+
+        if authors[author_id] <= 0:
+            del authors[author_id]
+
+        if not authors:
+            del self._authors[(guild_id, payload_key)]
+
 
 class AttachmentFilter(AntiSpamModule):
     """
@@ -29,6 +109,9 @@ class AttachmentFilter(AntiSpamModule):
     This antispam module is specifically geared towards raids and image dumps. Multiple images on one message will not
     trigger this filter.
 
+    The filter also recognizes the same file being posted by many different users (a common raid tactic), and alerts
+    staff once a file has been posted by more than a set number of users in a short time.
+
     Default Parameters:
         Time to Cooldown: 15 Seconds
         Warning Limit: 3 Attachments
@@ -46,11 +129,24 @@ class AttachmentFilter(AntiSpamModule):
         )
 
         self.bot = plugin.bot
+        self._ban_manager = BanManager(self.bot)
         self._config = self.bot.config
 
         self._events = {}
 
+        self._http_session = self.bot.http_client.get_client("AttachmentFilter", timeout=10)
+        self._payloads = PayloadIndex()
+
+        # Payload hashes by attachment ID (so an attachment is only ever downloaded once), and detected payloads (so
+        # each is only reported once per window). Both are LRU.
+        self.__payload_hashes__ = collections.OrderedDict()
+        self.__detected_payloads__ = collections.OrderedDict()
+
+        # Payload indexing runs alongside the rest of the filter, so its tasks are tracked to be cancelled on unload.
+        self.__index_tasks__ = set()
+
         self.add_command(self.set_attach_cooldown)
+        self.add_command(self.set_payload_limit)
         self.add_command(self.clear_cooldown)
         self.add_command(self.clear_all_cooldowns)
         self.add_command(self.view_config)
@@ -60,11 +156,18 @@ class AttachmentFilter(AntiSpamModule):
 
     def cleanup(self):
         # Purge expired events/cooldowns.
-        for user_id in self._events.keys():
+        for user_id in list(self._events.keys()):
             if self._events[user_id]['expiry'] < datetime.datetime.utcnow():
                 LOG.info("Cleaning up expired cooldown for user %s", user_id)
                 del self._events[user_id]
 
+        filter_config = self.__get_filter_config()
+        self._payloads.expire(datetime.timedelta(seconds=filter_config['payloadSeconds']))
+
+    def unload(self):
+        for task in self.__index_tasks__:
+            task.cancel()
+
     def clear_for_user(self, user: discord.Member):
         if user.id not in self._events.keys():
             raise KeyError("The user requested does not have a record for this filter.")
@@ -73,10 +176,129 @@ class AttachmentFilter(AntiSpamModule):
 
     def clear_all(self):
         self._events = {}
+        self._payloads.clear()
+        self.__detected_payloads__.clear()
 
-    async def process_message(self, message: discord.Message, context):
+    def __get_filter_config(self) -> dict:
         as_config = self._config.get('antiSpam', {})
-        filter_config = as_config.get('AttachmentFilter', {}).get('config', defaults)
+        return {**defaults, **as_config.get('AttachmentFilter', {}).get('config', {})}
+
+    async def get_payload_key(self, attachment: discord.Attachment):
+        """
+        Get the key identifying an attachment's file: its size, and a hash of the start of the file.
+
+        :return: Returns a (size, hash) tuple, or None if the file couldn't be read.
+        """
+        digest = self.__payload_hashes__.get(attachment.id)
+
+        if digest is None:
+            # Only the start of the file is needed, so don't download the rest.
+            try:
+                async with self._http_session.get(attachment.url,
+                                                  headers={"Range": f"bytes=0-{PAYLOAD_HASH_BYTES - 1}"}) as r:
+                    if r.status not in (200, 206):
+                        return None
+
+                    data = bytearray()
+                    async for chunk in r.content.iter_any():
+                        data += chunk
+
+                        if len(data) >= PAYLOAD_HASH_BYTES:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None
+
+            digest = hashlib.sha256(data[:PAYLOAD_HASH_BYTES]).hexdigest()
+
+            self.__payload_hashes__[attachment.id] = digest
+            while len(self.__payload_hashes__) > PAYLOAD_HASH_CACHE_SIZE:
+                self.__payload_hashes__.popitem(last=False)
+
+        return attachment.size, digest
+
+    async def index_payloads(self, message: discord.Message, filter_config: dict):
+        window = datetime.timedelta(seconds=filter_config['payloadSeconds'])
+        self._payloads.expire(window)
+
+        for attachment in message.attachments:  # type: discord.Attachment
+            payload_key = await self.get_payload_key(attachment)
+
+            if payload_key is None:
+                continue
+
+            author_count = self._payloads.add(message.guild.id, payload_key, message.author.id, message)
+
+            if filter_config['payloadAuthorLimit'] == 0 or author_count < filter_config['payloadAuthorLimit']:
+                continue
+
+            detection_key = (message.guild.id, payload_key)
+            detected_at = self.__detected_payloads__.get(detection_key)
+
+            if detected_at is not None and detected_at > datetime.datetime.utcnow() - window:
+                # Already reported. Just clean up after it, if we're meant to.
+                if filter_config['payloadDelete']:
+                    await self.__delete_quietly(message)
+                continue
+
+            self.__detected_payloads__[detection_key] = datetime.datetime.utcnow()
+            self.__detected_payloads__.move_to_end(detection_key)
+            while len(self.__detected_payloads__) > PAYLOAD_HASH_CACHE_SIZE:
+                self.__detected_payloads__.popitem(last=False)
+
+            await self.__report_payload(message, attachment, payload_key, filter_config)
+
+    async def __report_payload(self, message: discord.Message, attachment: discord.Attachment, payload_key,
+                               filter_config: dict):
+        authors = self._payloads.get_authors(message.guild.id, payload_key)
+        messages = self._payloads.get_messages(message.guild.id, payload_key)
+
+        LOG.info(f"File {attachment.filename} ({attachment.size} bytes) was posted by {len(authors)} users in "
+                 f"{filter_config['payloadSeconds']} seconds. Possible raid.")
+
+        if filter_config['payloadDelete']:
+            for m in messages:
+                await self.__delete_quietly(m)
+
+        alert_channel = self._config.get('specialChannels', {}).get(ChannelKeys.STAFF_ALERTS.value, None)
+        if alert_channel is not None:
+            alert_channel = message.guild.get_channel(alert_channel)
+
+        if alert_channel is None:
+            return
+
+        channels = {m.channel.mention for m in messages}
+        author_list = ", ".join(f"<@{a}>" for a in authors)
+
+        embed = discord.Embed(
+            description=f"The same file was posted by {len(authors)} different users in a "
+                        f"{filter_config['payloadSeconds']}-second period. This may be a raid.",
+            color=Colors.WARNING
+        )
+
+        embed.set_author(name="Repeated Attachment Detected")
+        embed.add_field(name="File", value=f"`{attachment.filename}` ({attachment.size} bytes)", inline=True)
+        embed.add_field(name="Channels", value=", ".join(channels), inline=True)
+        embed.add_field(name="Users", value=HuskyUtils.trim_string(author_list, 1000), inline=False)
+        embed.add_field(name="Action Taken",
+                        value="Messages Deleted" if filter_config['payloadDelete'] else "None", inline=False)
+
+        await alert_channel.send(embed=embed)
+
+    async def __delete_quietly(self, message: discord.Message):
+        try:
+            await message.delete()
+        except discord.HTTPException as e:
+            # Already gone, or we lack permission. Either way, one message shouldn't stop the rest from being deleted.
+            LOG.debug(f"Couldn't delete repeated payload message {message.id}: {e}")
+
+    def __on_index_done(self, task: asyncio.Task):
+        self.__index_tasks__.discard(task)
+
+        if not task.cancelled() and task.exception() is not None:
+            LOG.error("Failed to index attachment payloads.", exc_info=task.exception())
+
+    async def process_message(self, message: discord.Message, context):
+        filter_config = self.__get_filter_config()
 
         # Prepare the logger
         log_channel = self._config.get('specialChannels', {}).get(ChannelKeys.STAFF_LOG.value, None)
@@ -92,6 +314,12 @@ class AttachmentFilter(AntiSpamModule):
         if message.author.permissions_in(message.channel).manage_messages:
             return
 
+        # Attachments can't be added by an edit, so only new messages are indexed.
+        if len(message.attachments) > 0 and context == 'new_message':
+            task = self.bot.loop.create_task(self.index_payloads(message, filter_config))
+            self.__index_tasks__.add(task)
+            task.add_done_callback(self.__on_index_done)
+
         if len(message.attachments) > 0:
             # User posted an attachment, and is not in the cache. Let's add them, on strike 0.
             cooldown_record = self._events.setdefault(message.author.id, {
@@ -123,10 +351,11 @@ class AttachmentFilter(AntiSpamModule):
 
                 LOG.info(f"User {message.author} has been warned for posting too many attachments in a short while.")
             elif cooldown_record['offenseCount'] >= filter_config['banLimit']:
-                await message.author.ban(reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent "
-                                                f"{cooldown_record['offenseCount']} attachments in a "
-                                                f"{filter_config['seconds']} second period.",
-                                         delete_message_days=1)
+                await self._ban_manager.ban(
+                    message.guild, message.author,
+                    reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent {cooldown_record['offenseCount']} "
+                           f"attachments in a {filter_config['seconds']} second period.",
+                    delete_message_days=1)
                 del self._events[message.author.id]
                 LOG.info(f"User {message.author} has been banned for posting over {filter_config['banLimit']} "
                          f"attachments in a {filter_config['seconds']} period.")
@@ -179,6 +408,45 @@ class AttachmentFilter(AntiSpamModule):
             color=Colors.SUCCESS
         ))
 
+    @commands.command(name="payloadLimit", brief="Configure repeated file detection for AttachmentFilter")
+    async def set_payload_limit(self, ctx: commands.Context, seconds: int, author_limit: int, delete: bool = False):
+        """
+        AntiSpam can recognize the same file being posted by many different users, which is common during raids. Once
+        a file has been posted by `author_limit` different users within `seconds` seconds, staff will be alerted (and,
+        optionally, every copy of the file will be deleted).
+
+        Files are recognized by their size and contents, so renaming a file won't get around this check.
+
+        Parameters
+        ----------
+            ctx           :: Discord context <!nodoc>
+            seconds       :: The number of seconds a posted file is remembered for.
+            author_limit  :: The number of different users posting a file before staff are alerted. 0 to disable.
+            delete        :: Whether to delete every copy of the file once detected. Default false.
+
+        Examples
+        --------
+            /as attachFilter payloadLimit 120 4       :: Alert staff when 4 users post a file within 2 minutes.
+            /as attachFilter payloadLimit 60 3 true   :: Alert staff and delete the file when 3 users post it in 60s.
+        """
+
+        as_config = self._config.get('antiSpam', {})
+        attach_config = as_config.setdefault('AttachmentFilter', {}).setdefault('config', dict(defaults))
+
+        attach_config['payloadSeconds'] = seconds
+        attach_config['payloadAuthorLimit'] = author_limit
+        attach_config['payloadDelete'] = delete
+
+        self._config.set('antiSpam', as_config)
+
+        await ctx.send(embed=discord.Embed(
+            title="AntiSpam Plugin",
+            description=f"The attachments module of AntiSpam will now alert staff when the same file is posted by "
+                        f"**`{author_limit}`** users in a **`{seconds}` second** period"
+                        f"{', and delete every copy' if delete else ''}.",
+            color=Colors.SUCCESS
+        ))
+
     @commands.command(name="viewConfig", brief="See currently set configuration values for this plugin.")
     async def view_config(self, ctx: commands.Context):
         as_config = self._config.get('antiSpam', {})
@@ -8,6 +8,7 @@ from discord.ext import commands
 
 from libhusky.HuskyStatics import *
 from libhusky.antispam import AntiSpamModule
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin.AntiSpam." + __name__.split('.')[-1])
 
@@ -23,6 +24,7 @@ class EmbedFilter(AntiSpamModule):
                          checks=[super().has_permissions(mention_everyone=True)], aliases=["ef"])
 
         self.bot = plugin.bot
+        self._ban_manager = BanManager(self.bot)
         self._config = self.bot.config
 
         self.add_command(self.set_config)
@@ -63,7 +65,8 @@ class EmbedFilter(AntiSpamModule):
 
         if len(message.embeds):
             if filter_config['banOnOffense']:
-                await message.author.ban(
+                await self._ban_manager.ban(
+                    message.guild, message.author,
                     reason=f"[AUTOMATIC BAN - AntiSpam Plugin] User sent an embed without accompanying message. "
                            f"Self-bot detected/probable.",
                     delete_message_days=7 if filter_config['deleteOnOffense'] else 0)
@@ -11,6 +11,7 @@ from discord.http import Route
 
 from libhusky.HuskyStatics import *
 from libhusky.antispam import AntiSpamModule
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin.AntiSpam." + __name__.split('.')[-1])
 
@@ -27,6 +28,7 @@ class InviteFilter(AntiSpamModule):
                          checks=[super().has_permissions(manage_guild=True)], aliases=["if"])
 
         self.bot = plugin.bot
+        self._ban_manager = BanManager(self.bot)
         self._config = self.bot.config
 
         self._events = {}
@@ -162,7 +164,8 @@ class InviteFilter(AntiSpamModule):
 
             # Ban the user if necessary (performance)
             if filter_settings['banLimit'] > 0 and (record['offenseCount'] >= filter_settings['banLimit']):
-                await message.author.ban(
+                await self._ban_manager.ban(
+                    message.guild, message.author,
                     reason=f"[AUTOMATIC BAN - AntiSpam Plugin] User sent {filter_settings['banLimit']} "
                            f"unauthorized invites in a {filter_settings['minutes']} minute period.",
                     delete_message_days=0)
@@ -12,6 +12,7 @@ from discord.ext import commands
 from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
 from libhusky.antispam import AntiSpamModule
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin.AntiSpam." + __name__.split('.')[-1])
 
@@ -29,6 +30,7 @@ class LinkFilter(AntiSpamModule):
                          checks=[super().has_permissions(manage_guild=True)], aliases=["lf"])
 
         self.bot = plugin.bot
+        self._ban_manager = BanManager(self.bot)
         self._config = self.bot.config
 
         self._events = {}
@@ -145,10 +147,11 @@ class LinkFilter(AntiSpamModule):
 
             # And then ban at max
             if cooldown_record['totalLinks'] >= cooldown_config['totalBeforeBan']:
-                await message.author.ban(reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent "
-                f"{cooldown_config['totalBeforeBan']} or more links in a "
-                f"{cooldown_config['minutes']} minute period.",
-                                         delete_message_days=1)
+                await self._ban_manager.ban(
+                    message.guild, message.author,
+                    reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent {cooldown_config['totalBeforeBan']} or "
+                           f"more links in a {cooldown_config['minutes']} minute period.",
+                    delete_message_days=1)
 
                 # And purge their record, it's not needed anymore
                 del self._events[message.author.id]
@@ -196,11 +199,12 @@ class LinkFilter(AntiSpamModule):
 
             # If the user is over the ban limit, get rid of them.
             if cooldown_record['offenseCount'] >= cooldown_config['banLimit']:
-                await message.author.ban(reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent "
-                f"{cooldown_config['banLimit']} messages containing "
-                f"{cooldown_config['linkWarnLimit']} or more links in a "
-                f"{cooldown_config['minutes']} minute period.",
-                                         delete_message_days=1)
+                await self._ban_manager.ban(
+                    message.guild, message.author,
+                    reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent {cooldown_config['banLimit']} messages "
+                           f"containing {cooldown_config['linkWarnLimit']} or more links in a "
+                           f"{cooldown_config['minutes']} minute period.",
+                    delete_message_days=1)
 
                 # And purge their record, it's not needed anymore
                 del self._events[message.author.id]
@@ -9,6 +9,7 @@ from discord.ext import commands
 
 from libhusky.HuskyStatics import *
 from libhusky.antispam import AntiSpamModule
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin.AntiSpam." + __name__.split('.')[-1])
 
@@ -25,6 +26,7 @@ class MentionFilter(AntiSpamModule):
                          checks=[super().has_permissions(mention_everyone=True)], aliases=["mf"])
 
         self.bot = plugin.bot
+        self._ban_manager = BanManager(self.bot)
         self._config = self.bot.config
         self._events = {}
 
@@ -103,7 +105,8 @@ class MentionFilter(AntiSpamModule):
 
         if ping_config['hard'] is not None:
             if len(message.mentions) >= ping_config['hard']:
-                await message.author.ban(
+                await self._ban_manager.ban(
+                    message.guild, message.author,
                     delete_message_days=0,
                     reason="[AUTOMATIC BAN - AntiSpam Module] Multi-pinged over guild ban limit."
                 )
@@ -112,7 +115,8 @@ class MentionFilter(AntiSpamModule):
 
             if cooldown_record:
                 if cooldown_record['offenseCount'] >= ping_config['hard']:
-                    await message.author.ban(
+                    await self._ban_manager.ban(
+                        message.guild, message.author,
                         delete_message_days=0,
                         reason=f"[AUTOMATIC BAN - AntiSpam Module] Pinged over guild ban limit in "
                         f"{ping_config['seconds']} seconds."
@@ -11,6 +11,7 @@ from discord.ext import commands
 from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
 from libhusky.antispam import AntiSpamModule
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin.AntiSpam." + __name__.split('.')[-1])
 
@@ -29,6 +30,7 @@ class NonAsciiFilter(AntiSpamModule):
                          checks=[super().has_permissions(manage_guild=True)], aliases=["naf"])
 
         self.bot = plugin.bot
+        self._ban_manager = BanManager(self.bot)
         self._config = self.bot.config
 
         self._events = {}
@@ -143,10 +145,11 @@ class NonAsciiFilter(AntiSpamModule):
             await log_channel.send(embed=embed)
 
         if cooldown_record['offenseCount'] >= check_config['banLimit']:
-            await message.author.ban(reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent {check_config['banLimit']} "
-                                            f"messages over the non-ASCII threshold in a {check_config['minutes']} "
-                                            f"minute period.",
-                                     delete_message_days=1)
+            await self._ban_manager.ban(
+                message.guild, message.author,
+                reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent {check_config['banLimit']} messages over the "
+                       f"non-ASCII threshold in a {check_config['minutes']} minute period.",
+                delete_message_days=1)
 
             # And purge their record, it's not needed anymore
             del self._events[message.author.id]
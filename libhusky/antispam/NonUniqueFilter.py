@@ -11,6 +11,7 @@ from discord.ext import commands
 from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
 from libhusky.antispam.__init__ import AntiSpamModule
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin.AntiSpam." + __name__.split('.')[-1])
 
@@ -30,6 +31,7 @@ class NonUniqueFilter(AntiSpamModule):
 
         self.plugin = plugin
         self.bot = self.plugin.bot
+        self._ban_manager = BanManager(self.bot)
         self._config = self.bot.config
 
         self._events = {}
@@ -134,10 +136,11 @@ class NonUniqueFilter(AntiSpamModule):
             cooldown_record['wasntWarned'] = False
 
         elif total_infractions == nonunique_config['banLimit']:
-            await message.author.ban(reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent "
-                                            f"{nonunique_config['banLimit']} nonunique messages in a "
-                                            f"{nonunique_config['minutes']} minute period.",
-                                     delete_message_days=1)
+            await self._ban_manager.ban(
+                message.guild, message.author,
+                reason=f"[AUTOMATIC BAN - AntiSpam Module] User sent {nonunique_config['banLimit']} nonunique "
+                       f"messages in a {nonunique_config['minutes']} minute period.",
+                delete_message_days=1)
 
             del self._events[message.author.id]
 
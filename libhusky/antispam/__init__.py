@@ -40,6 +40,12 @@ class AntiSpamModule(commands.Group, metaclass=CogMeta):
     def clear_all(self):
         raise NotImplementedError
 
+    def unload(self):
+        """
+        Called when the module is unloaded. Modules that start their own background tasks should cancel them here.
+        """
+        pass
+
     async def base(self, ctx):
         pass
 
@@ -0,0 +1,496 @@
+import datetime
+import io
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import zipfile
+
+import aiohttp
+
+LOG = logging.getLogger("HuskyBot.API.FCCULS")
+
+FULL_DUMP_URL = "https://data.fcc.gov/download/pub/uls/complete/l_amat.zip"
+DAILY_DUMP_URL = "https://data.fcc.gov/download/pub/uls/daily/l_am_{day}.zip"
+DAILY_DUMP_DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+ULS_LICENSE_URL = "https://wireless2.fcc.gov/UlsApp/UlsSearch/license.jsp?licKey={usi}"
+
+# There's one daily file per weekday, each replaced a week later, so only the last week of days can be replayed.
+# Anything further behind than this needs a full import.
+MAX_DELTA_DAYS = 7
+
+# The creation date line in a dump's "counts" file, e.g. "File Creation Date: Sun Apr  7 04:13:58 EDT 2024".
+COUNTS_DATE_REGEX = re.compile(r"File Creation Date:\s*\w+\s+(\w+)\s+(\d+)\s+[\d:]+\s+\w+\s+(\d{4})")
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# The fields we keep from each ULS record type, as {record_type: {column_name: field_index}}. Field 1 is always the
+# unique system identifier (USI) of the license. See the FCC's "ULS Public Access Database Definitions".
+RECORD_FIELDS = {
+    "HD": {
+        "callsign": 4,
+        "status": 5,
+        "grant_date": 7,
+        "expiry_date": 8,
+        "last_action_date": 43
+    },
+    "EN": {
+        "entity_type": 5,
+        "name": 7,
+        "first_name": 8,
+        "middle_initial": 9,
+        "last_name": 10,
+        "suffix": 11,
+        "street": 15,
+        "city": 16,
+        "state": 17,
+        "zip": 18,
+        "po_box": 19,
+        "attention": 20,
+        "frn": 22,
+        "applicant_type": 23
+    },
+    "AM": {
+        "operator_class": 5,
+        "trustee_callsign": 8
+    }
+}
+
+DATE_FIELDS = {"grant_date", "expiry_date", "last_action_date"}
+
+OPERATOR_CLASSES = {
+    "E": "EXTRA",
+    "A": "ADVANCED",
+    "G": "GENERAL",
+    "P": "TECHNICIAN PLUS",
+    "T": "TECHNICIAN",
+    "N": "NOVICE"
+}
+
+# Only active licenses (and expired ones still in their grace period) are returned by lookups.
+VALID_STATUSES = ('A', 'E')
+
+LICENSE_COLUMNS = ["callsign", "status", "grant_date", "expiry_date", "last_action_date", "name", "first_name",
+                   "last_name", "street", "city", "state", "zip", "po_box", "attention", "frn", "applicant_type",
+                   "operator_class", "trustee_callsign"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS licenses (
+    usi INTEGER PRIMARY KEY,
+    callsign TEXT NOT NULL,
+    status TEXT,
+    grant_date TEXT,
+    expiry_date TEXT,
+    last_action_date TEXT,
+    name TEXT COLLATE NOCASE,
+    first_name TEXT,
+    last_name TEXT COLLATE NOCASE,
+    street TEXT,
+    city TEXT,
+    state TEXT,
+    zip TEXT,
+    po_box TEXT,
+    attention TEXT,
+    frn TEXT,
+    applicant_type TEXT,
+    operator_class TEXT,
+    trustee_callsign TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_licenses_callsign ON licenses (callsign);
+CREATE INDEX IF NOT EXISTS ix_licenses_name ON licenses (name);
+CREATE INDEX IF NOT EXISTS ix_licenses_last_name ON licenses (last_name);
+"""
+
+
+class CallsignDatabase:
+    """
+    A local, indexed copy of the FCC's amateur radio license database (ULS).
+
+    The database is a single SQLite file, built from the FCC's weekly full dump and kept current with its daily
+    transaction files. Lookups are plain indexed queries, so they're cheap enough to run directly on the event loop.
+    Imports are slow (the full dump is well over a million licenses), and should be run in an executor.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._conn = None
+
+    def is_available(self) -> bool:
+        return os.path.exists(self._path)
+
+    def reopen(self) -> None:
+        """
+        Drop the current connection, so the next lookup sees a freshly imported database file. This must be called
+        from the thread doing lookups (i.e. the event loop), not the import thread.
+        """
+        self.close()
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def lookup(self, callsign: str):
+        """
+        Look up the current license for a callsign.
+
+        :param callsign: The callsign to look up.
+        :return: Returns the license in callook.info's JSON format, or None if the database has no valid license for
+                 the callsign (or doesn't exist).
+        """
+        conn = self.__get_connection()
+        if conn is None:
+            return None
+
+        row = conn.execute(
+            f"SELECT * FROM licenses WHERE callsign = ? AND status IN {VALID_STATUSES} "
+            f"ORDER BY status = 'A' DESC, grant_date DESC LIMIT 1",
+            (callsign.upper(),)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        trustee_name = None
+        if row['trustee_callsign']:
+            trustee = conn.execute(
+                f"SELECT name FROM licenses WHERE callsign = ? AND status IN {VALID_STATUSES} "
+                f"ORDER BY grant_date DESC LIMIT 1",
+                (row['trustee_callsign'],)
+            ).fetchone()
+
+            trustee_name = trustee['name'] if trustee is not None else None
+
+        return _to_callook_data(row, trustee_name)
+
+    def search_name(self, name: str, limit: int = 10) -> list:
+        """
+        Find active licenses by name. Both the full licensee name and the last name are prefix-matched.
+
+        :param name: The (start of the) name to search for.
+        :param limit: The maximum number of results to return.
+        :return: Returns a list of (callsign, name, operator_class) tuples.
+        """
+        conn = self.__get_connection()
+        if conn is None:
+            return []
+
+        pattern = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+        rows = conn.execute(
+            "SELECT callsign, name, operator_class FROM licenses "
+            "WHERE (name LIKE ? ESCAPE '\\' OR last_name LIKE ? ESCAPE '\\') AND status = 'A' "
+            "ORDER BY name LIMIT ?",
+            (pattern, pattern, limit)
+        ).fetchall()
+
+        return [(r['callsign'], r['name'], OPERATOR_CLASSES.get(r['operator_class'])) for r in rows]
+
+    def get_meta(self, key: str, default=None):
+        conn = self.__get_connection()
+        if conn is None:
+            return default
+
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+        return row['value'] if row is not None else default
+
+    def import_full(self, dump_path: str, dump_date: datetime.date = None) -> int:
+        """
+        Build a fresh database from a full ULS dump (l_amat.zip), replacing the current one once it's complete. Lookups
+        keep using the old database until `reopen` is called.
+
+        The weekly dump can be several days old, so the database is marked as current to the day before the dump was
+        made (not to today), and `get_pending_deltas` replays the daily files from there.
+
+        :param dump_path: The path to the downloaded dump.
+        :param dump_date: The day the dump was made. Read from the dump itself if not given.
+        :return: Returns the number of licenses imported.
+        """
+        dump_date = dump_date or get_dump_date(dump_path)
+
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+
+        temp_path = self._path + ".new"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        conn = sqlite3.connect(temp_path)
+
+        try:
+            conn.executescript(SCHEMA)
+
+            # Indexes are built after loading, which is much faster than maintaining them on every insert.
+            count = _apply_dump(conn, dump_path)
+            conn.executescript(INDEXES)
+
+            conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [
+                ("fullImportDate", dump_date.isoformat()),
+                ("lastDeltaDate", (dump_date - datetime.timedelta(days=1)).isoformat())
+            ])
+            conn.commit()
+        finally:
+            conn.close()
+
+        os.replace(temp_path, self._path)
+
+        LOG.info(f"Imported {count} licenses from the full ULS dump of {dump_date}.")
+        return count
+
+    def import_delta(self, dump_path: str, dump_date: datetime.date) -> int:
+        """
+        Apply a daily ULS transaction file (l_am_<day>.zip) to the existing database.
+
+        :param dump_path: The path to the downloaded file.
+        :param dump_date: The day the file covers.
+        :return: Returns the number of licenses updated.
+        """
+        conn = sqlite3.connect(self._path)
+
+        try:
+            count = _apply_dump(conn, dump_path)
+
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                         ("lastDeltaDate", dump_date.isoformat()))
+            conn.commit()
+        finally:
+            conn.close()
+
+        LOG.info(f"Applied {count} license updates from the ULS daily file for {dump_date}.")
+        return count
+
+    def get_pending_deltas(self, today: datetime.date = None):
+        """
+        Work out which daily files need to be applied to bring the database up to date.
+
+        :return: Returns a list of dates to download daily files for, or None if a full import is needed instead.
+        """
+        today = today or datetime.date.today()
+        last_delta = self.get_meta("lastDeltaDate")
+
+        if last_delta is None:
+            return None
+
+        last_delta = datetime.date.fromisoformat(last_delta)
+
+        # The file for a day is published the following morning.
+        days = [last_delta + datetime.timedelta(days=i) for i in range(1, (today - last_delta).days)]
+
+        if len(days) > MAX_DELTA_DAYS:
+            return None
+
+        return days
+
+    def __get_connection(self):
+        if self._conn is None:
+            if not self.is_available():
+                return None
+
+            self._conn = sqlite3.connect(self._path)
+            self._conn.row_factory = sqlite3.Row
+
+        return self._conn
+
+
+async def download_dump(http_client, url: str) -> str:
+    """
+    Download a ULS dump to a temporary file.
+
+    :param http_client: A client borrowed from the bot's shared HTTP client.
+    :param url: The dump to download.
+    :return: Returns the path to the downloaded file. The caller is responsible for removing it.
+    """
+    (fd, path) = tempfile.mkstemp(suffix=".zip")
+
+    try:
+        # The full dump is large, so only stalls (not the total download time) count as a timeout.
+        async with http_client.get(url, timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as resp:
+            resp.raise_for_status()
+
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+
+    return path
+
+
+def get_dump_date(dump_path: str) -> datetime.date:
+    """
+    Work out which day a full ULS dump was made, from its "counts" file (or failing that, its file timestamps).
+
+    If neither can be read, the dump is assumed to be as old as it could be, so every daily file still published gets
+    replayed. Replaying a day the dump already covers is harmless.
+    """
+    with zipfile.ZipFile(dump_path) as archive:
+        names = set(archive.namelist())
+
+        if "counts" in names:
+            match = COUNTS_DATE_REGEX.search(archive.read("counts").decode('latin-1'))
+
+            if match is not None:
+                try:
+                    return datetime.datetime.strptime(" ".join(match.groups()), '%b %d %Y').date()
+                except ValueError:
+                    pass
+
+        if "HD.dat" in names:
+            return datetime.date(*archive.getinfo("HD.dat").date_time[:3])
+
+    LOG.warning(f"Couldn't tell when the ULS dump {dump_path} was made. Assuming it's a week old.")
+    return datetime.date.today() - datetime.timedelta(days=MAX_DELTA_DAYS)
+
+
+def _apply_dump(conn: sqlite3.Connection, dump_path: str) -> int:
+    conn.executescript("""
+        CREATE TEMP TABLE hd (usi INTEGER PRIMARY KEY, callsign, status, grant_date, expiry_date, last_action_date);
+        CREATE TEMP TABLE en (usi INTEGER PRIMARY KEY, entity_type, name, first_name, middle_initial, last_name, suffix,
+                              street, city, state, zip, po_box, attention, frn, applicant_type);
+        CREATE TEMP TABLE am (usi INTEGER PRIMARY KEY, operator_class, trustee_callsign);
+    """)
+
+    with zipfile.ZipFile(dump_path) as archive:
+        names = set(archive.namelist())
+
+        for (record_type, fields) in RECORD_FIELDS.items():
+            if f"{record_type}.dat" not in names:
+                continue
+
+            columns = ["usi"] + list(fields.keys())
+            with archive.open(f"{record_type}.dat") as raw:
+                rows = _read_records(io.TextIOWrapper(raw, encoding='latin-1', newline=''), fields)
+
+                conn.executemany(f"INSERT OR REPLACE INTO {record_type.lower()} ({', '.join(columns)}) "
+                                 f"VALUES ({', '.join('?' * len(columns))})", rows)
+
+    # A delta may not carry every record type for a license, so anything missing keeps its current value.
+    sources = {column: table.lower() for (table, fields) in RECORD_FIELDS.items() for column in fields}
+    values = [f"{sources[c]}.{c}" if sources[c] == "hd" else f"COALESCE({sources[c]}.{c}, old.{c})"
+              for c in LICENSE_COLUMNS]
+
+    conn.execute(f"""
+        INSERT OR REPLACE INTO licenses (usi, {', '.join(LICENSE_COLUMNS)})
+        SELECT hd.usi, {', '.join(values)}
+        FROM hd
+        LEFT JOIN en ON en.usi = hd.usi
+        LEFT JOIN am ON am.usi = hd.usi
+        LEFT JOIN licenses old ON old.usi = hd.usi
+    """)
+
+    count = conn.execute("SELECT COUNT(*) FROM hd").fetchone()[0]
+    conn.executescript("DROP TABLE temp.hd; DROP TABLE temp.en; DROP TABLE temp.am;")
+
+    return count
+
+
+def _read_records(lines, fields: dict):
+    """
+    Parse a pipe-delimited ULS .dat file, yielding (usi, *fields) rows.
+
+    A few ULS records contain raw line breaks inside a field, so short lines are joined with the next one.
+    """
+    min_fields = max(fields.values()) + 1
+    pending = ""
+
+    for line in lines:
+        line = pending + line.rstrip('\r\n')
+        parts = line.split('|')
+
+        if len(parts) < min_fields:
+            pending = line + " "
+            continue
+
+        pending = ""
+
+        # Only the licensee's own entity record matters (not contacts, etc).
+        if parts[0] == "EN" and parts[fields["entity_type"]] != "L":
+            continue
+
+        record = {}
+        for (name, index) in fields.items():
+            value = parts[index].strip() or None
+
+            if value is not None and name in DATE_FIELDS:
+                value = _parse_date(value)
+
+            record[name] = value
+
+        if parts[0] == "EN" and record["name"] is None:
+            record["name"] = " ".join(filter(None, [record["first_name"], record["middle_initial"],
+                                                    record["last_name"], record["suffix"]])) or None
+
+        yield [int(parts[1])] + list(record.values())
+
+
+def _parse_date(value: str):
+    try:
+        return datetime.datetime.strptime(value, '%m/%d/%Y').date().isoformat()
+    except ValueError:
+        return None
+
+
+def _format_date(value: str):
+    if value is None:
+        return None
+
+    return datetime.date.fromisoformat(value).strftime('%m/%d/%Y')
+
+
+def _to_callook_data(row: sqlite3.Row, trustee_name: str = None) -> dict:
+    # Lookups are returned in the same shape as callook.info's API, so either source can be displayed the same way.
+    address_line2 = " ".join(filter(None, [f"{row['city']}," if row['city'] else None, row['state'], row['zip']]))
+    other_info = {
+        "frn": row['frn'],
+        "ulsUrl": ULS_LICENSE_URL.format(usi=row['usi'])
+    }
+
+    for (key, column) in [("grantDate", 'grant_date'), ("expiryDate", 'expiry_date'),
+                          ("lastActionDate", 'last_action_date')]:
+        if row[column] is not None:
+            other_info[key] = _format_date(row[column])
+
+    return {
+        "status": "VALID",
+        "type": "PERSON" if row['applicant_type'] in (None, 'I') else "CLUB",
+        "current": {
+            "callsign": row['callsign'],
+            "operClass": OPERATOR_CLASSES.get(row['operator_class'], "")
+        },
+        "trustee": {
+            "callsign": row['trustee_callsign'] or "",
+            "name": trustee_name or ""
+        },
+        "name": row['name'],
+        "address": {
+            "line1": row['street'] or (f"PO BOX {row['po_box']}" if row['po_box'] else None),
+            "line2": address_line2 or None,
+            "attn": row['attention']
+        },
+        "location": {},
+        "otherInfo": other_info
+    }
+
+
+if __name__ == '__main__':
+    # Import a locally downloaded dump: python -m libhusky.apis.FCCULS <database> <l_amat.zip | l_am_day.zip> [date]
+    logging.basicConfig(level=logging.INFO)
+
+    database = CallsignDatabase(sys.argv[1])
+
+    if len(sys.argv) > 3:
+        database.import_delta(sys.argv[2], datetime.date.fromisoformat(sys.argv[3]))
+    else:
+        database.import_full(sys.argv[2])
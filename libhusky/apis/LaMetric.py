@@ -1,25 +1,27 @@
-import aiohttp
-
 APP_BASE = "https://developer.lametric.com/api/v1/dev/widget/update/com.lametric.{app_id}"
 
 
 class LaMetricApi:
-    def __init__(self, loop):
-        self.__async_loop__ = loop
-
-        self._http_client = aiohttp.ClientSession(loop=loop)
-
-    def cleanup(self):
-        self.__async_loop__.create_task(self._http_client.close())
-
-    async def push(self, app_id: str, data: dict, access_token: str):
+    def __init__(self, http_client):
+        """
+        :param http_client: A client borrowed from the bot's shared HTTP client (see HuskyHTTPClient).
+        """
+        self._http_client = http_client
+
+    async def push(self, app_id: str, data: dict, access_token: str) -> int:
+        """
+        Push new frames to a LaMetric app.
+
+        :return: Returns the HTTP status code of the push.
+        """
         headers = {
             "Accept": "application/json",
             "X-Access-Token": access_token,
             "Cache-Control": "no-cache"
         }
 
-        return await self._http_client.post(APP_BASE.format(app_id=app_id), json=data, headers=headers)
+        async with self._http_client.post(APP_BASE.format(app_id=app_id), json=data, headers=headers) as resp:
+            return resp.status
 
 
 def build_data(icon: str, text: str) -> dict:
@@ -0,0 +1,380 @@
+import array
+import asyncio
+import datetime
+import json
+import logging
+import os
+import threading
+
+import discord
+
+from HuskyBot import HuskyBot
+from libhusky import HuskyScheduler, HuskyUtils
+
+SCHEDULER_OWNER = "ActivityManager"
+LOG = logging.getLogger("HuskyBot.Managers.ActivityManager")
+
+STORE_VERSION = 1
+
+# How often (in seconds) the index is written to disk (and compacted).
+FLUSH_INTERVAL = 60 * 5
+
+# Per-minute channel counts are rolled up to hours after MINUTE_RETENTION, and hours to days after HOUR_RETENTION.
+MINUTE_RETENTION = datetime.timedelta(days=2)
+HOUR_RETENTION = datetime.timedelta(days=60)
+
+# Per-user counts are only kept for this long. Older active user queries fall back to history scans.
+USER_RETENTION = datetime.timedelta(days=90)
+
+# After downtime, missed messages are read back from history if the gap is shorter than this. Otherwise, the index
+# starts over from the current session.
+BACKFILL_LIMIT = datetime.timedelta(hours=12)
+BACKFILL_CONCURRENCY = 4
+
+# The tables (and their columns) in the on-disk store. Every column is stored as one flat array.
+CHANNEL_TABLES = {"channel_minutes": 60, "channel_hours": 60 * 60, "channel_days": 60 * 60 * 24}
+USER_TABLE = "user_days"
+COLUMN_TYPES = {"channel_id": 'q', "user_id": 'q', "bucket": 'q', "count": 'I'}
+
+
+def _to_timestamp(when: datetime.datetime) -> float:
+    return when.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class ActivityManager(metaclass=HuskyUtils.Singleton):
+    """
+    The Activity Manager keeps a running index of guild message activity, fed from on_message, so that message and
+    active user counts don't need to re-read channel history.
+
+    Channel activity is counted per minute, and rolled up into hours and then days as it ages. User activity is counted
+    per user, per channel, per day. The index is kept in memory and periodically written to disk as flat, column-wise
+    arrays.
+
+    The index only knows about messages sent while it was running (or that it could backfill after a short downtime).
+    Queries for anything older return None, and callers should fall back to reading history - but only as far back as
+    get_covered_since, as the index can answer for the rest.
+    """
+
+    def __init__(self, bot: HuskyBot):
+        """
+        Initialize the (shared) ActivityManager for the bot.
+        :param bot: The Bot we use to initialize everything.
+        """
+
+        self.bot = bot
+        self._scheduler = HuskyScheduler.get_scheduler()
+
+        config_prefix = os.environ.get('HUSKYBOT_CONFIG_PREFIX', '')
+        if config_prefix:
+            config_prefix += "_"
+
+        self._path = f'config/{config_prefix}activity.bin'
+        self._write_lock = threading.Lock()
+
+        # Channel counts as {table: {channel_id: {bucket: count}}}, where a bucket is a UTC timestamp divided by the
+        # table's resolution. User counts as {day: {(channel_id, user_id): count}}.
+        self.__channels__ = {table: {} for table in CHANNEL_TABLES}
+        self.__users__ = {}
+
+        # The index is complete from covered_since onward (once any backfill is done).
+        self._covered_since = None
+        self._session_start = datetime.datetime.utcnow()
+        self._ready = False
+
+        indexed_until = self.__load()
+        self.__backfill_task__ = None
+
+        if indexed_until is not None and self._session_start - indexed_until <= BACKFILL_LIMIT:
+            self.__backfill_task__ = self.bot.loop.create_task(self.__backfill(indexed_until))
+        else:
+            if indexed_until is not None:
+                LOG.warning(f"Activity index was last written at {indexed_until}, which is too long ago to backfill. "
+                            f"Starting over from now.")
+
+            self.__reset(self._session_start)
+            self._ready = True
+
+        self.bot.add_listener(self.__on_message, 'on_message')
+        self.__schedule_flush()
+
+        LOG.info(f"Manager load complete. Activity is indexed since {self._covered_since}.")
+
+    def get_message_count(self, channel_ids, since: datetime.datetime):
+        """
+        Count the messages sent in a set of channels since a point in time.
+
+        Rolled-up buckets are counted if any part of them falls in the range, so older ranges may slightly overcount.
+
+        :param channel_ids: The IDs of the channels to count messages in.
+        :param since: The (naive, UTC) start of the range.
+        :return: Returns the approximate message count, or None if the index doesn't cover the range (in which case,
+                 only the messages before get_covered_since need to be counted some other way).
+        """
+        if not self.covers(since):
+            return None
+
+        since = _to_timestamp(since)
+        total = 0
+
+        for (table, resolution) in CHANNEL_TABLES.items():
+            first_bucket = int(since // resolution)
+
+            for channel_id in channel_ids:
+                buckets = self.__channels__[table].get(channel_id)
+
+                if not buckets:
+                    continue
+
+                total += sum(count for (bucket, count) in buckets.items() if bucket >= first_bucket)
+
+        return total
+
+    def get_user_message_counts(self, channel_ids, since: datetime.datetime):
+        """
+        Count the messages each (non-bot) user sent in a set of channels since a point in time.
+
+        User counts are only kept per day, so the range is widened to start at midnight (UTC) of `since`.
+
+        :param channel_ids: The IDs of the channels to count messages in.
+        :param since: The (naive, UTC) start of the range.
+        :return: Returns a tuple of ({user_id: count}, actual range start), or None if the index doesn't cover it.
+        """
+        since = since.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        if not self.covers(since) or since < self._session_start - USER_RETENTION:
+            return None
+
+        channel_ids = set(channel_ids)
+        first_day = int(_to_timestamp(since) // CHANNEL_TABLES["channel_days"])
+        user_counts = {}
+
+        for (day, counts) in self.__users__.items():
+            if day < first_day:
+                continue
+
+            for ((channel_id, user_id), count) in counts.items():
+                if channel_id in channel_ids:
+                    user_counts[user_id] = user_counts.get(user_id, 0) + count
+
+        return user_counts, since
+
+    def covers(self, since: datetime.datetime) -> bool:
+        return self._ready and self._covered_since is not None and since >= self._covered_since
+
+    def get_covered_since(self):
+        """
+        :return: Returns the (naive, UTC) time the index is complete from, or None if it can't be used yet.
+        """
+        return self._covered_since if self._ready else None
+
+    def record(self, channel_id: int, user_id, created_at: datetime.datetime) -> None:
+        """
+        Count a single message.
+
+        :param channel_id: The channel the message was sent in.
+        :param user_id: The author of the message, or None if the author shouldn't count as an active user (bots).
+        :param created_at: The (naive, UTC) time the message was sent.
+        """
+        timestamp = _to_timestamp(created_at)
+        minute = int(timestamp // CHANNEL_TABLES["channel_minutes"])
+
+        buckets = self.__channels__["channel_minutes"].setdefault(channel_id, {})
+        buckets[minute] = buckets.get(minute, 0) + 1
+
+        if user_id is not None:
+            day = int(timestamp // CHANNEL_TABLES["channel_days"])
+            counts = self.__users__.setdefault(day, {})
+            counts[(channel_id, user_id)] = counts.get((channel_id, user_id), 0) + 1
+
+    def compact(self) -> None:
+        """
+        Roll aged channel counts up into coarser tables, and drop expired user counts.
+        """
+        now = _to_timestamp(datetime.datetime.utcnow())
+
+        self.__roll_up("channel_minutes", "channel_hours", now - MINUTE_RETENTION.total_seconds())
+        self.__roll_up("channel_hours", "channel_days", now - HOUR_RETENTION.total_seconds())
+
+        first_day = int((now - USER_RETENTION.total_seconds()) // CHANNEL_TABLES["channel_days"])
+        for day in [d for d in self.__users__ if d < first_day]:
+            del self.__users__[day]
+
+    def flush(self) -> None:
+        """
+        Write the index to disk, blocking until it's written. The index is only written while it's complete, so a crash
+        during a backfill will just redo the backfill next time.
+        """
+        snapshot = self.__snapshot()
+
+        if snapshot is not None:
+            self.__write(*snapshot)
+
+    async def flush_in_background(self) -> None:
+        """
+        Write the index to disk without blocking the event loop. Only the snapshot of the index is taken on the loop,
+        and building the columns and writing them out runs in an executor.
+        """
+        snapshot = self.__snapshot()
+
+        if snapshot is not None:
+            await self.bot.loop.run_in_executor(None, self.__write, *snapshot)
+
+    def __snapshot(self):
+        """
+        Compact the index, and copy out its rows as they are right now.
+
+        :return: Returns a tuple of (covered since, indexed until, {table: rows}), or None if the index shouldn't be
+                 written.
+        """
+        if not self._ready:
+            return None
+
+        self.compact()
+
+        rows = {}
+
+        for table in CHANNEL_TABLES:
+            rows[table] = [(c, b, n) for (c, buckets) in self.__channels__[table].items() for (b, n) in buckets.items()]
+
+        rows[USER_TABLE] = [(c, u, d, n) for (d, counts) in self.__users__.items() for ((c, u), n) in counts.items()]
+
+        return self._covered_since, datetime.datetime.utcnow(), rows
+
+    def __write(self, covered_since: datetime.datetime, indexed_until: datetime.datetime, rows: dict) -> None:
+        tables = {table: self.__to_columns(rows[table], ("channel_id", "bucket", "count")) for table in CHANNEL_TABLES}
+        tables[USER_TABLE] = self.__to_columns(rows[USER_TABLE], ("channel_id", "user_id", "bucket", "count"))
+
+        header = {
+            "version": STORE_VERSION,
+            "coveredSince": _to_timestamp(covered_since),
+            "indexedUntil": _to_timestamp(indexed_until),
+            "tables": {t: [[name, len(column)] for (name, column) in columns] for (t, columns) in tables.items()}
+        }
+
+        # A background write and the final write on unload may overlap, and both use the same temporary file.
+        with self._write_lock:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            temp_path = self._path + ".tmp"
+
+            with open(temp_path, 'wb') as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+
+                for columns in tables.values():
+                    for (_, column) in columns:
+                        column.tofile(f)
+
+            # Replace the old index in one step, so it's never half-written.
+            os.replace(temp_path, self._path)
+
+    @staticmethod
+    def __to_columns(rows: list, names: tuple) -> list:
+        return [(name, array.array(COLUMN_TYPES[name], (row[i] for row in rows))) for (i, name) in enumerate(names)]
+
+    def __load(self):
+        """
+        Load the index from disk.
+
+        :return: Returns the (naive, UTC) time the index was last written, or None if there is no usable index.
+        """
+        try:
+            with open(self._path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+
+                if header.get('version') != STORE_VERSION:
+                    LOG.warning("Activity index is from an unknown version, ignoring it.")
+                    return None
+
+                tables = {}
+                for (table, columns) in header['tables'].items():
+                    tables[table] = {}
+
+                    for (name, length) in columns:
+                        column = array.array(COLUMN_TYPES[name])
+                        column.fromfile(f, length)
+                        tables[table][name] = column
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, EOFError):
+            LOG.exception("Activity index is corrupt, ignoring it.")
+            return None
+
+        for table in CHANNEL_TABLES:
+            columns = tables.get(table, {})
+
+            for (c, b, n) in zip(columns.get("channel_id", []), columns.get("bucket", []), columns.get("count", [])):
+                self.__channels__[table].setdefault(c, {})[b] = n
+
+        columns = tables.get(USER_TABLE, {})
+        for (c, u, d, n) in zip(columns.get("channel_id", []), columns.get("user_id", []), columns.get("bucket", []),
+                                columns.get("count", [])):
+            self.__users__.setdefault(d, {})[(c, u)] = n
+
+        self._covered_since = datetime.datetime.utcfromtimestamp(header['coveredSince'])
+
+        return datetime.datetime.utcfromtimestamp(header['indexedUntil'])
+
+    def __reset(self, covered_since: datetime.datetime) -> None:
+        self.__channels__ = {table: {} for table in CHANNEL_TABLES}
+        self.__users__ = {}
+        self._covered_since = covered_since
+
+    def __roll_up(self, source: str, target: str, cutoff: float) -> None:
+        source_resolution = CHANNEL_TABLES[source]
+        target_resolution = CHANNEL_TABLES[target]
+        cutoff_bucket = int(cutoff // source_resolution)
+
+        for (channel_id, buckets) in self.__channels__[source].items():
+            aged = [b for b in buckets if b < cutoff_bucket]
+
+            if not aged:
+                continue
+
+            target_buckets = self.__channels__[target].setdefault(channel_id, {})
+
+            for bucket in aged:
+                target_bucket = (bucket * source_resolution) // target_resolution
+                target_buckets[target_bucket] = target_buckets.get(target_bucket, 0) + buckets.pop(bucket)
+
+    def __schedule_flush(self):
+        async def flush():
+            try:
+                await self.flush_in_background()
+            finally:
+                self.__schedule_flush()
+
+        self._scheduler.schedule(SCHEDULER_OWNER, "flush", HuskyScheduler.get_current_time() + FLUSH_INTERVAL, flush)
+
+    async def __backfill(self, indexed_until: datetime.datetime):
+        """
+        Read back the messages sent while the bot was offline, so the index stays continuous across restarts.
+        """
+        await self.bot.wait_until_ready()
+
+        semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+        channels = [c for g in self.bot.guilds for c in g.text_channels if c.permissions_for(g.me).read_message_history]
+
+        async def backfill_channel(channel: discord.TextChannel):
+            async with semaphore:
+                history = HuskyUtils.iter_history_slices(channel, after=indexed_until, before=self._session_start,
+                                                         slices=1)
+
+                async for message in history:  # type: discord.Message
+                    self.record(channel.id, None if message.author.bot else message.author.id, message.created_at)
+
+        LOG.info(f"Backfilling activity index from {indexed_until} across {len(channels)} channels.")
+
+        results = await asyncio.gather(*[backfill_channel(c) for c in channels], return_exceptions=True)
+
+        for (channel, result) in zip(channels, results):
+            if isinstance(result, Exception):
+                LOG.warning(f"Couldn't backfill activity for channel {channel}: {result}")
+
+        self._ready = True
+        self.__backfill_task__ = None
+        LOG.info("Activity index backfill complete.")
+
+    async def __on_message(self, message: discord.Message):
+        if message.guild is None:
+            return
+
+        self.record(message.channel.id, None if message.author.bot else message.author.id, message.created_at)
@@ -0,0 +1,246 @@
+import asyncio
+import logging
+
+import discord
+
+from HuskyBot import HuskyBot
+from libhusky import HuskyUtils
+
+LOG = logging.getLogger("HuskyBot.Managers.BanManager")
+
+# How long (in seconds) the entry for a ban that just happened is kept outside the index, so the on_member_ban
+# listeners (which run in no set order) can all share it.
+RECENT_BAN_TTL = 60
+
+
+class BanManager(metaclass=HuskyUtils.Singleton):
+    """
+    The Ban Manager keeps a live index of every guild's bans, so that checking a ban (or reading its reason) doesn't
+    require downloading the entire ban list from Discord.
+
+    The index for a guild is loaded once (lazily, on first use) and is then kept current from `on_member_ban` and
+    `on_member_unban`. Until the index is ready, lookups fall back to a targeted per-user ban fetch.
+
+    Bans made through `ban` are known (with their reason) before Discord even sends the gateway event, so they never
+    need a fetch. Other bans are fetched at most once per event, shared between every listener that asks for it.
+    """
+
+    def __init__(self, bot: HuskyBot):
+        """
+        Initialize the (shared) BanManager for the bot.
+        :param bot: The Bot we use to initialize everything.
+        """
+
+        self.bot = bot
+
+        # Bans are indexed as {guild_id: {user_id: discord.guild.BanEntry}}. A guild only has an index once it's fully
+        # loaded, so a missing user in an existing index means the user is not banned.
+        self.__bans__ = {}
+
+        # Index loads in progress, and any ban changes seen while they were running.
+        self.__load_tasks__ = {}
+        self.__pending_changes__ = {}
+
+        # Ban entries for bans that just happened (or are happening), as futures by (guild_id, user_id).
+        self.__recent_bans__ = {}
+
+        self.bot.add_listener(self.__on_member_ban, 'on_member_ban')
+        self.bot.add_listener(self.__on_member_unban, 'on_member_unban')
+
+        LOG.info("Manager load complete.")
+
+    def is_loaded(self, guild: discord.Guild) -> bool:
+        return guild.id in self.__bans__
+
+    def get_ban_count(self, guild: discord.Guild):
+        """
+        Get the number of bans in a guild, or None if the guild's index isn't loaded yet.
+        """
+        index = self.__bans__.get(guild.id)
+
+        return len(index) if index is not None else None
+
+    async def get_ban(self, guild: discord.Guild, user: discord.abc.Snowflake, trust_index: bool = True):
+        """
+        Get the ban entry for a specific user.
+
+        :param guild: The guild to check.
+        :param user: The user (or any object with an ID) to look up.
+        :param trust_index: If False, a miss in the index is confirmed with Discord. Use this when the ban may have
+                            only just happened (e.g. while handling on_member_ban), as listeners run in no set order.
+        :return: Returns the BanEntry for the user, or None if the user is not banned.
+        """
+        recent = self.__recent_bans__.get((guild.id, user.id))
+
+        if recent is not None:
+            return await asyncio.shield(recent)
+
+        index = self.__bans__.get(guild.id)
+
+        if index is None:
+            self.__ensure_loading(guild)
+        else:
+            entry = index.get(user.id)
+
+            if entry is not None or trust_index:
+                return entry
+
+        if not trust_index:
+            # Share the lookup with the on_member_ban listener (or whoever else is handling the same event).
+            return await asyncio.shield(self.__fetch_recent_ban(guild, user))
+
+        try:
+            entry = await guild.fetch_ban(user)
+        except discord.NotFound:
+            return None
+
+        self.__record(guild.id, user.id, entry)
+        return entry
+
+    async def is_banned(self, guild: discord.Guild, user: discord.abc.Snowflake) -> bool:
+        return (await self.get_ban(guild, user)) is not None
+
+    async def ban(self, guild: discord.Guild, user: discord.abc.Snowflake, reason: str = None,
+                  delete_message_days: int = 1) -> None:
+        """
+        Ban a user through the bot. The ban (and its reason) is recorded before Discord is asked to ban the user, so the
+        resulting on_member_ban event never needs to fetch it.
+
+        :param guild: The guild to ban the user from.
+        :param user: The user (or any object with an ID, for hackbans) to ban.
+        :param reason: The ban reason, for the audit log and the ban list.
+        :param delete_message_days: How many days of the user's messages to delete.
+        """
+        key = (guild.id, user.id)
+
+        recent = self.bot.loop.create_future()
+        recent.set_result(discord.guild.BanEntry(reason=reason, user=user))
+        self.__remember_recent_ban(key, recent)
+
+        try:
+            await guild.ban(user, reason=reason, delete_message_days=delete_message_days)
+        except Exception:
+            if self.__recent_bans__.get(key) is recent:
+                del self.__recent_bans__[key]
+
+            raise
+
+        self.__record(guild.id, user.id, recent.result())
+
+    def record_unban(self, guild: discord.Guild, user: discord.abc.Snowflake) -> None:
+        self.__recent_bans__.pop((guild.id, user.id), None)
+        self.__record(guild.id, user.id, None)
+
+    async def load_guild(self, guild: discord.Guild) -> None:
+        """
+        Load (or reload) the ban index for a guild. Concurrent calls share a single load.
+        """
+        task = self.__load_tasks__.get(guild.id)
+
+        if task is None:
+            task = self.__ensure_loading(guild, force=True)
+
+        await asyncio.shield(task)
+
+    def __ensure_loading(self, guild: discord.Guild, force: bool = False):
+        task = self.__load_tasks__.get(guild.id)
+
+        if task is not None or (guild.id in self.__bans__ and not force):
+            return task
+
+        task = self.bot.loop.create_task(self.__load(guild))
+        self.__load_tasks__[guild.id] = task
+        return task
+
+    async def __load(self, guild: discord.Guild) -> None:
+        pending = self.__pending_changes__.setdefault(guild.id, {})
+
+        try:
+            # discord.py returns the whole ban list in one call. This is the only time we do that.
+            bans = await guild.bans()
+        except discord.HTTPException:
+            LOG.exception(f"Could not load the ban list for guild {guild.id}. Falling back to per-user lookups.")
+            return
+        finally:
+            self.__load_tasks__.pop(guild.id, None)
+            self.__pending_changes__.pop(guild.id, None)
+
+        index = {entry.user.id: entry for entry in bans}
+
+        # Anything that happened while the list was downloading is newer than the list itself.
+        for (user_id, entry) in pending.items():
+            if entry is None:
+                index.pop(user_id, None)
+            else:
+                index[user_id] = entry
+
+        self.__bans__[guild.id] = index
+        LOG.info(f"Loaded {len(index)} bans for guild {guild.id}.")
+
+    def __record(self, guild_id: int, user_id: int, entry) -> None:
+        pending = self.__pending_changes__.get(guild_id)
+        if pending is not None:
+            pending[user_id] = entry
+
+        index = self.__bans__.get(guild_id)
+        if index is None:
+            return
+
+        if entry is None:
+            index.pop(user_id, None)
+        else:
+            index[user_id] = entry
+
+    def __remember_recent_ban(self, key: tuple, recent: asyncio.Future) -> None:
+        self.__recent_bans__[key] = recent
+
+        def forget():
+            if self.__recent_bans__.get(key) is recent:
+                del self.__recent_bans__[key]
+
+        self.bot.loop.call_later(RECENT_BAN_TTL, forget)
+
+    def __fetch_recent_ban(self, guild: discord.Guild, user: discord.abc.Snowflake) -> asyncio.Future:
+        """
+        Get the (shared) lookup of a ban that just happened, starting it if nobody has yet.
+        """
+        key = (guild.id, user.id)
+        recent = self.__recent_bans__.get(key)
+
+        if recent is not None:
+            return recent
+
+        async def fetch():
+            try:
+                return await guild.fetch_ban(user)
+            except discord.NotFound:
+                # Already unbanned again.
+                return None
+
+        recent = self.bot.loop.create_task(fetch())
+        self.__remember_recent_ban(key, recent)
+
+        return recent
+
+    async def __on_member_ban(self, guild: discord.Guild, user: discord.User):
+        index = self.__bans__.get(guild.id)
+
+        # Bans made through the bot (or already fetched by another listener) are known without asking Discord.
+        if (guild.id, user.id) not in self.__recent_bans__ and index is not None and user.id in index:
+            return
+
+        # The gateway event doesn't carry the ban reason, so (unless we know it already) fetch just this one ban.
+        entry = await asyncio.shield(self.__fetch_recent_ban(guild, user))
+
+        if entry is None:
+            return
+
+        # Hackbans are made with a bare ID, but the event has the full user.
+        if not isinstance(entry.user, discord.abc.User):
+            entry = discord.guild.BanEntry(reason=entry.reason, user=user)
+
+        self.__record(guild.id, user.id, entry)
+
+    async def __on_member_unban(self, guild: discord.Guild, user: discord.User):
+        self.__recent_bans__.pop((guild.id, user.id), None)
+        self.__record(guild.id, user.id, None)
@@ -1,4 +1,4 @@
-import asyncio
+import collections.abc
 import datetime
 import logging
 import random
@@ -7,10 +7,17 @@ import discord
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
-from libhusky import HuskyConfig, HuskyData, HuskyUtils
+from libhusky import HuskyConfig, HuskyData, HuskyDatabase, HuskyScheduler, HuskyUtils
 from libhusky.HuskyStatics import *
+from libhusky.managers.JobManager import JobManager
 
 GIVEAWAY_CONFIG_KEY = 'giveaways'
+ENTRANTS_CONFIG_KEY = 'entrants'
+SCHEDULER_OWNER = "GiveawayManager"
+GIVEAWAY_FINISH_JOB = "giveaway.finish"
+
+# How long (in seconds) entrant changes may sit in memory before being flushed to storage.
+ENTRANT_FLUSH_DELAY = 30
 LOG = logging.getLogger("HuskyBot.Managers.GiveawayManager")
 
 
@@ -19,7 +26,7 @@ class GiveawayManager:
     The Giveaway Manager is a centralized management location for Giveaways (see the Giveaway plugin).
 
     Because Giveaways need to be persistent between sessions/bot executions, this class exists. Similarly, the
-    scheduler needs some registered class.
+    JobManager needs some registered class to call back into when a giveaway ends.
     """
 
     def __init__(self, bot: HuskyBot):
@@ -38,10 +45,30 @@ class GiveawayManager:
         # We store all giveaways in a time-ordered cache list. Reading and working with the file directly is
         # *generally* a bad idea.
         self.__cache__ = []
+        self._scheduler = HuskyScheduler.get_scheduler()
+        self._jobs = JobManager(bot)
+
+        # Entrants are tracked live from reaction events as {message_id: set(user_id)}, so ending a giveaway doesn't
+        # need to page through the reaction list. While a giveaway is being reconciled against Discord, incoming events
+        # are also logged in __reconciling__ so they can be replayed on top of the fetched list.
+        self.__entrants__ = {}
+        self.__reconciling__ = {}
+
+        # Entrant changes not yet written to the database, as {message_id: {user_id: entered}}. Reactions can come in
+        # very quickly, so these are written as one batch per flush window rather than one commit per reaction.
+        self.__pending_entrants__ = {}
+
+        # Giveaways are stored in the database (one row per giveaway) if enabled, falling back to giveaways.json.
+        self._db_store = None
+        if HuskyDatabase.is_enabled(bot):
+            self._db_store = HuskyDatabase.GiveawayStore(bot.session_factory)
+            self.load_giveaways_from_database()
+        else:
+            self.load_giveaways_from_file()
 
-        self.load_giveaways_from_file()
+        self._jobs.register_handler(GIVEAWAY_FINISH_JOB, self.__finish_giveaway_job)
 
-        self.__task__ = self.bot.loop.create_task(self.process_giveaways())
+        self.__reconcile_task__ = self.bot.loop.create_task(self.reconcile_entrants())
 
         LOG.info("Manager load complete.")
 
@@ -56,31 +83,242 @@ class GiveawayManager:
             giveaway = HuskyData.GiveawayObject(data=giveaway_raw)
 
             self.__cache__.append(giveaway)
+            self.schedule_giveaway(giveaway)
+
+        active_ids = {g.register_message_id for g in self.__cache__}
+
+        for message_id, user_ids in self._giveaway_config.get(ENTRANTS_CONFIG_KEY, {}).items():
+            if int(message_id) in active_ids:
+                self.__entrants__[int(message_id)] = set(user_ids)
+
+    def load_giveaways_from_database(self) -> None:
+        """
+        Initialize the giveaways cache from the database, importing giveaways.json first if it hasn't been yet.
+        :return: Doesn't return.
+        """
+        self._db_store.import_from_json()
+
+        for giveaway in self._db_store.load_all():
+            self.__cache__.append(giveaway)
+            self.schedule_giveaway(giveaway)
+
+        self.__entrants__ = self._db_store.load_entrants()
+
+    def schedule_giveaway(self, giveaway: HuskyData.GiveawayObject) -> None:
+        """
+        Register a giveaway's end time with the JobManager.
+
+        The JobManager will call back into `finish_giveaway` once the giveaway's end time has passed. Giveaways without
+        an end time (usually impossible) are never scheduled.
+
+        :param giveaway: The giveaway to schedule.
+        :return: Doesn't return.
+        """
+
+        if giveaway.end_time is None:
+            return
+
+        self._jobs.schedule(GIVEAWAY_FINISH_JOB, self.__get_job_key(giveaway), giveaway.end_time,
+                            {"message_id": giveaway.register_message_id})
+
+    @staticmethod
+    def __get_job_key(giveaway: HuskyData.GiveawayObject) -> str:
+        return f"{GIVEAWAY_FINISH_JOB}:{giveaway.register_message_id}"
+
+    async def __finish_giveaway_job(self, job: HuskyData.ScheduledJob) -> None:
+        giveaway = discord.utils.get(self.__cache__, register_message_id=job.payload['message_id'])
+
+        # The giveaway was already ended or killed, so there's nothing to do.
+        if giveaway is None:
+            return
+
+        LOG.info(f"Found a scheduled giveaway for {giveaway.name} ending. Triggering...")
+        await self.finish_giveaway(giveaway)
+
+    def __remove_from_cache(self, giveaway: HuskyData.GiveawayObject) -> None:
+        self._jobs.cancel(self.__get_job_key(giveaway))
+
+        if giveaway in self.__cache__:
+            self.__cache__.remove(giveaway)
+
+        self.__entrants__.pop(giveaway.register_message_id, None)
+
+        if self._db_store is not None:
+            self.__pending_entrants__.pop(giveaway.register_message_id, None)
+            self._db_store.delete(giveaway)
+        else:
+            self._giveaway_config.set(GIVEAWAY_CONFIG_KEY, self.__cache__)
+            self.__flush_entrants()
+
+    def __flush_entrants(self) -> None:
+        self._scheduler.cancel(SCHEDULER_OWNER, ENTRANTS_CONFIG_KEY)
+
+        if self._db_store is not None:
+            if self.__pending_entrants__:
+                self._db_store.apply_entrant_changes(self.__pending_entrants__)
+                self.__pending_entrants__ = {}
+
+            return
+
+        self._giveaway_config.set(ENTRANTS_CONFIG_KEY, {
+            str(message_id): list(user_ids) for (message_id, user_ids) in self.__entrants__.items()
+        })
+
+    def __schedule_entrant_flush(self) -> None:
+        # Entrant changes can come in very quickly, so storage only gets written once per flush window.
+        if self._scheduler.is_scheduled(SCHEDULER_OWNER, ENTRANTS_CONFIG_KEY):
+            return
+
+        async def flush():
+            self.__flush_entrants()
+
+        self._scheduler.schedule(SCHEDULER_OWNER, ENTRANTS_CONFIG_KEY,
+                                 HuskyScheduler.get_current_time() + ENTRANT_FLUSH_DELAY, flush)
+
+    def is_giveaway_message(self, message_id: int) -> bool:
+        return message_id in self.__entrants__
+
+    def get_entrant_count(self, giveaway: HuskyData.GiveawayObject):
+        """
+        Get the number of users currently entered into a giveaway.
+
+        :param giveaway: The giveaway to check.
+        :return: Returns the live entrant count, or None if entrants aren't (yet) tracked for this giveaway.
+        """
+        entrants = self.__entrants__.get(giveaway.register_message_id)
+
+        if entrants is None:
+            return None
+
+        return len(entrants)
+
+    def add_entrant(self, message_id: int, user_id: int) -> None:
+        """
+        Record a user as entered into a giveaway. Called from raw reaction events.
+
+        :param message_id: The giveaway's registration message ID.
+        :param user_id: The user ID that entered.
+        """
+        entrants = self.__entrants__.get(message_id)
+
+        if entrants is None or user_id == self.bot.user.id:
+            return
+
+        # While reconciling, the tracked list is only a placeholder (or stale), so every event is logged for replay
+        # before checking it.
+        if message_id in self.__reconciling__:
+            self.__reconciling__[message_id].append((True, user_id))
+
+        if user_id in entrants:
+            return
+
+        entrants.add(user_id)
+
+        if self._db_store is not None:
+            self.__pending_entrants__.setdefault(message_id, {})[user_id] = True
+
+        self.__schedule_entrant_flush()
+
+    def remove_entrant(self, message_id: int, user_id: int) -> None:
+        """
+        Remove a user from a giveaway. Called from raw reaction events.
+
+        :param message_id: The giveaway's registration message ID.
+        :param user_id: The user ID that left.
+        """
+        entrants = self.__entrants__.get(message_id)
 
-    async def process_giveaways(self) -> None:
+        if entrants is None:
+            return
+
+        if message_id in self.__reconciling__:
+            self.__reconciling__[message_id].append((False, user_id))
+
+        if user_id not in entrants:
+            return
+
+        entrants.discard(user_id)
+
+        if self._db_store is not None:
+            self.__pending_entrants__.setdefault(message_id, {})[user_id] = False
+
+        self.__schedule_entrant_flush()
+
+    async def reconcile_entrants(self) -> None:
         """
-        Process all pending giveaways.
+        Rebuild the entrant list of every active giveaway from Discord.
+
+        This runs once when the manager loads, to catch any reactions added or removed while the bot was offline. After
+        this, entrant lists are kept up to date purely from reaction events.
 
-        Iterate through the cache looking for any expired giveaway. This method will run about once every 0.5 seconds
-        as part of the bot's event loop. As a result, care must be taken to make sure this code exits quickly if nothing
-        needs to be done.
         :return: Doesn't return.
         """
+        await self.bot.wait_until_ready()
 
-        while not self.bot.is_closed():
-            # This is what peak performance looks like, kids.
-            for giveaway in self.__cache__:
-                if giveaway.is_over():
-                    LOG.info(f"Found a scheduled giveaway for {giveaway.name} ending. Triggering...")
-                    await self.finish_giveaway(giveaway)
+        for giveaway in list(self.__cache__):
+            message_id = giveaway.register_message_id
+            channel = self.bot.get_channel(giveaway.register_channel_id)
 
-                # Because giveaways are sorted by finish date, if we encounter a giveaway that *isn't* over, we can
-                # assume there's nothing more to do, so we can exit the for loop entirely.
+            if channel is None:
+                continue
+
+            # Events that arrive while we page through Discord are logged so they can be replayed afterwards.
+            had_stored_list = message_id in self.__entrants__
+            self.__entrants__.setdefault(message_id, set())
+            self.__reconciling__[message_id] = []
+
+            try:
+                message = await channel.fetch_message(message_id)
+                fetched = {user.id async for user in self.__iterate_entrants(message)}
+            except discord.HTTPException as e:
+                LOG.warning(f"Could not reconcile entrants for giveaway {giveaway.name}: {e}")
+
+                # Don't leave a (wrongly) empty list behind if we never had one to begin with.
+                if not had_stored_list:
+                    self.__entrants__.pop(message_id, None)
+
+                continue
+            finally:
+                replay = self.__reconciling__.pop(message_id)
+
+            for (added, user_id) in replay:
+                if added:
+                    fetched.add(user_id)
                 else:
-                    break
+                    fetched.discard(user_id)
 
-            # Check again every half second
-            await asyncio.sleep(0.5)
+            if giveaway not in self.__cache__:
+                # The giveaway ended while we were reconciling.
+                continue
+
+            self.__entrants__[message_id] = fetched
+
+            if self._db_store is not None:
+                # The fetched list already includes any pending changes, so they don't need writing separately.
+                self.__pending_entrants__.pop(message_id, None)
+                self._db_store.replace_entrants(message_id, fetched)
+
+            LOG.info(f"Reconciled {len(fetched)} entrants for giveaway {giveaway.name}")
+
+        if self._db_store is None:
+            self.__flush_entrants()
+
+    async def __iterate_entrants(self, message: discord.Message):
+        """
+        Stream every eligible entrant of a giveaway message, page by page.
+
+        Only the giveaway reaction is read, and Discord lists each user at most once per reaction, so nothing needs to
+        be remembered between pages. The bot itself is skipped.
+        """
+        for reaction in message.reactions:
+            if reaction.emoji != Emojis.GIVEAWAY:
+                continue
+
+            async for user in reaction.users():
+                if user.id == self.bot.user.id:
+                    continue
+
+                yield user
 
     async def finish_giveaway(self, giveaway: HuskyData.GiveawayObject) -> None:
         """
@@ -95,46 +333,47 @@ class GiveawayManager:
 
         wcl = "\n\nWinners will be contacted shortly."
 
-        try:
-            channel: discord.TextChannel = self.bot.get_channel(giveaway.register_channel_id)
-            message: discord.Message = await channel.fetch_message(giveaway.register_message_id)
-        except discord.NotFound:
-            LOG.error("An expected giveaway channel or message was deleted. The giveaway can not continue, as the "
-                      "associated records are gone or no longer accessible to the bot. The giveaway will be deleted "
-                      "from the cache.")
+        channel: discord.TextChannel = self.bot.get_channel(giveaway.register_channel_id)
 
-            if giveaway in self.__cache__:
-                self.__cache__.remove(giveaway)
-            self._giveaway_config.set(GIVEAWAY_CONFIG_KEY, self.__cache__)
-            return
-
-        contending_users = []
-
-        for reaction in message.reactions:
-            if reaction.emoji != Emojis.GIVEAWAY:
-                continue
-
-            contending_users += await reaction.users().flatten()
+        if channel is None:
+            LOG.error("An expected giveaway channel was deleted. The giveaway can not continue, as the associated "
+                      "records are gone or no longer accessible to the bot. The giveaway will be deleted from the "
+                      "cache.")
 
-        LOG.info(f"{len(contending_users)} users joined the giveaway {giveaway.name}")
+            self.__remove_from_cache(giveaway)
+            return
 
-        # Remove the bot
         try:
-            contending_users.remove(self.bot.user)
-        except ValueError as _:
-            pass
+            message: discord.Message = await channel.fetch_message(giveaway.register_message_id)
+        except discord.NotFound:
+            LOG.warning(f"The registration message for giveaway {giveaway.name} was deleted. Winners will be picked "
+                        f"from the tracked entrant list.")
+            message = None
+
+        entrants = self.__entrants__.get(giveaway.register_message_id)
+
+        if entrants is not None:
+            winning_ids, entrant_count = await draw_winners(entrants, giveaway.winner_count, self._rng)
+        elif message is not None:
+            # Entrants were never reconciled for this giveaway, so fall back to paging through the reactions.
+            winning_users, entrant_count = await draw_winners(self.__iterate_entrants(message),
+                                                              giveaway.winner_count, self._rng)
+            winning_ids = [u.id for u in winning_users]
+        else:
+            entrant_count = 0
+            winning_ids = []
 
-        winning_users = self._rng.sample(contending_users, min(giveaway.winner_count, len(contending_users)))
-        LOG.info(f"Winners for \"{giveaway.name}\": {winning_users}")
+        LOG.info(f"{entrant_count} users joined the giveaway {giveaway.name}")
+        LOG.info(f"Winners for \"{giveaway.name}\": {winning_ids}")
 
-        if len(winning_users) == 1:
-            win_text = f"{f'Congratulations to our winner, {winning_users[0].mention}!'}{wcl}"
-        elif len(winning_users) == 2:
-            mc = f'Congratulations to our winners, {winning_users[0].mention} and {winning_users[1].mention}!'
-            win_text = f"{mc}{wcl}"
-        elif len(winning_users) > 2:
-            win_csb = [u.mention for u in winning_users]
+        win_csb = [f"<@{user_id}>" for user_id in winning_ids]
 
+        if len(win_csb) == 1:
+            win_text = f"{f'Congratulations to our winner, {win_csb[0]}!'}{wcl}"
+        elif len(win_csb) == 2:
+            mc = f'Congratulations to our winners, {win_csb[0]} and {win_csb[1]}!'
+            win_text = f"{mc}{wcl}"
+        elif len(win_csb) > 2:
             win_text = f"Congratulations to our winners: {', '.join(win_csb[:-1])}, and {win_csb[-1:][0]}! {wcl}"
         else:
             win_text = "Unfortunately, nobody entered this giveaway... :sob:"
@@ -145,13 +384,12 @@ class GiveawayManager:
             color=Colors.PRIMARY
         )
 
-        await message.delete()
-        await channel.send(embed=embed)
+        if message is not None:
+            await message.delete()
 
-        if giveaway in self.__cache__:
-            self.__cache__.remove(giveaway)
+        await channel.send(embed=embed)
 
-        self._giveaway_config.set(GIVEAWAY_CONFIG_KEY, self.__cache__)
+        self.__remove_from_cache(giveaway)
 
     async def start_giveaway(self, ctx: commands.Context, title: str, end_time: datetime.datetime,
                              winners: int) -> HuskyData.GiveawayObject:
@@ -193,13 +431,18 @@ class GiveawayManager:
         giveaway.register_channel_id = channel.id
         giveaway.register_message_id = message.id
 
+        # The cache is only kept in end-time order for /giveaways list. Null-ending giveaways (usually impossible) are
+        # placed at the very end by get_sort_index. The scheduler handles actually firing the giveaway.
         pos = HuskyUtils.get_sort_index(self.__cache__, giveaway, 'end_time')
-
-        # note, we insert the giveaway, and sort. this is a rare operation, so a sort is "acceptable"
-        # Null-ending giveaways (usually impossible) will be placed at the very end.
         self.__cache__.insert(pos, giveaway)
-        self.__cache__.sort(key=lambda g: g.end_time if g.end_time else 10 * 100)
-        self._giveaway_config.set(GIVEAWAY_CONFIG_KEY, self.__cache__)
+        self.__entrants__[giveaway.register_message_id] = set()
+
+        if self._db_store is not None:
+            self._db_store.save(giveaway)
+        else:
+            self._giveaway_config.set(GIVEAWAY_CONFIG_KEY, self.__cache__)
+
+        self.schedule_giveaway(giveaway)
 
         return giveaway
 
@@ -229,9 +472,31 @@ class GiveawayManager:
         :param giveaway: The GiveawayObject to terminate.
         """
 
-        self.__cache__.remove(giveaway)
-        self._giveaway_config.set(GIVEAWAY_CONFIG_KEY, self.__cache__)
+        self.__remove_from_cache(giveaway)
 
     def cleanup(self):
-        if self.__task__ is not None:
-            self.__task__.cancel()
+        if self.__reconcile_task__ is not None:
+            self.__reconcile_task__.cancel()
+
+        if self._scheduler.is_scheduled(SCHEDULER_OWNER, ENTRANTS_CONFIG_KEY):
+            self.__flush_entrants()
+
+        self._jobs.unregister_handler(GIVEAWAY_FINISH_JOB)
+        self._scheduler.cancel_owner(SCHEDULER_OWNER)
+
+
+async def draw_winners(entrants, count: int, rng: random.Random):
+    """
+    Uniformly pick up to `count` winners from a giveaway's entrants.
+
+    :param entrants: Either a collection of entrants (the tracked list), or an async iterator over them (the paged
+                     reactions).
+    :param count: The maximum number of winners to pick.
+    :param rng: The random number generator to use.
+    :return: Returns a tuple of (the winners in random order, the total number of entrants).
+    """
+    if isinstance(entrants, collections.abc.Collection):
+        return rng.sample(list(entrants), min(count, len(entrants))), len(entrants)
+
+    return await HuskyUtils.reservoir_sample(entrants, count, rng)
+
@@ -0,0 +1,174 @@
+import logging
+
+from HuskyBot import HuskyBot
+from libhusky import HuskyData, HuskyScheduler, HuskyUtils
+
+SCHEDULER_OWNER = "JobManager"
+LOG = logging.getLogger("HuskyBot.Managers.JobManager")
+
+# Retry defaults. A failed job is retried after BACKOFF_BASE * 2^(attempts - 1) seconds, capped at BACKOFF_MAX.
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 30
+BACKOFF_MAX = 60 * 60
+
+
+class JobManager(metaclass=HuskyUtils.Singleton):
+    """
+    The Job Manager is a shared scheduler for time-based actions (mute expiry, giveaway ends, etc).
+
+    Jobs are typed: every job has a `job_type` that maps to a handler registered by a manager or plugin, and a unique
+    idempotency key. Scheduling a job with a key that already exists replaces the old job, so callers can blindly
+    (re)schedule without creating duplicates.
+
+    Jobs only live in memory. Their owners keep the records the jobs act on (mutes, giveaways) in their own storage,
+    and schedule the jobs again from it whenever they load, so a job interrupted by a crash or restart still runs -
+    handlers must be idempotent. If a handler raises, the job is retried with exponential backoff until it runs out of
+    attempts, at which point the owner's give-up hook (if any) is called so it can clean up the record.
+
+    All jobs share a single HuskyScheduler heap, so there is no polling and an idle bot has no wakeups, regardless of
+    how many jobs are pending.
+    """
+
+    def __init__(self, bot: HuskyBot):
+        """
+        Initialize the (shared) JobManager for the bot.
+        :param bot: The Bot we use to initialize everything.
+        """
+
+        self.bot = bot
+        self._scheduler = HuskyScheduler.get_scheduler()
+
+        # All known jobs, by key. Jobs whose handler isn't registered yet stay here until it is.
+        self.__jobs__ = {}
+        self.__handlers__ = {}
+
+        LOG.info("Manager load complete.")
+
+    def register_handler(self, job_type: str, handler, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                         on_give_up=None) -> None:
+        """
+        Register the handler for a type of job, and start scheduling any pending jobs of that type.
+
+        :param job_type: The job type to handle.
+        :param handler: An async function taking the ScheduledJob to run.
+        :param max_attempts: How many times a job may fail before being dropped.
+        :param on_give_up: An (optional) async function taking the ScheduledJob, called when a job is dropped after
+                           failing max_attempts times.
+        """
+        self.__handlers__[job_type] = (handler, max_attempts, on_give_up)
+
+        for job in self.__jobs__.values():
+            if job.job_type == job_type:
+                self.__schedule(job)
+
+    def unregister_handler(self, job_type: str) -> None:
+        """
+        Stop running jobs of a specific type. Jobs are kept, and will resume once a handler is registered again.
+
+        :param job_type: The job type to stop handling.
+        """
+        self.__handlers__.pop(job_type, None)
+
+        for job in self.__jobs__.values():
+            if job.job_type == job_type:
+                self._scheduler.cancel(SCHEDULER_OWNER, job.key)
+
+    def schedule(self, job_type: str, key: str, run_at: float, payload: dict = None) -> HuskyData.ScheduledJob:
+        """
+        Schedule a new job, or replace the existing job with the same key.
+
+        Rescheduling a job to exactly the same time and payload is a no-op, and keeps its attempt count.
+
+        :param job_type: The type of job (as passed to register_handler).
+        :param key: A unique idempotency key for this job.
+        :param run_at: The UTC timestamp (see HuskyScheduler.get_current_time) to run the job at.
+        :param payload: A dict of data for the handler.
+        :return: Returns the scheduled job.
+        """
+        payload = payload or {}
+        existing = self.__jobs__.get(key)
+
+        if existing is not None and existing.job_type == job_type and existing.run_at == run_at \
+                and existing.payload == payload:
+            return existing
+
+        job = HuskyData.ScheduledJob()
+        job.key = key
+        job.job_type = job_type
+        job.run_at = run_at
+        job.payload = payload
+
+        self.__jobs__[key] = job
+        self.__schedule(job)
+
+        return job
+
+    def cancel(self, key: str) -> bool:
+        """
+        Cancel and forget a job.
+
+        :param key: The idempotency key of the job to cancel.
+        :return: Returns True if a job was cancelled.
+        """
+        job = self.__jobs__.pop(key, None)
+
+        if job is None:
+            return False
+
+        self._scheduler.cancel(SCHEDULER_OWNER, key)
+
+        return True
+
+    def get_job(self, key: str):
+        return self.__jobs__.get(key)
+
+    def __len__(self):
+        return len(self.__jobs__)
+
+    def __schedule(self, job: HuskyData.ScheduledJob) -> None:
+        if job.job_type not in self.__handlers__:
+            return
+
+        async def run():
+            await self.__run_job(job)
+
+        self._scheduler.schedule(SCHEDULER_OWNER, job.key, job.run_at, run)
+
+    async def __run_job(self, job: HuskyData.ScheduledJob) -> None:
+        handler, max_attempts, on_give_up = self.__handlers__.get(job.job_type, (None, 0, None))
+
+        if handler is None:
+            return
+
+        try:
+            await handler(job)
+        except Exception:
+            job.attempts += 1
+
+            if job.attempts >= max_attempts:
+                LOG.exception(f"Job {job.key} ({job.job_type}) failed {job.attempts} times. Giving up.")
+                self.__drop_if_current(job)
+
+                if on_give_up is not None:
+                    try:
+                        await on_give_up(job)
+                    except Exception:
+                        LOG.exception(f"Give-up hook for job {job.key} ({job.job_type}) failed.")
+                return
+
+            delay = min(BACKOFF_BASE * (2 ** (job.attempts - 1)), BACKOFF_MAX)
+            LOG.exception(f"Job {job.key} ({job.job_type}) failed (attempt {job.attempts}). Retrying in "
+                          f"{delay} seconds.")
+
+            # Only retry if the job wasn't replaced or cancelled while it was running.
+            if self.__jobs__.get(job.key) is job:
+                job.run_at = HuskyScheduler.get_current_time() + delay
+                self.__schedule(job)
+            return
+
+        self.__drop_if_current(job)
+
+    def __drop_if_current(self, job: HuskyData.ScheduledJob) -> None:
+        # The handler may have rescheduled the same key, in which case the new job must stay.
+        if self.__jobs__.get(job.key) is job:
+            self.cancel(job.key)
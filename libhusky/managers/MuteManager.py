@@ -6,51 +6,193 @@ import discord
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
-from libhusky import HuskyConfig, HuskyData, HuskyUtils
+from libhusky import HuskyConfig, HuskyData, HuskyDatabase, HuskyScheduler, HuskyUtils
 from libhusky.HuskyStatics import *
+from libhusky.managers.JobManager import JobManager
 
 LOG = logging.getLogger("HuskyBot.Managers.MuteManager")
 
+MUTE_EXPIRY_JOB = "mute.expire"
+RETRY_DELAY = 60
+
+# How many overdue mutes may be lifted at once when catching up after downtime. discord.py still handles the actual
+# per-route rate limit buckets, this just keeps us from queueing a thousand requests at once.
+CATCHUP_CONCURRENCY = 5
+
 
 class MuteManager:
     def __init__(self, bot: HuskyBot):
         self._bot = bot
         self._bot_config = HuskyConfig.get_config()
         self._mute_config = HuskyConfig.get_config('mutes', create_if_nonexistent=True)
-        self.__cache__ = []
-
-        self.read_mutes_from_file()
+        self._jobs = JobManager(bot)
+
+        # Mutes are indexed as {user_id: {channel_id: Mute}}, where a channel ID of None is a guild mute. This gives
+        # constant-time lookups for both "all mutes for a user" (rejoins) and "this user's mute in this channel".
+        # Expiry ordering lives in the scheduler, not here. With database storage, permanent mutes are left out of the
+        # cache and looked up in the database instead, as only mutes that expire need to be held in memory.
+        self.__cache__ = {}
+        self.__catchup_task__ = None
+
+        # Mutes are stored in the database (one row per mute) if enabled, falling back to mutes.json otherwise.
+        self._db_store = None
+        if HuskyDatabase.is_enabled(bot):
+            self._db_store = HuskyDatabase.MuteStore(bot.session_factory)
+            self.read_mutes_from_database()
+        else:
+            self.read_mutes_from_file()
 
-        self.__task__ = self._bot.loop.create_task(self.check_mutes())
+        self._jobs.register_handler(MUTE_EXPIRY_JOB, self.__expire_mute_job, on_give_up=self.__give_up_mute_job)
 
         LOG.info("Manager load complete.")
 
     def read_mutes_from_file(self):
         disk_mutes = self._mute_config.get("mutes", [])
 
-        for raw_mute in disk_mutes:
-            mute = HuskyData.Mute(raw_mute)
+        self.__load_mutes([HuskyData.Mute(raw_mute) for raw_mute in disk_mutes])
+        self.__save_mutes()
+
+    def read_mutes_from_database(self):
+        self._db_store.import_from_json()
+
+        self.__load_mutes(self._db_store.get_next_expiring())
+
+    def __load_mutes(self, mutes: list):
+        overdue = []
+
+        for mute in mutes:
+            if self.__get_cached(mute.user_id, mute.channel) is not None:
+                LOG.warning(f"Found a duplicate mute record for [user_id={mute.user_id}, "
+                            f"channel_id={mute.channel}] on disk. Only the last record will be kept.")
+
+            # Mutes that expired while the bot was offline are lifted in bulk rather than one at a time, so they
+            # shouldn't also have an expiry job waiting to fire.
+            expired = mute.is_expired()
+            self.__add_to_cache(mute, persist=False, schedule=not expired)
+
+            if expired:
+                self._jobs.cancel(self.__get_job_key(mute))
+                overdue.append(mute)
+
+        if overdue:
+            self.__catchup_task__ = self._bot.loop.create_task(self.process_overdue_mutes(overdue))
+
+    def __get_cached(self, user_id: int, channel_id):
+        return self.__cache__.get(user_id, {}).get(channel_id)
+
+    def __should_cache(self, mute: HuskyData.Mute) -> bool:
+        return self._db_store is None or mute.expiry is not None
+
+    async def __get_mutes_for_user(self, user_id: int) -> list:
+        if self._db_store is None:
+            return list(self.__cache__.get(user_id, {}).values())
+
+        # Timed mutes are also cached (and scheduled), so hand out those records rather than fresh copies.
+        mutes = await self._db_store.get_mutes_for_user(user_id)
+
+        return [self.__get_cached(m.user_id, m.channel) or m for m in mutes]
+
+    def __is_cached(self, mute: HuskyData.Mute) -> bool:
+        cached = self.__get_cached(mute.user_id, mute.channel)
+
+        return cached is not None and cached == mute
+
+    def __all_mutes(self) -> list:
+        return [mute for user_mutes in self.__cache__.values() for mute in user_mutes.values()]
+
+    def __save_mutes(self):
+        self._mute_config.set("mutes", self.__all_mutes())
+
+    def __persist_mute(self, mute: HuskyData.Mute):
+        if self._db_store is not None:
+            self._db_store.save(mute)
+        else:
+            self.__save_mutes()
+
+    def __add_to_cache(self, mute: HuskyData.Mute, persist: bool = True, schedule: bool = True):
+        # Only one mute may exist per user/channel pair. The replaced record's expiry job shares the same key, so it
+        # gets overwritten (or cancelled) below rather than here.
+        self.__remove_from_cache(mute, persist=False, cancel_job=False)
+
+        if self.__should_cache(mute):
+            self.__cache__.setdefault(mute.user_id, {})[mute.channel] = mute
+
+        if schedule:
+            self.__schedule_expiry(mute)
+
+        if persist:
+            self.__persist_mute(mute)
+
+    @staticmethod
+    def __get_job_key(mute: HuskyData.Mute) -> str:
+        return f"{MUTE_EXPIRY_JOB}:{mute.user_id}:{mute.channel}"
+
+    def __schedule_expiry(self, mute: HuskyData.Mute, when: float = None):
+        # Permanent mutes never expire, so they never need an expiry job.
+        if mute.expiry is None:
+            self._jobs.cancel(self.__get_job_key(mute))
+            return
+
+        self._jobs.schedule(MUTE_EXPIRY_JOB, self.__get_job_key(mute), when if when is not None else mute.expiry,
+                            {"user_id": mute.user_id, "channel": mute.channel})
+
+    async def __expire_mute_job(self, job: HuskyData.ScheduledJob):
+        mute = self.__get_cached(job.payload['user_id'], job.payload['channel'])
+
+        # Already unmuted, or made permanent. Either way, there's nothing left to do.
+        if mute is None or mute.expiry is None:
+            return
+
+        # The mute was extended after this job was written, so push the job back.
+        if not mute.is_expired():
+            self.__schedule_expiry(mute)
+            return
+
+        LOG.info(f"Found a scheduled unmute - [user_id={mute.user_id}, channel_id={mute.channel}]. Triggering...")
+        await self.unmute_user(mute, "System - Scheduled")
+
+    async def __give_up_mute_job(self, job: HuskyData.ScheduledJob):
+        mute = self.__get_cached(job.payload['user_id'], job.payload['channel'])
+
+        if mute is None or mute.expiry is None or not mute.is_expired():
+            return
 
-            self.__cache__.append(mute)
+        # Keeping the record would only retry (and fail) again on every restart, so drop it and let staff know.
+        LOG.error(f"Giving up on lifting expired mute [user_id={mute.user_id}, channel_id={mute.channel}]. Its record "
+                  f"has been removed, and it may need to be lifted by hand.")
+        self.__remove_from_cache(mute)
 
-        self._mute_config.set("mutes", self.__cache__)
+        embed = discord.Embed(
+            description=f"The expired mute for user ID `{mute.user_id}` in "
+                        f"{'the guild' if mute.channel is None else f'<#{mute.channel}>'} could not be lifted after "
+                        f"several attempts, and has been removed from the bot's records. Please check it, and lift it "
+                        f"by hand if needed.",
+            color=Colors.DANGER
+        )
+        embed.set_author(name="Expired mute could not be lifted!")
+        embed.add_field(name="Timestamp", value=HuskyUtils.get_timestamp(), inline=True)
 
-    async def check_mutes(self):
-        while not self._bot.is_closed():
-            for mute in self.__cache__:
-                if mute.is_expired():
-                    LOG.info(f"Found a scheduled unmute - [user_id={mute.user_id}, channel_id={mute.channel}]. "
-                             f"Triggering...")
-                    await self.unmute_user(mute, "System - Scheduled")
+        await HuskyUtils.send_to_keyed_channel(self._bot, ChannelKeys.STAFF_LOG, embed)
 
-                # Because mutes are sorted by expiry, we can just exit the loop if we encounter a mute that's not yet
-                # over.
-                else:
-                    break
+    def __remove_from_cache(self, mute: HuskyData.Mute, persist: bool = True, cancel_job: bool = True):
+        user_mutes = self.__cache__.get(mute.user_id, {})
+        cached = user_mutes.pop(mute.channel, None)
 
-            await asyncio.sleep(0.5)
+        if cached is not None and cancel_job:
+            self._jobs.cancel(self.__get_job_key(cached))
+
+        if not user_mutes:
+            self.__cache__.pop(mute.user_id, None)
+
+        if not persist:
+            return
+
+        if self._db_store is not None:
+            self._db_store.delete(mute)
+        else:
+            self.__save_mutes()
 
-    async def mute_user_by_object(self, mute: HuskyData.Mute, staff_member: str = "System"):
+    async def mute_user_by_object(self, mute: HuskyData.Mute, staff_member: str = "System", is_new: bool = True):
         guild = self._bot.get_guild(mute.guild)
 
         member = guild.get_member(mute.user_id)
@@ -77,11 +219,9 @@ class MuteManager:
                                           send_messages=False,
                                           add_reactions=False)
 
-        if mute not in self.__cache__:
-            pos = HuskyUtils.get_sort_index(self.__cache__, mute, 'expiry')
-            self.__cache__.insert(pos, mute)
-            self.__cache__.sort(key=lambda m: m.expiry if m.expiry else 10 * 100)
-            self._mute_config.set("mutes", self.__cache__)
+        # Existing records (e.g. restored on rejoin) may not be cached if they're permanent, so the caller says so.
+        if is_new and not self.__is_cached(mute):
+            self.__add_to_cache(mute)
 
             # Inform the guild logs
             alert_channel = self._bot_config.get('specialChannels', {}).get(ChannelKeys.STAFF_LOG.value, None)
@@ -125,12 +265,14 @@ class MuteManager:
 
         await self.mute_user_by_object(mute_obj, str(staff_member))
 
-    async def unmute_user(self, mute: HuskyData.Mute, staff_member: str):
-        if staff_member is not None:
-            unmute_reason = f"user {staff_member}"
-        else:
-            unmute_reason = "expiry"
+    async def __lift_mute(self, mute: HuskyData.Mute, unmute_reason: str):
+        """
+        Lift a mute on Discord, without touching the cache, persistence or logs.
 
+        :return: Returns a tuple of (the unmuted member, a mention of the unmute context). The member is None if they
+                 are no longer on the guild (or the muted channel was deleted), as there is nothing to lift in that
+                 case.
+        """
         guild = self._bot.get_guild(mute.guild)
         member = guild.get_member(mute.user_id)
 
@@ -138,13 +280,16 @@ class MuteManager:
         # is up.
         if member is None:
             LOG.info(f"Left user ID {mute.user_id} has had their mute expire. Removing it.")
-            self.__cache__.remove(mute)
-            self._mute_config.set("mutes", self.__cache__)
-
-            return
+            return None, None
 
         if mute.channel is not None:
             channel = self._bot.get_channel(mute.channel)
+
+            # The channel's permission overwrites (including the mute) went with it.
+            if channel is None:
+                LOG.info(f"The channel {mute.channel} for user ID {mute.user_id}'s mute was deleted. Removing it.")
+                return None, None
+
             unmute_context = channel.mention
 
             await channel.set_permissions(member, overwrite=mute.get_cached_override(),
@@ -160,9 +305,21 @@ class MuteManager:
             await member.remove_roles(mute_role,
                                       reason=f"User's guild mute has been lifted by {unmute_reason}")
 
+        return member, unmute_context
+
+    async def unmute_user(self, mute: HuskyData.Mute, staff_member: str):
+        if staff_member is not None:
+            unmute_reason = f"user {staff_member}"
+        else:
+            unmute_reason = "expiry"
+
+        member, unmute_context = await self.__lift_mute(mute, unmute_reason)
+
         # Remove from the disk
-        self.__cache__.remove(mute)
-        self._mute_config.set("mutes", self.__cache__)
+        self.__remove_from_cache(mute)
+
+        if member is None:
+            return
 
         # Inform the guild logs
         alert_channel = self._bot_config.get('specialChannels', {}).get(ChannelKeys.STAFF_LOG.value, None)
@@ -182,35 +339,104 @@ class MuteManager:
 
             await alert_channel.send(embed=embed)
 
+    async def process_overdue_mutes(self, mutes: list):
+        """
+        Lift a batch of mutes that expired while the bot was offline.
+
+        Mutes are lifted with bounded parallelism, persistence is only written once at the end, and a single summary is
+        sent to the staff log instead of one embed per mute (or none, if nothing was lifted). Any mute that fails to
+        lift is handed back to the JobManager to be retried.
+
+        :param mutes: The list of overdue mutes to lift.
+        """
+        await self._bot.wait_until_ready()
+
+        # Skip anything that was manually unmuted or replaced before we got here.
+        mutes = [m for m in mutes if self.__get_cached(m.user_id, m.channel) is m]
+        LOG.info(f"Catching up on {len(mutes)} mutes that expired while the bot was offline...")
+
+        semaphore = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+        failed_ids = set()
+
+        async def lift(mute: HuskyData.Mute):
+            async with semaphore:
+                # The mute may have been manually lifted while waiting for a slot.
+                if self.__get_cached(mute.user_id, mute.channel) is not mute:
+                    return
+
+                try:
+                    await self.__lift_mute(mute, "expiry")
+                except Exception as e:
+                    LOG.warning(f"Failed to lift overdue mute [user_id={mute.user_id}, channel_id={mute.channel}]: "
+                                f"{e}. Retrying later.")
+                    failed_ids.add(id(mute))
+
+        await asyncio.gather(*[lift(m) for m in mutes])
+
+        lifted = []
+        for mute in mutes:
+            if self.__get_cached(mute.user_id, mute.channel) is not mute:
+                continue
+
+            if id(mute) in failed_ids:
+                self.__schedule_expiry(mute, HuskyScheduler.get_current_time() + RETRY_DELAY)
+                continue
+
+            self.__remove_from_cache(mute, persist=False)
+            lifted.append(mute)
+
+        LOG.info(f"Mute catch-up complete. {len(lifted)} lifted, {len(failed_ids)} failed.")
+
+        # Nothing was lifted, so there's nothing to save or report. Failed mutes are retried (and logged) one by one.
+        if not lifted:
+            return
+
+        # Flush persistence once for the entire batch.
+        if self._db_store is not None:
+            self._db_store.delete_many(lifted)
+        else:
+            self.__save_mutes()
+
+        embed = discord.Embed(
+            description=f"{len(lifted)} mutes expired while the bot was offline, and have now been lifted.",
+            color=Colors.INFO
+        )
+        embed.set_author(name="Expired mutes lifted!")
+        embed.add_field(name="Responsible User", value="System - Scheduled", inline=True)
+        embed.add_field(name="Timestamp", value=HuskyUtils.get_timestamp(), inline=True)
+
+        if failed_ids:
+            embed.add_field(name="Failed", value=f"{len(failed_ids)} mutes could not be lifted, and will be retried "
+                                                 f"shortly.", inline=False)
+
+        await HuskyUtils.send_to_keyed_channel(self._bot, ChannelKeys.STAFF_LOG, embed)
+
     async def restore_user_mute(self, member: discord.Member):
-        for mute in self.__cache__:
-            if (mute.user_id == member.id) and not mute.is_expired():
+        for mute in await self.__get_mutes_for_user(member.id):
+            if not mute.is_expired():
                 LOG.info(f"Restoring mute state for left user {member} in channel")
-                await self.mute_user_by_object(mute, "System - ReJoin")
+                await self.mute_user_by_object(mute, "System - ReJoin", is_new=False)
 
     async def find_user_mute_record(self, member: discord.Member, channel):
-        result = None
-
         channel_id = None
         if channel is not None:
             channel_id = channel.id
 
-        for mute in self.__cache__:
-            if member.id == mute.user_id and channel_id == mute.channel:
-                result = mute
+        if self._db_store is None:
+            return self.__get_cached(member.id, channel_id)
 
-        if result is None:
-            return None
+        for mute in await self.__get_mutes_for_user(member.id):
+            if mute.channel == channel_id:
+                return mute
 
-        return result
+        return None
 
     async def update_mute_record(self, mute: HuskyData.Mute, reason: str = None, expiry: int = None):
 
-        if mute not in self.__cache__:
+        # Permanent mutes aren't cached with database storage, so there's nothing to check against.
+        if self.__should_cache(mute) and not self.__is_cached(mute):
             raise KeyError("This record doesn't exist in the cache!")
 
-        self.__cache__.remove(mute)
-
         old_reason = mute.reason
         old_expiry = mute.expiry
 
@@ -220,11 +446,9 @@ class MuteManager:
         if expiry is not None:
             mute.expiry = expiry
 
-        # Update cache and disk
-        pos = HuskyUtils.get_sort_index(self.__cache__, mute, 'expiry')
-        self.__cache__.insert(pos, mute)
-        self.__cache__.sort(key=lambda m: m.expiry if m.expiry else 10 * 100)
-        self._mute_config.set("mutes", self.__cache__)
+        # Update scheduler and disk. Re-adding the record also moves it in or out of the cache if it was made (or no
+        # longer is) permanent.
+        self.__add_to_cache(mute)
 
         alert_channel = self._bot_config.get('specialChannels', {}).get(ChannelKeys.STAFF_LOG.value, None)
         if alert_channel is not None:
@@ -255,5 +479,8 @@ class MuteManager:
             await alert_channel.send(embed=embed)
 
     def cleanup(self):
-        if self.__task__ is not None:
-            self.__task__.cancel()
+        if self.__catchup_task__ is not None:
+            self.__catchup_task__.cancel()
+
+        self._jobs.unregister_handler(MUTE_EXPIRY_JOB)
+
@@ -65,7 +65,7 @@ class AntiSpam(commands.Cog):
 
     def unload_module(self, module_name):
         self.asp.remove_command(self.__modules__[module_name])
-        del self.__modules__[module_name]
+        self.__modules__.pop(module_name).unload()
 
     async def run_scheduled_cleanups(self):
         """
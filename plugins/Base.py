@@ -6,10 +6,11 @@ import socket
 
 import discord
 import git
+from aiohttp import web
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
-from libhusky import HuskyUtils
+from libhusky import HuskyHTTP, HuskyMetrics, HuskyUtils
 from libhusky.HuskyStatics import *
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
@@ -134,6 +135,13 @@ class Base(commands.Cog):
 
         await ctx.send(embed=embed)
 
+    # noinspection PyUnusedLocal
+    @HuskyHTTP.register("/metrics", ["GET"])
+    async def get_metrics(self, request: web.BaseRequest):
+        # Prometheus text exposition format, version 0.0.4.
+        return web.Response(body=HuskyMetrics.get_registry().render().encode('utf-8'),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
 
 def setup(bot: HuskyBot):
     bot.add_cog(Base(bot))
@@ -1,11 +1,14 @@
+import collections
+import concurrent.futures
+import hashlib
+import io
 import json
 import logging
-import os
 import random
 import re
-import tempfile
+import urllib.parse
+from concurrent.futures.process import BrokenProcessPool
 
-import aiohttp
 import discord
 from PIL import Image, ImageSequence
 from discord.ext import commands
@@ -16,6 +19,74 @@ from libhusky.HuskyStatics import *
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
+# GIFs are only read up to this many bytes. Anything bigger is too big to be an "undersized" GIF, and frame headers
+# past this point are not checked.
+GIF_MAX_BYTES = 8 * 1024 * 1024
+GIF_CHUNK_SIZE = 16 * 1024
+
+# Reposts of a known abusive file are recognized by a hash of their first GIF_HASH_BYTES (and their length).
+GIF_HASH_BYTES = 64 * 1024
+
+# Discord attachment URLs never change content, so clean verdicts for them can be cached. Anything else could be
+# swapped out after it's checked.
+DISCORD_CDN_HOSTS = ["cdn.discordapp.com", "media.discordapp.net"]
+
+GIF_VERDICT_CACHE_SIZE = 1000
+
+
+def is_abusive_gif_structure(scanner: HuskyUtils.GifScanner, file_size: int = None):
+    """
+    Check a (possibly partially downloaded) GIF for known abusive structures.
+
+    :param scanner: The scanner the GIF is being fed into.
+    :param file_size: The size of the file, if known ahead of time.
+    :return: Returns True if the GIF is abusive, False if it's fully scanned and clean, or None if there's no verdict
+             yet.
+    """
+    if scanner.screen_size is None:
+        return None
+
+    (mx, my) = scanner.screen_size
+
+    if scanner.complete and file_size is None:
+        file_size = len(scanner.data)
+
+    # Too big for its size (over 5000px^2, but under 1mb)
+    if (mx > 5000) and (my > 5000) and file_size is not None and file_size < 1000000:
+        LOG.info("Found a GIF that exceeds sane size limits (over 5000px^2, but under 1mb)")
+        return True
+
+    # A frame that's way too big for the GIF
+    (x, y) = scanner.max_frame_extent
+    if (mx + my) > 0 and ((x > 2 * mx) or (y > 2 * my)):
+        LOG.info("Found a GIF with an obscenely large frame.")
+        return True
+
+    return False if scanner.complete else None
+
+
+def decode_check_gif(data: bytes) -> bool:
+    """
+    Check a GIF for an abusively large frame by fully decoding it with Pillow. This is slow (and Pillow is what abusive
+    GIFs are trying to break), so it's only run in a worker process, for GIFs the scanner can't read.
+    """
+    im = Image.open(io.BytesIO(data))
+    mx, my = im.size
+
+    for frame in ImageSequence.Iterator(im):
+        x, y = frame.tile[0][1][2:]
+
+        if (mx + my) > 0 and ((x > 2 * mx) or (y > 2 * my)):
+            return True
+
+    return False
+
+
+def is_immutable_url(url: str) -> bool:
+    parsed = urllib.parse.urlparse(url)
+
+    return parsed.hostname in DISCORD_CDN_HOSTS and parsed.path.startswith("/attachments/")
+
 
 # noinspection PyMethodMayBeStatic
 class DirtyHacks(commands.Cog):
@@ -29,40 +100,22 @@ class DirtyHacks(commands.Cog):
         self.bot = bot
         self._config = bot.config
 
-        self._http_session = aiohttp.ClientSession(loop=bot.loop)
+        self._http_session = bot.http_client.get_client("DirtyHacks", timeout=10)
+        self._decode_pool = None
+
+        # GIF verdicts (True if abusive) by URL, and known abusive GIFs by content key. Both are LRU. Clean verdicts are
+        # only cached for immutable URLs, as a clean GIF can share its first bytes (and length) with an abusive one.
+        self.__url_verdicts__ = collections.OrderedDict()
+        self.__abusive_content__ = collections.OrderedDict()
 
         LOG.info("Loaded plugin!")
 
     def cog_unload(self):
-        self.bot.loop.create_task(self._http_session.close())
+        if self._decode_pool is not None:
+            self._decode_pool.shutdown(wait=False)
 
     @commands.Cog.listener(name="on_message")
     async def kill_abusive_gifs(self, message: discord.Message):
-        def undersized_gif_check(file) -> bool:
-            # Try to see if this gif is too big for its size (over 5000px^2, but less than 1mb)
-            (width, height) = HuskyUtils.get_image_size(file.name)
-
-            if (width > 5000) and (height > 5000) and os.path.getsize(file.name) < 1000000:
-                LOG.info("Found a GIF that exceeds sane size limits (over 5000px^2, but under 1mb)")
-                return True
-
-            return False
-
-        def too_large_frame_check(file) -> bool:
-            # Try to see if this gif has a too big frame
-            im = Image.open(file.name)
-            frames = ImageSequence.Iterator(im)
-            mx, my = im.size
-            for frame in frames:
-                x, y = frame.tile[0][1][2:]
-
-                if (mx + my) > 0 and ((x > 2 * mx) or (y > 2 * my)):
-                    # We found a frame that's way too big
-                    LOG.info("Found a GIF with an obscenely large frame.")
-                    return True
-
-            return False
-
         if not HuskyUtils.should_process_message(message):
             return
 
@@ -77,32 +130,118 @@ class DirtyHacks(commands.Cog):
             return
 
         # deduplicate the list
-        matches = list(set(matches))
+        matches = list(set(''.join(match) for match in matches))
 
         for match in matches:  # type: str
-            match = ''.join(match)
+            if not urllib.parse.urlparse(match).path.lower().endswith('.gif'):
+                continue
+
+            if await self.is_abusive_gif(match):
+                await message.delete()
+                break
+
+    async def is_abusive_gif(self, url: str) -> bool:
+        verdict = self.__get_cached(self.__url_verdicts__, url)
+
+        if verdict is None:
+            verdict = await self.__inspect_gif(url)
 
-            if not match.endswith('.gif'):
-                return
+            # Anything left undecided (failed, truncated, or too large to read fully) passes, but isn't remembered.
+            if verdict is None:
+                return False
 
-            with tempfile.NamedTemporaryFile(suffix=".gif") as f:
-                async with self._http_session.get(match) as r:  # type: aiohttp.ClientResponse
-                    if r.status != 200:
-                        LOG.warning("Failed to check GIF, because status code was not 200")
-                        return
+            if verdict or is_immutable_url(url):
+                self.__set_cached(self.__url_verdicts__, url, verdict)
 
-                    if not r.headers.get('content-type', 'application/octet-stream').startswith('image'):
-                        LOG.warning("Failed to check GIF, because content type was not image")
-                        return
+        return verdict
 
-                    img_data = await r.read()
+    async def __inspect_gif(self, url: str):
+        scanner = HuskyUtils.GifScanner()
+        content_key = None
 
-                f.write(img_data)
-                f.flush()
+        async with self._http_session.get(url) as r:
+            if r.status != 200:
+                LOG.warning("Failed to check GIF, because status code was not 200")
+                return None
 
-                if undersized_gif_check(f) or too_large_frame_check(f):
-                    await message.delete()
+            if not r.headers.get('content-type', 'application/octet-stream').startswith('image'):
+                LOG.warning("Failed to check GIF, because content type was not image")
+                return None
+
+            file_size = r.content_length
+
+            # Stop reading as soon as there's a verdict, so a clean GIF is read once and an abusive one only as far as
+            # its first bad header. If the scanner can't parse the file, keep reading anyway: the decoder fallback
+            # needs the whole body, as a truncated prefix would just fail to decode.
+            async for chunk in r.content.iter_chunked(GIF_CHUNK_SIZE):
+                scanner.feed(chunk)
+
+                if content_key is None and file_size is not None and len(scanner.data) >= GIF_HASH_BYTES:
+                    content_key = self.__get_content_key(scanner.data, file_size)
+
+                    if self.__get_cached(self.__abusive_content__, content_key):
+                        return True
+
+                verdict = is_abusive_gif_structure(scanner, file_size)
+
+                if verdict is not None or len(scanner.data) >= GIF_MAX_BYTES:
                     break
+            else:
+                verdict = is_abusive_gif_structure(scanner, file_size)
+
+        # Small files never reach GIF_HASH_BYTES while streaming, but their size is known once they're fully read.
+        if content_key is None and (file_size is not None or scanner.complete):
+            content_key = self.__get_content_key(scanner.data, file_size or len(scanner.data))
+
+            if self.__get_cached(self.__abusive_content__, content_key):
+                return True
+
+        # Anything larger than GIF_MAX_BYTES was only partly read, so it's left undecided rather than decoded.
+        if verdict is None and scanner.error is not None and len(scanner.data) < GIF_MAX_BYTES:
+            LOG.debug(f"Could not scan GIF {url} ({scanner.error}). Decoding it instead.")
+            verdict = await self.__decode_check(bytes(scanner.data))
+
+        if verdict and content_key is not None:
+            self.__set_cached(self.__abusive_content__, content_key, True)
+
+        return verdict
+
+    async def __decode_check(self, data: bytes):
+        if self._decode_pool is None:
+            self._decode_pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+
+        try:
+            return await self.bot.loop.run_in_executor(self._decode_pool, decode_check_gif, data)
+        except BrokenProcessPool:
+            # The GIF crashed the decoder outright, which is exactly what we're trying to protect clients from.
+            LOG.info("Found a GIF that crashed the image decoder.")
+            self._decode_pool.shutdown(wait=False)
+            self._decode_pool = None
+            return True
+        except Exception:
+            # Couldn't decide either way.
+            return None
+
+    @staticmethod
+    def __get_content_key(data: bytearray, file_size: int) -> str:
+        return f"{hashlib.sha256(data[:GIF_HASH_BYTES]).hexdigest()}:{file_size}"
+
+    @staticmethod
+    def __get_cached(cache: collections.OrderedDict, key):
+        verdict = cache.get(key)
+
+        if verdict is not None:
+            cache.move_to_end(key)
+
+        return verdict
+
+    @staticmethod
+    def __set_cached(cache: collections.OrderedDict, key, verdict: bool):
+        cache[key] = verdict
+        cache.move_to_end(key)
+
+        while len(cache) > GIF_VERDICT_CACHE_SIZE:
+            cache.popitem(last=False)
 
     # @commands.Cog.listener(name="on_message")
 
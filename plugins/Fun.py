@@ -4,7 +4,6 @@ import random
 import re
 from datetime import datetime
 
-import aiohttp
 import discord
 from discord.ext import commands
 
@@ -22,11 +21,13 @@ class Fun(commands.Cog):
     ToDo: Delete this. And for the open release, don't judge me :(
     """
 
+    XKCD_LATEST_CACHE_TTL = 60 * 60
+
     def __init__(self, bot: HuskyBot):
         self.bot = bot
         self._config = bot.config
 
-        self._http_session = aiohttp.ClientSession(loop=bot.loop)
+        self._http_session = bot.http_client.get_client("Fun", timeout=15)
 
         # For those reading this code and wondering about the significance of 736580, it is a very important
         # number relating to someone I loved. </3
@@ -34,9 +35,6 @@ class Fun(commands.Cog):
 
         LOG.info("Loaded plugin!")
 
-    def cog_unload(self):
-        self.bot.loop.create_task(self._http_session.close())
-
     @commands.command(name="slap", brief="Slap a user silly!")
     @commands.guild_only()
     async def slap(self, ctx: commands.Context, user: discord.Member = None):
@@ -220,8 +218,8 @@ class Fun(commands.Cog):
         """
         Dog.
         """
-        async with self._http_session.get("https://dog.ceo/api/breeds/image/random") as resp:
-            dog = await resp.json()
+        # Every call should get a new dog, so this isn't cached. Concurrent requests still share a single call.
+        dog = (await self._http_session.fetch('GET', "https://dog.ceo/api/breeds/image/random", ttl=0)).json()
 
         if dog.get('status') != "success":
             await ctx.send("Error getting dog. Why not play with a husky?")
@@ -516,10 +514,15 @@ class Fun(commands.Cog):
 
         base_url = "https://xkcd.com/{}/info.0.json"
 
+        # Published comics never change, so they're cached forever (and on disk). The latest comic changes a few
+        # times a week.
+        persist = True
+
         if not comic_id or comic_id in ['random', 'rand', 'r']:
             api_url = base_url.format(await get_random_comic())
         elif comic_id in ['latest', 'new', 'l', 'n']:
             api_url = base_url.format('')  # hacky, but works.
+            persist = False
         elif comic_id.isnumeric() and int(comic_id) > 1:
             api_url = base_url.format(comic_id)
         else:
@@ -530,16 +533,17 @@ class Fun(commands.Cog):
             ))
             return
 
-        async with self._http_session.get(api_url) as resp:
-            if resp.status != 200:
-                await ctx.send(embed=discord.Embed(
-                    title="xkcd Comic Not Found!",
-                    description="The requested comic ID could not be found. ",
-                    color=Colors.DANGER
-                ))
-                return
+        resp = await self._http_session.fetch('GET', api_url, ttl=self.XKCD_LATEST_CACHE_TTL, persist=persist)
+
+        if resp.status != 200:
+            await ctx.send(embed=discord.Embed(
+                title="xkcd Comic Not Found!",
+                description="The requested comic ID could not be found. ",
+                color=Colors.DANGER
+            ))
+            return
 
-            comic = await resp.json()
+        comic = resp.json()
 
         embed = discord.Embed(
             title=f"[{comic.get('num')}] {comic.get('safe_title')}",
@@ -37,6 +37,20 @@ class Giveaway(commands.Cog):
         # super.__cleanup()
         self.giveaway_manager.cleanup()
 
+    @commands.Cog.listener(name="on_raw_reaction_add")
+    async def track_giveaway_entry(self, payload: discord.RawReactionActionEvent):
+        if str(payload.emoji) != Emojis.GIVEAWAY or not self.giveaway_manager.is_giveaway_message(payload.message_id):
+            return
+
+        self.giveaway_manager.add_entrant(payload.message_id, payload.user_id)
+
+    @commands.Cog.listener(name="on_raw_reaction_remove")
+    async def track_giveaway_exit(self, payload: discord.RawReactionActionEvent):
+        if str(payload.emoji) != Emojis.GIVEAWAY or not self.giveaway_manager.is_giveaway_message(payload.message_id):
+            return
+
+        self.giveaway_manager.remove_entrant(payload.message_id, payload.user_id)
+
     @commands.group(name="giveaways", brief="Control the giveaway plugin", aliases=["giveaway", "ga"])
     @commands.has_permissions(manage_messages=True)
     async def ga(self, ctx: commands.Context):
@@ -63,7 +77,11 @@ class Giveaway(commands.Cog):
             end_time = datetime.datetime.utcfromtimestamp(g.end_time).strftime(DATETIME_FORMAT)
             channel = self.bot.get_channel(g.register_channel_id)
 
-            pretty_list += f"\n{i + 1}. {g.name} (in {channel.mention}, ending {end_time}, {g.winner_count} winners)"
+            entrant_count = self.giveaway_manager.get_entrant_count(g)
+            entrant_str = f", {entrant_count} entrants" if entrant_count is not None else ""
+
+            pretty_list += f"\n{i + 1}. {g.name} (in {channel.mention}, ending {end_time}, {g.winner_count} winners" \
+                           f"{entrant_str})"
 
         if len(giveaways) == 0:
             await ctx.send(embed=discord.Embed(
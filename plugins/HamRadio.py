@@ -1,41 +1,136 @@
 import datetime
 import logging
+import os
 import re
 
-import aiohttp
 import discord
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
+from libhusky import HuskyChecks, HuskyScheduler
 from libhusky.HuskyStatics import *
+from libhusky.apis import FCCULS
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
+SCHEDULER_OWNER = "HamRadio"
+
+# How often (in seconds) the local callsign database is brought up to date with the FCC's daily files.
+ULS_UPDATE_INTERVAL = 24 * 60 * 60
+ULS_UPDATE_RETRY = 60 * 60
+
 
 # noinspection PyMethodMayBeStatic
 class HamRadio(commands.Cog):
     CALLSIGN_LOOKUP_URL = "https://callook.info/{callsign}/json"
 
+    # callook.info updates from the FCC daily at most, so a lookup can be reused for a few hours.
+    CALLSIGN_CACHE_TTL = 6 * 60 * 60
+
     def __init__(self, bot: HuskyBot):
         self.bot = bot
         self._config = bot.config
 
-        self._http_session = aiohttp.ClientSession(loop=bot.loop)
+        self._http_session = bot.http_client.get_client("HamRadio", timeout=15)
+        self._scheduler = HuskyScheduler.get_scheduler()
+
+        config_prefix = os.environ.get('HUSKYBOT_CONFIG_PREFIX', '')
+        if config_prefix:
+            config_prefix += "_"
+
+        self._uls = FCCULS.CallsignDatabase(f'config/{config_prefix}uls.db')
+        self._uls_update_task = None
+
+        # Lookups against the local database are free, so only lookups that go to callook.info are rate limited.
+        self._remote_cooldown = commands.CooldownMapping.from_cooldown(1, 10, commands.BucketType.user)
+
+        # Keeping the database current is opt-in: it starts once someone has run the first import.
+        if self._uls.is_available():
+            up_to_date = self._uls.get_pending_deltas() == []
+            self.__schedule_uls_update(ULS_UPDATE_INTERVAL if up_to_date else 60)
 
         LOG.info("Loaded plugin!")
 
     def cog_unload(self):
-        self.bot.loop.create_task(self._http_session.close())
+        self._scheduler.cancel_owner(SCHEDULER_OWNER)
+
+        if self._uls_update_task is not None:
+            self._uls_update_task.cancel()
+
+        self._uls.close()
+
+    def __schedule_uls_update(self, delay: float):
+        async def update():
+            self.__start_uls_update()
+
+        self._scheduler.schedule(SCHEDULER_OWNER, "ulsUpdate", HuskyScheduler.get_current_time() + delay, update)
+
+    def __start_uls_update(self, force_full: bool = False):
+        if self._uls_update_task is None or self._uls_update_task.done():
+            self._uls_update_task = self.bot.loop.create_task(self.update_callsign_database(force_full))
+
+        return self._uls_update_task
+
+    async def update_callsign_database(self, force_full: bool = False) -> str:
+        """
+        Bring the local callsign database up to date, using the FCC's daily files where possible.
+
+        :param force_full: If True, always rebuild the database from the weekly full dump.
+        :return: Returns a short summary of what was imported.
+        """
+        pending = None if (force_full or not self._uls.is_available()) else self._uls.get_pending_deltas()
+        summary = ""
+
+        try:
+            if pending is None:
+                path = await FCCULS.download_dump(self._http_session, FCCULS.FULL_DUMP_URL)
+
+                try:
+                    count = await self.bot.loop.run_in_executor(None, self._uls.import_full, path)
+                finally:
+                    os.remove(path)
+
+                self._uls.reopen()
+                summary = f"Imported {count} licenses from the full FCC dump. "
+
+                # The weekly dump is usually a few days old, so catch up on the days since it was made.
+                pending = self._uls.get_pending_deltas()
+
+                if pending is None:
+                    LOG.warning("The full FCC dump is older than the daily files go back. Some updates will be missing "
+                                "until the next full dump.")
+                    pending = []
+
+            count = 0
+
+            for day in pending:
+                url = FCCULS.DAILY_DUMP_URL.format(day=FCCULS.DAILY_DUMP_DAYS[day.weekday()])
+                path = await FCCULS.download_dump(self._http_session, url)
+
+                try:
+                    count += await self.bot.loop.run_in_executor(None, self._uls.import_delta, path, day)
+                finally:
+                    os.remove(path)
+
+            summary += f"Applied {count} license updates from {len(pending)} daily FCC file(s)."
+        except Exception:
+            LOG.exception("Could not update the local callsign database. Retrying later.")
+            self.__schedule_uls_update(ULS_UPDATE_RETRY)
+            raise
+
+        LOG.info(summary)
+        self.__schedule_uls_update(ULS_UPDATE_INTERVAL)
+        return summary
 
     @commands.command(name="callsign", brief="Get information about a callsign")
-    @commands.cooldown(1, 10, commands.BucketType.user)
     async def get_callsign_data(self, ctx: commands.Context, callsign: str):
         """
-        This command allows radio amateurs to query the FCC callsign database (via callook.info) to get basic
-        information about radio amateurs. It only works (for now) for US callsigns, and is slightly delayed from the
-        official FCC record due to download and processing times.
+        This command allows radio amateurs to query the FCC callsign database to get basic information about radio
+        amateurs. It only works (for now) for US callsigns, and is slightly delayed from the official FCC record due to
+        download and processing times.
 
-        In order to prevent API abuse, this command is restricted to one lookup every ten seconds.
+        Callsigns are looked up in the bot's local copy of the FCC database first. Callsigns that aren't there are
+        looked up via callook.info, which is restricted to one lookup every ten seconds to prevent API abuse.
 
         Parameters
         ----------
@@ -58,17 +153,34 @@ class HamRadio(commands.Cog):
             ))
             return
 
-        async with self._http_session.get(self.CALLSIGN_LOOKUP_URL.format(callsign=callsign)) as r:
-            if r.status != 200:
-                await ctx.send(embed=discord.Embed(
-                    title="Callsign Server Error",
-                    description=f"The callsign lookup server responded with HTTP status code {r.status}. Please try "
-                                f"your query again later.",
-                    color=Colors.ERROR
-                ))
-                return
+        callsign_data = self._uls.lookup(callsign)
+
+        if callsign_data is not None:
+            await ctx.send(embed=self.__build_callsign_embed(Callsign(callsign_data), local=True))
+            return
+
+        bucket = self._remote_cooldown.get_bucket(ctx.message)
+        retry_after = bucket.update_rate_limit()
+        if retry_after:
+            raise commands.CommandOnCooldown(bucket, retry_after)
 
-            callsign_data = await r.json()
+        # Don't cache an "updating" answer, or the callsign would look broken for hours.
+        r = await self._http_session.fetch(
+            'GET', self.CALLSIGN_LOOKUP_URL.format(callsign=callsign),
+            ttl=self.CALLSIGN_CACHE_TTL,
+            cacheable=lambda resp: resp.status == 200 and resp.json().get('status') != "UPDATING"
+        )
+
+        if r.status != 200:
+            await ctx.send(embed=discord.Embed(
+                title="Callsign Server Error",
+                description=f"The callsign lookup server responded with HTTP status code {r.status}. Please try "
+                            f"your query again later.",
+                color=Colors.ERROR
+            ))
+            return
+
+        callsign_data = r.json()
 
         if callsign_data['status'] == "UPDATING":
             await ctx.send(embed=discord.Embed(
@@ -91,8 +203,9 @@ class HamRadio(commands.Cog):
         elif callsign_data['status'] != "VALID":
             raise ValueError(f"The callsign server responded with illegal value {callsign_data['status']}")
 
-        callsign = Callsign(callsign_data)
+        await ctx.send(embed=self.__build_callsign_embed(Callsign(callsign_data), local=False))
 
+    def __build_callsign_embed(self, callsign: 'Callsign', local: bool) -> discord.Embed:
         notes = []
 
         if callsign.is_expired():
@@ -133,20 +246,94 @@ class HamRadio(commands.Cog):
                             value=callsign.address,
                             inline=False)
 
-        # Line 5
-        embed.add_field(name="Location",
-                        value=f"[{callsign.latitude:.5f}, {callsign.longitude:5f}]({callsign.google_maps_url()})",
-                        inline=True)
-        embed.add_field(name="Grid Square", value=callsign.gridsquare, inline=True)
+        # Line 5 (the FCC database doesn't have locations, only callook.info does)
+        if callsign.latitude is not None:
+            embed.add_field(name="Location",
+                            value=f"[{callsign.latitude:.5f}, {callsign.longitude:5f}]({callsign.google_maps_url()})",
+                            inline=True)
+            embed.add_field(name="Grid Square", value=callsign.gridsquare, inline=True)
 
         # Line 7
         embed.add_field(name="Links", value=f"[ULS Entry >]({callsign.uls_url})\n"
                                             f"[QRZ Page >](https://www.qrz.com/db/{callsign.callsign})",
                         inline=False)
 
-        embed.set_footer(text="Data retrieved from https://callook.info/", icon_url="https://callook.info/favicon.ico")
+        if local:
+            embed.set_footer(text="Data retrieved from the FCC ULS database")
+        else:
+            embed.set_footer(text="Data retrieved from https://callook.info/",
+                             icon_url="https://callook.info/favicon.ico")
+
+        return embed
+
+    @commands.command(name="callsignsearch", brief="Find callsigns by name", aliases=["csearch"])
+    @commands.cooldown(1, 3, commands.BucketType.user)
+    async def search_callsigns(self, ctx: commands.Context, *, name: str):
+        """
+        Search the bot's local copy of the FCC database for active licenses by name.
+
+        Names are matched from the start, either against the full licensee name (generally "LAST, FIRST" for people)
+        or the last name alone. Only the first ten matches are shown.
+
+        Parameters
+        ----------
+            ctx   :: Discord context <!nodoc>
+            name  :: The (start of the) name to search for.
+
+        Examples
+        --------
+            /callsignsearch smith       :: Find licenses for people named Smith.
+            /callsignsearch arrl        :: Find licenses for clubs with names starting with "ARRL".
+        """
+        if not self._uls.is_available():
+            await ctx.send(embed=discord.Embed(
+                title="Callsign Database Unavailable",
+                description="Name searches need the local FCC callsign database, which hasn't been imported yet.",
+                color=Colors.ERROR
+            ))
+            return
+
+        results = self._uls.search_name(name)
+
+        if not results:
+            description = "No active licenses were found matching that name."
+        else:
+            description = "\n".join(f"`{c}` - {n}" + (f" ({o.capitalize()})" if o else "") for (c, n, o) in results)
+
+        await ctx.send(embed=discord.Embed(
+            title=f"{Emojis.RADIO} Callsign Search",
+            description=description,
+            color=Colors.INFO
+        ))
+
+    @commands.command(name="ulsupdate", brief="Update the local FCC callsign database")
+    @HuskyChecks.is_superuser()
+    async def update_uls(self, ctx: commands.Context, mode: str = None):
+        """
+        Download the latest FCC amateur license data and import it into the bot's local callsign database.
+
+        The first import downloads the FCC's full weekly dump, which is large and may take several minutes to process.
+        After that, the database is kept up to date automatically from the FCC's daily files.
+
+        Parameters
+        ----------
+            ctx   :: Discord context <!nodoc>
+            mode  :: Pass "full" to rebuild the database from the full dump, even if it's already up to date.
+        """
+        await ctx.send(embed=discord.Embed(
+            title=f"{Emojis.RADIO} Callsign Database Update",
+            description="Downloading and importing FCC license data. This may take a while...",
+            color=Colors.INFO
+        ))
+
+        async with ctx.typing():
+            summary = await self.__start_uls_update(force_full=(mode == "full"))
 
-        await ctx.send(embed=embed)
+        await ctx.send(embed=discord.Embed(
+            title=f"{Emojis.RADIO} Callsign Database Updated",
+            description=summary,
+            color=Colors.SUCCESS
+        ))
 
 
 class Callsign:
@@ -169,8 +356,9 @@ class Callsign:
         formatted_addr = [addr_attn, addr_line1, addr_line2]
         self.address = "\n".join([x for x in formatted_addr if x is not None]) or None
 
-        self.latitude = float(data.get('location', {}).get('latitude', 0))
-        self.longitude = float(data.get('location', {}).get('longitude', 0))
+        location = data.get('location', {})
+        self.latitude = float(location['latitude']) if 'latitude' in location else None
+        self.longitude = float(location['longitude']) if 'longitude' in location else None
         self.gridsquare = data.get('location', {}).get('gridsquare')
 
         self.granted_on = datetime.datetime.strptime(
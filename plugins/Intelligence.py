@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import logging
 
@@ -9,9 +10,17 @@ from HuskyBot import HuskyBot
 from libhusky import HuskyConverters
 from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
+from libhusky.managers.ActivityManager import ActivityManager
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
+# How many channels a history scan may read at once, and how often (in seconds) it reports progress.
+HISTORY_SCAN_WORKERS = 4
+HISTORY_SCAN_PROGRESS_INTERVAL = 5
+
+# How many time slices of a single channel's history are fetched at once. See HuskyUtils.iter_history_slices.
+HISTORY_SLICES_PER_CHANNEL = 4
+
 
 class Intelligence(commands.Cog):
     """
@@ -26,8 +35,19 @@ class Intelligence(commands.Cog):
 
     def __init__(self, bot: HuskyBot):
         self.bot = bot
+
+        # Running message history scans, one per guild ID.
+        self.__history_scans__ = {}
+        self._activity = ActivityManager(bot)
+
         LOG.info("Loaded plugin!")
 
+    def cog_unload(self):
+        for scan in self.__history_scans__.values():
+            scan['task'].cancel()
+
+        self._activity.flush()
+
     @commands.command(name="guildinfo", aliases=["sinfo", "ginfo"], brief="Get information about the current guild")
     @commands.guild_only()
     async def guild_info(self, ctx: commands.Context):
@@ -201,7 +221,6 @@ class Intelligence(commands.Cog):
 
     @commands.command(name="msgcount", brief="Get a count of messages in a given context")
     @commands.has_permissions(manage_messages=True)
-    @commands.cooldown(1, 60, commands.BucketType.user)
     async def message_count(self, ctx: commands.Context,
                             search_context: HuskyConverters.ChannelContextConverter = "public",
                             timedelta: HuskyConverters.DateDiffConverter = "24h"):
@@ -214,10 +233,14 @@ class Intelligence(commands.Cog):
 
         Caveats
         -------
-          * It is important to know that this is a *slow* command, because it needs to iterate over every message
-            in the search channels in order to successfully operate. Because of this, the "Typing" indicator will
-            display. Also note that this command may not return accurate results due to the nature of the search system.
-            It should be used for approximation only.
+          * Recent message counts are answered instantly from the bot's activity index. For time ranges from before
+            the index started, this is a *slow* command, because it needs to iterate over every message in the search
+            channels (up to when the index started) in order to successfully operate. Progress is reported while the
+            search runs, and a running search may be stopped early (with partial results) through /cancelscan. Also
+            note that this command may not return accurate results due to the nature of the search system. It should
+            be used for approximation only.
+          * Only one search may run per guild at a time. Running the same search while it's already in progress will
+            wait for (and share) the existing search's results.
 
         Parameters
         ----------
@@ -243,33 +266,43 @@ class Intelligence(commands.Cog):
         if timedelta == "24h":
             timedelta = datetime.timedelta(hours=24)
 
-        message_count = 0
-
-        now = datetime.datetime.utcnow()
-        search_start = now - timedelta
-
-        async with ctx.typing():
-            for channel in search_context['channels']:
-                if not channel.permissions_for(ctx.me).read_message_history:
-                    LOG.info("I don't have permission to get information for channel %s", channel)
-                    continue
-
-                LOG.info("Getting history for %s", channel)
-                hist = channel.history(limit=None, after=search_start)
-
-                async for _ in hist:
-                    message_count += 1
+        search_start = datetime.datetime.utcnow() - timedelta
+        channel_ids = [c.id for c in search_context['channels']]
+        message_count = self._activity.get_message_count(channel_ids, search_start)
 
+        if message_count is not None:
             await ctx.send(embed=discord.Embed(
                 title="Message Count Report",
                 description=f"Since `{search_start.strftime(DATETIME_FORMAT)}`, the channel context "
                             f"`{search_context['name']}` has seen about **{message_count} messages**.",
                 color=Colors.INFO
             ))
+            return
+
+        # The activity index doesn't go back that far, so only read the history from before the index started, and
+        # count the rest from the index.
+        scan = await self.__get_history_scan(ctx, search_context, timedelta,
+                                             search_end=self._activity.get_covered_since())
+
+        if scan is None:
+            return
+
+        await self.__wait_for_scan(scan)
+
+        message_count = scan['message_count']
+        if scan['search_end'] is not None:
+            message_count += self._activity.get_message_count(channel_ids, scan['search_end'])
+
+        await ctx.send(embed=discord.Embed(
+            title="Message Count Report",
+            description=f"Since `{scan['search_start'].strftime(DATETIME_FORMAT)}`, the channel context "
+                        f"`{search_context['name']}` has seen about **{message_count} messages**."
+                        f"{self.__get_partial_notice(scan)}",
+            color=Colors.INFO
+        ))
 
     @commands.command(name="activeusercount", brief="Get a count of active users on the guild", aliases=["auc"])
     @commands.has_permissions(view_audit_log=True)
-    @commands.cooldown(1, 60, commands.BucketType.user)
     async def active_user_count(self, ctx: commands.Context,
                                 search_context: HuskyConverters.ChannelContextConverter = "all",
                                 delta: HuskyConverters.DateDiffConverter = "24h",
@@ -286,10 +319,12 @@ class Intelligence(commands.Cog):
 
         Caveats
         -------
-          * It is important to know that this is a *slow* command, because it needs to iterate over every message
-            in the search channels in order to successfully operate. Because of this, the "Typing" indicator will
-            display. Also note that this command may not return accurate results due to the nature of the search system.
-            It should be used for approximation only.
+          * Recent activity is answered instantly from the bot's activity index, which counts per day (so the search
+            will start at midnight UTC). For time ranges from before the index started, this is a *slow* command,
+            because it needs to iterate over every message in the search channels in order to successfully operate.
+            Progress is reported while the search runs, and a running search may be stopped early (with partial
+            results) through /cancelscan. Also note that this command may not return accurate results due to the
+            nature of the search system. It should be used for approximation only.
 
         Parameters
         ----------
@@ -311,40 +346,224 @@ class Intelligence(commands.Cog):
         if delta == "24h":
             delta = datetime.timedelta(hours=24)
 
-        message_counts = {}
-        active_user_count = 0
+        indexed_counts = self._activity.get_user_message_counts([c.id for c in search_context['channels']],
+                                                                datetime.datetime.utcnow() - delta)
 
-        now = datetime.datetime.utcnow()
-        search_start = now - delta
+        if indexed_counts is not None:
+            (user_counts, search_start) = indexed_counts
+            active_user_count = sum(1 for count in user_counts.values() if count >= threshold)
 
-        async with ctx.typing():
-            for channel in search_context['channels']:
-                if not channel.permissions_for(ctx.me).read_message_history:
-                    LOG.info("I don't have permission to get information for channel %s", channel)
-                    continue
+            await ctx.send(embed=discord.Embed(
+                title="Active User Count Report",
+                description=f"Since `{search_start.strftime(DATETIME_FORMAT)}`, the channel context "
+                            f"`{search_context['name']}` has seen about **{active_user_count} active "
+                            f"{'users' if threshold > 1 else 'user'}** (sending at least {threshold} "
+                            f"{'messages' if threshold > 1 else 'message'}).",
+                color=Colors.INFO
+            ))
+            return
 
-                LOG.info("Getting history for %s", channel)
-                hist = channel.history(limit=None, after=search_start)
+        # The activity index doesn't go back that far, so read the history instead.
+        scan = await self.__get_history_scan(ctx, search_context, delta)
 
-                async for m in hist:  # type: discord.Message
-                    if m.author.bot:
-                        continue
+        if scan is None:
+            return
 
-                    message_counts[m.author.id] = message_counts.get(m.author.id, 0) + 1
+        await self.__wait_for_scan(scan)
 
-            for user in message_counts:
-                if message_counts[user] >= threshold:
-                    active_user_count += 1
+        active_user_count = sum(1 for count in scan['user_counts'].values() if count >= threshold)
 
         await ctx.send(embed=discord.Embed(
             title="Active User Count Report",
-            description=f"Since `{search_start.strftime(DATETIME_FORMAT)}`, the channel context "
+            description=f"Since `{scan['search_start'].strftime(DATETIME_FORMAT)}`, the channel context "
                         f"`{search_context['name']}` has seen about **{active_user_count} active "
                         f"{'users' if threshold > 1 else 'user'}** (sending at least {threshold} "
-                        f"{'messages' if threshold > 1 else 'message'}).",
+                        f"{'messages' if threshold > 1 else 'message'}).{self.__get_partial_notice(scan)}",
             color=Colors.INFO
         ))
 
+    @commands.command(name="cancelscan", brief="Stop the running message history search")
+    @commands.has_permissions(manage_messages=True)
+    async def cancel_scan(self, ctx: commands.Context):
+        """
+        Searches started by /msgcount and /activeusercount can take a long time on large guilds. This command will stop
+        the search currently running in this guild, and any waiting commands will report what was found so far.
+        """
+        scan = self.__history_scans__.get(ctx.guild.id)
+
+        if scan is None:
+            await ctx.send(embed=discord.Embed(
+                title="No Search Running",
+                description="There is no message history search running in this guild right now.",
+                color=Colors.WARNING
+            ))
+            return
+
+        scan['task'].cancel()
+
+        await ctx.send(embed=discord.Embed(
+            title="Search Cancelled",
+            description="The running message history search has been stopped. Partial results will be reported.",
+            color=Colors.SUCCESS
+        ))
+
+    async def __get_history_scan(self, ctx: commands.Context, search_context: dict, delta: datetime.timedelta,
+                                 search_end: datetime.datetime = None):
+        """
+        Get the history scan for a search, starting it if necessary. The scan reads history up to search_end (or now).
+
+        Scans are locked per guild. If the same search is already running, its scan is shared. If a different search
+        is running, the caller is told to wait and None is returned.
+        """
+        channels = [c for c in search_context['channels'] if c.permissions_for(ctx.me).read_message_history]
+
+        for channel in search_context['channels']:
+            if channel not in channels:
+                LOG.info("I don't have permission to get information for channel %s", channel)
+
+        key = (tuple(sorted(c.id for c in channels)), delta, search_end)
+        scan = self.__history_scans__.get(ctx.guild.id)
+
+        if scan is not None:
+            if scan['key'] != key:
+                await ctx.send(embed=discord.Embed(
+                    title="Search Already Running",
+                    description="Another message history search is already running in this guild. Please wait for "
+                                "it to finish, or stop it with `/cancelscan`.",
+                    color=Colors.WARNING
+                ))
+                return None
+
+            await ctx.send(embed=discord.Embed(
+                title="Search Already Running",
+                description="An identical search is already running, so its results will be shared.",
+                color=Colors.INFO
+            ))
+            return scan
+
+        scan = {
+            "key": key,
+            "search_start": datetime.datetime.utcnow() - delta,
+            "search_end": search_end,
+            "channel_count": len(channels),
+            "channels_done": 0,
+            "channels_failed": 0,
+            "message_count": 0,
+            "user_counts": {},
+            "cancelled": False
+        }
+
+        status_message = await ctx.send(embed=self.__get_scan_progress_embed(scan))
+
+        scan['task'] = self.bot.loop.create_task(self.__run_history_scan(scan, channels, status_message))
+        self.__history_scans__[ctx.guild.id] = scan
+
+        def on_done(task: asyncio.Task):
+            if task.cancelled():
+                # Cancelled before it even started.
+                scan['cancelled'] = True
+
+            if self.__history_scans__.get(ctx.guild.id) is scan:
+                del self.__history_scans__[ctx.guild.id]
+
+        scan['task'].add_done_callback(on_done)
+
+        return scan
+
+    @staticmethod
+    async def __wait_for_scan(scan: dict):
+        # asyncio.wait() neither cancels the (shared) scan if this command is cancelled, nor raises if the scan was.
+        await asyncio.wait([scan['task']])
+
+        if not scan['task'].cancelled() and scan['task'].exception() is not None:
+            raise scan['task'].exception()
+
+    async def __run_history_scan(self, scan: dict, channels: list, status_message: discord.Message):
+        semaphore = asyncio.Semaphore(HISTORY_SCAN_WORKERS)
+
+        async def scan_channel(channel: discord.TextChannel):
+            async with semaphore:
+                LOG.info("Getting history for %s", channel)
+
+                # Messages are only counted, so they can come in any order.
+                history = HuskyUtils.iter_history_slices(channel, after=scan['search_start'], before=scan['search_end'],
+                                                         slices=HISTORY_SLICES_PER_CHANNEL, ordered=False)
+
+                async for m in history:  # type: discord.Message
+                    scan['message_count'] += 1
+
+                    if not m.author.bot:
+                        scan['user_counts'][m.author.id] = scan['user_counts'].get(m.author.id, 0) + 1
+
+                scan['channels_done'] += 1
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(HISTORY_SCAN_PROGRESS_INTERVAL)
+
+                try:
+                    await status_message.edit(embed=self.__get_scan_progress_embed(scan))
+                except discord.HTTPException:
+                    LOG.warning("Couldn't update history scan progress message.")
+
+        # Each channel's history is its own rate limit bucket (which discord.py tracks for us), so channels can be
+        # scanned side by side. The pool just keeps us from opening every bucket in the guild at once.
+        progress_task = self.bot.loop.create_task(report_progress())
+
+        try:
+            # A channel that fails part way (e.g. permissions changed) doesn't stop the others, and whatever it counted
+            # before failing is kept.
+            results = await asyncio.gather(*[scan_channel(c) for c in channels], return_exceptions=True)
+        except asyncio.CancelledError:
+            # gather() cancels the channel scans for us, and the counts so far are kept as partial results.
+            scan['cancelled'] = True
+        else:
+            for (channel, result) in zip(channels, results):
+                if isinstance(result, Exception):
+                    LOG.warning("Couldn't finish getting history for %s: %s", channel, result)
+                    scan['channels_failed'] += 1
+        finally:
+            progress_task.cancel()
+
+        try:
+            await status_message.edit(embed=self.__get_scan_progress_embed(scan))
+        except discord.HTTPException:
+            pass
+
+    @staticmethod
+    def __get_scan_progress_embed(scan: dict) -> discord.Embed:
+        if scan['cancelled']:
+            title, color = "Message Search Cancelled", Colors.WARNING
+        elif scan['channels_done'] + scan['channels_failed'] < scan['channel_count']:
+            title, color = "Message Search Running", Colors.INFO
+        elif scan['channels_failed'] > 0:
+            title, color = "Message Search Partially Complete", Colors.WARNING
+        else:
+            title, color = "Message Search Complete", Colors.SUCCESS
+
+        failed = f" ({scan['channels_failed']} could not be fully searched)" if scan['channels_failed'] else ""
+        until = f" until `{scan['search_end'].strftime(DATETIME_FORMAT)}`" if scan['search_end'] is not None else ""
+
+        return discord.Embed(
+            title=title,
+            description=f"Searched {scan['channels_done']} of {scan['channel_count']} channels{failed}, and found "
+                        f"{scan['message_count']} messages since `{scan['search_start'].strftime(DATETIME_FORMAT)}`"
+                        f"{until} so far.",
+            color=color
+        )
+
+    @staticmethod
+    def __get_partial_notice(scan: dict) -> str:
+        if scan['cancelled']:
+            return f"\n\n**This is a partial result.** The search was cancelled after fully searching " \
+                   f"{scan['channels_done']} of {scan['channel_count']} channels."
+
+        if scan['channels_failed'] > 0:
+            return f"\n\n**This is a partial result.** {scan['channels_failed']} of {scan['channel_count']} channels " \
+                   f"could not be fully searched."
+
+        return ""
+
     @commands.command(name="prunesim", brief="Get a number of users scheduled for pruning")
     @commands.has_permissions(manage_guild=True)
     async def check_prune(self, ctx: commands.Context, days: int = 7):
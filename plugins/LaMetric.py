@@ -2,16 +2,27 @@ import asyncio
 import logging
 import os
 
+import aiohttp
 import discord
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
-from libhusky import HuskyChecks
+from libhusky import HuskyChecks, HuskyScheduler
 from libhusky.HuskyStatics import *
 from libhusky.apis import LaMetric as LaMetricApi
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
+SCHEDULER_OWNER = "LaMetric"
+
+# Devices get at most one count update every PUSH_INTERVAL seconds. Updates in between are merged, and the latest value
+# is sent once the interval is up.
+PUSH_INTERVAL = 10
+
+# A device that fails is retried after BACKOFF_BASE * 2^(failures - 1) seconds, capped at BACKOFF_MAX.
+BACKOFF_BASE = 30
+BACKOFF_MAX = 30 * 60
+
 
 # noinspection PyMethodMayBeStatic
 class LaMetric(commands.Cog):
@@ -43,7 +54,16 @@ class LaMetric(commands.Cog):
         self.bot = bot
         self._config = bot.config
 
-        self._api = LaMetricApi.LaMetricApi(loop=bot.loop)
+        self._api = LaMetricApi.LaMetricApi(bot.http_client.get_client("LaMetric", timeout=10))
+        self._scheduler = HuskyScheduler.get_scheduler()
+
+        # Push state, by device ID. Pending data is the latest value waiting to be sent, and sent data is the last value
+        # the device accepted (so unchanged values aren't sent again).
+        self.__pending_data__ = {}
+        self.__sent_data__ = {}
+        self.__last_push__ = {}
+        self.__failures__ = {}
+        self.__push_tasks__ = {}
 
         self._pending_registrations = {}
         '''
@@ -53,10 +73,79 @@ class LaMetric(commands.Cog):
 
         LOG.info("Loaded plugin!")
 
-    def __cleanup(self):
-        self._api.cleanup()
+    def cog_unload(self):
+        self._scheduler.cancel_owner(SCHEDULER_OWNER)
+
+        for task in self.__push_tasks__.values():
+            task.cancel()
+
+    def queue_push(self, device_id: str, data: dict):
+        """
+        Queue data to be pushed to a device. Only the latest queued data is ever sent, at most once per PUSH_INTERVAL
+        (or less often, if the device has been failing).
+
+        :param device_id: The registered device ID to push to.
+        :param data: The data to push (see LaMetricApi.build_data).
+        """
+        if self.__sent_data__.get(device_id) == data and device_id not in self.__pending_data__:
+            return
+
+        self.__pending_data__[device_id] = data
+
+        # A push in progress will schedule the next one itself once it's done.
+        if device_id in self.__push_tasks__ or self._scheduler.is_scheduled(SCHEDULER_OWNER, device_id):
+            return
+
+        self.__schedule_push(device_id)
+
+    def __schedule_push(self, device_id: str):
+        now = HuskyScheduler.get_current_time()
+        when = max(now, self.__last_push__.get(device_id, 0) + PUSH_INTERVAL)
+
+        failures = self.__failures__.get(device_id, 0)
+        if failures > 0:
+            when = max(when, self.__last_push__[device_id] + min(BACKOFF_BASE * (2 ** (failures - 1)), BACKOFF_MAX))
+
+        async def start_push():
+            # Pushes are tracked as their own task, so queue_push can tell a push is in progress.
+            self.__push_tasks__[device_id] = self.bot.loop.create_task(self.__push(device_id))
+
+        self._scheduler.schedule(SCHEDULER_OWNER, device_id, when, start_push)
+
+    async def __push(self, device_id: str):
+        data = self.__pending_data__.pop(device_id, None)
+        device = self._config.get('lametric', {}).get('devices', {}).get(device_id)
+
+        try:
+            if data is None or device is None or data == self.__sent_data__.get(device_id):
+                return
+
+            self.__last_push__[device_id] = HuskyScheduler.get_current_time()
+
+            try:
+                status = await self._api.push(device['appId'], data, device['authToken'])
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = None
+                LOG.warning(f"Could not push to LaMetric device ID {device_id}: {e!r}")
+
+            if status is not None and status < 400:
+                self.__failures__.pop(device_id, None)
+                self.__sent_data__[device_id] = data
+                return
+
+            failures = self.__failures__[device_id] = self.__failures__.get(device_id, 0) + 1
+            LOG.warning(f"Push to LaMetric device ID {device_id} failed (status {status}, {failures} failures in a "
+                        f"row). Backing off.")
+
+            # Retry with this data, unless something newer came in while we were pushing.
+            self.__pending_data__.setdefault(device_id, data)
+        finally:
+            self.__push_tasks__.pop(device_id, None)
+
+            if device_id in self.__pending_data__:
+                self.__schedule_push(device_id)
 
-    async def update_lametric_counts(self, guild: discord.Guild):
+    def update_lametric_counts(self, guild: discord.Guild):
         lametric_conf = self._config.get('lametric', {})
         devices = lametric_conf.setdefault('devices', {})
 
@@ -71,16 +160,15 @@ class LaMetric(commands.Cog):
             if "userCount" not in device.get("enabledTasks", []):
                 continue
 
-            LOG.info(f"Updating usercount for LaMetric device ID {device_id}")
-            await self._api.push(device['appId'], LaMetricApi.build_data(icon, new_count), device['authToken'])
+            self.queue_push(device_id, LaMetricApi.build_data(icon, new_count))
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
-        await self.update_lametric_counts(member.guild)
+        self.update_lametric_counts(member.guild)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
-        await self.update_lametric_counts(member.guild)
+        self.update_lametric_counts(member.guild)
 
     @commands.group(name="lametric", brief="Base command for LaMetric interfaces", hidden=True)
     async def lametric(self, ctx: commands.Context):
@@ -220,9 +308,9 @@ class LaMetric(commands.Cog):
             ]
         }
 
-        r = await self._api.push(device['appId'], data, device['authToken'])
+        status = await self._api.push(device['appId'], data, device['authToken'])
 
-        await ctx.send(f"Status code: {r.status}")
+        await ctx.send(f"Status code: {status}")
 
     @lametric.command(name="list", brief="List registered LaMetric devices")
     @HuskyChecks.has_guild_permissions(administrator=True)
@@ -1,17 +1,225 @@
+import datetime
 import logging
 
+import discord
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
+from libhusky import HuskyConfig, HuskyScheduler, HuskyUtils
+from libhusky.HuskyStatics import *
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
+SCHEDULER_OWNER = "Leaderboards"
+BOARDS_CONFIG_KEY = "boards"
+
+BOARDS = ["messages", "reactions"]
+WINDOWS = ["day", "week", "all"]
+GUILD_SCOPE = "guild"
+
+# How long (in seconds) counter changes may sit in memory before being written to leaderboards.json.
+FLUSH_DELAY = 60
+
+LEADERBOARD_SIZE = 10
+
+
+def get_window_keys(when: datetime.datetime) -> dict:
+    """
+    Get the storage key of every leaderboard window that a point in time falls into.
+    """
+    (iso_year, iso_week, _) = when.isocalendar()
+
+    return {
+        "day": f"day:{when.date().isoformat()}",
+        "week": f"week:{iso_year}-W{iso_week:02d}",
+        "all": "all"
+    }
+
 
 # noinspection PyMethodMayBeStatic
 class Leaderboards(commands.Cog):
-    def __init__(self):
-        raise Exception("Module borked. DISABLE ME.")
+    """
+    The Leaderboards plugin tracks which members are sending the most messages, and which members' messages are getting
+    the most reactions.
+
+    Leaderboards are kept per channel and for the whole guild, for the current day, the current week (both UTC), and
+    all time. Scores are counted live as messages and reactions come in, so looking at a leaderboard never needs to read
+    message history. This also means that activity from before the plugin was loaded isn't counted.
+    """
+
+    def __init__(self, bot: HuskyBot):
+        self.bot = bot
+        self._config = bot.config
+        self._leaderboard_config = HuskyConfig.get_config('leaderboards', create_if_nonexistent=True)
+        self._scheduler = HuskyScheduler.get_scheduler()
+
+        # Counters are stored as {board: {window_key: {scope: RankedCounter({user_id: score})}}}, where the scope is
+        # either a channel ID or GUILD_SCOPE.
+        self.__boards__ = {board: {} for board in BOARDS}
+        self.__load()
+
+        LOG.info("Loaded plugin!")
+
+    def cog_unload(self):
+        if self._scheduler.is_scheduled(SCHEDULER_OWNER, BOARDS_CONFIG_KEY):
+            self.__flush()
+
+        self._scheduler.cancel_owner(SCHEDULER_OWNER)
+
+    def __load(self):
+        for (board, windows) in self._leaderboard_config.get(BOARDS_CONFIG_KEY, {}).items():
+            if board not in self.__boards__:
+                continue
+
+            for (window_key, scopes) in windows.items():
+                self.__boards__[board][window_key] = {
+                    scope: HuskyUtils.RankedCounter({int(u): n for (u, n) in counts.items()})
+                    for (scope, counts) in scopes.items()
+                }
+
+        self.__prune_windows()
+
+    def __prune_windows(self):
+        # Only the current day and week are ever shown, so older windows are dropped.
+        current_keys = set(get_window_keys(datetime.datetime.utcnow()).values())
+
+        for windows in self.__boards__.values():
+            for window_key in [k for k in windows if k not in current_keys]:
+                del windows[window_key]
+
+    def __flush(self):
+        self.__prune_windows()
+
+        self._leaderboard_config.set(BOARDS_CONFIG_KEY, {
+            board: {
+                window_key: {
+                    scope: {str(u): n for (u, n) in counter.items()} for (scope, counter) in scopes.items()
+                } for (window_key, scopes) in windows.items()
+            } for (board, windows) in self.__boards__.items()
+        })
+
+    def __schedule_flush(self):
+        # Changes are batched, so a busy guild writes the store at most once per FLUSH_DELAY instead of per message.
+        if self._scheduler.is_scheduled(SCHEDULER_OWNER, BOARDS_CONFIG_KEY):
+            return
+
+        async def flush():
+            self.__flush()
+
+        self._scheduler.schedule(SCHEDULER_OWNER, BOARDS_CONFIG_KEY, HuskyScheduler.get_current_time() + FLUSH_DELAY,
+                                 flush)
+
+    def __count(self, board: str, channel_id: int, user_id: int, amount: int = 1):
+        for window_key in get_window_keys(datetime.datetime.utcnow()).values():
+            scopes = self.__boards__[board].setdefault(window_key, {})
+
+            for scope in (str(channel_id), GUILD_SCOPE):
+                counter = scopes.get(scope)
+
+                if counter is None:
+                    if amount < 0:
+                        continue
+
+                    counter = scopes[scope] = HuskyUtils.RankedCounter()
+
+                counter.add(user_id, amount)
+
+        self.__schedule_flush()
+
+    def get_leaderboard(self, board: str, window: str, channel: discord.TextChannel = None,
+                        count: int = LEADERBOARD_SIZE) -> list:
+        """
+        Get the top scores on a leaderboard.
+
+        :param board: The leaderboard to read (see BOARDS).
+        :param window: The time window to read (see WINDOWS).
+        :param channel: The channel to get scores for, or None for the whole guild.
+        :param count: The number of scores to get.
+        :return: Returns a list of (user_id, score) tuples, highest score first.
+        """
+        window_key = get_window_keys(datetime.datetime.utcnow())[window]
+        scope = str(channel.id) if channel is not None else GUILD_SCOPE
+
+        counter = self.__boards__[board].get(window_key, {}).get(scope)
+
+        if counter is None:
+            return []
+
+        return counter.top(count)
+
+    @commands.Cog.listener(name="on_message")
+    async def count_message(self, message: discord.Message):
+        if message.guild is None or message.author.bot:
+            return
+
+        self.__count("messages", message.channel.id, message.author.id)
+
+    # Reactions are scored to the author of the message, so only messages in discord.py's message cache (generally
+    # recent ones) can be counted without a fetch per reaction.
+    @commands.Cog.listener(name="on_reaction_add")
+    async def count_reaction(self, reaction: discord.Reaction, user: discord.User):
+        message = reaction.message  # type: discord.Message
+
+        if message.guild is None or message.author.bot or user.bot or user.id == message.author.id:
+            return
+
+        self.__count("reactions", message.channel.id, message.author.id)
+
+    @commands.Cog.listener(name="on_reaction_remove")
+    async def uncount_reaction(self, reaction: discord.Reaction, user: discord.User):
+        message = reaction.message  # type: discord.Message
+
+        if message.guild is None or message.author.bot or user.bot or user.id == message.author.id:
+            return
+
+        self.__count("reactions", message.channel.id, message.author.id, -1)
+
+    @commands.command(name="leaderboard", brief="Show the guild's most active members", aliases=["lb", "top"])
+    @commands.guild_only()
+    async def leaderboard(self, ctx: commands.Context, board: str = "messages", window: str = "week",
+                          channel: discord.TextChannel = None):
+        """
+        Leaderboards rank members by the number of messages they've sent, or by the number of reactions their messages
+        have received from other members. Bots and self-reactions are not counted.
+
+        Parameters
+        ----------
+            ctx      :: Discord context <!nodoc>
+            board    :: Either "messages" or "reactions". Default "messages".
+            window   :: Either "day", "week", or "all" (for all time). Days and weeks are in UTC. Default "week".
+            channel  :: A channel to show the leaderboard of. If not specified, the whole guild is ranked.
+
+        Examples
+        --------
+            /leaderboard                           :: Show this week's top message senders.
+            /leaderboard reactions all             :: Show the most reacted-to members of all time.
+            /leaderboard messages day #general     :: Show today's top message senders in #general.
+        """
+        board = board.lower()
+        window = window.lower()
+
+        if board not in BOARDS:
+            raise commands.BadArgument(f"The leaderboard must be one of: {', '.join(BOARDS)}.")
+
+        if window not in WINDOWS:
+            raise commands.BadArgument(f"The time window must be one of: {', '.join(WINDOWS)}.")
+
+        scores = self.get_leaderboard(board, window, channel)
+        window_name = {"day": "Today", "week": "This Week", "all": "All Time"}[window]
+
+        if not scores:
+            description = "Nobody is on this leaderboard yet."
+        else:
+            description = "\n".join(f"**{i + 1}.** <@{user_id}> - {score} {board}"
+                                    for (i, (user_id, score)) in enumerate(scores))
+
+        await ctx.send(embed=discord.Embed(
+            title=f"{Emojis.PARTY} {board.capitalize()} Leaderboard ({window_name})",
+            description=f"Showing the top members in {channel.mention if channel else ctx.guild.name}.\n\n"
+                        f"{description}",
+            color=Colors.INFO
+        ))
 
 
 def setup(bot: HuskyBot):
-    bot.add_cog(Leaderboards())
+    bot.add_cog(Leaderboards(bot))
@@ -1,11 +1,12 @@
-import json
+import hashlib
+import io
 import logging
 
-import aiohttp
 import discord
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
+from libhusky import HuskyHTTPClient
 from libhusky.HuskyStatics import *
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
@@ -17,13 +18,10 @@ class Math(commands.Cog):
         self.bot = bot
         self._config = bot.config
 
-        self._http_session = aiohttp.ClientSession(loop=bot.loop)
+        self._http_session = bot.http_client.get_client("Math", timeout=30)
 
         LOG.info("Loaded plugin!")
 
-    def cog_unload(self):
-        self.bot.loop.create_task(self._http_session.close())
-
     @commands.command(name="latex", brief="Generate and render some LaTeX code [EXPERIMENTAL]")
     @commands.cooldown(1, 10, commands.BucketType.user)
     async def render_tex(self, ctx: commands.Context, *, latex: str):
@@ -61,15 +59,25 @@ class Math(commands.Cog):
                         f"\\pagenumbering{{gobble}}\n" \
                         f" \\end{{document}}"
 
-        response = await self._http_session.post(api_url, data={
-            "code": latex_wrapped,
-            "format": "png"
-        })
+        async def render():
+            async with self._http_session.post(api_url, data={"code": latex_wrapped, "format": "png"}) as response:
+                response_data = await response.json(content_type=None)
+
+                # A failed render is returned with no image, so it's never cached.
+                if response.status != 200 or response_data.get('status') != 'success':
+                    return HuskyHTTPClient.CachedResponse(response.status, {}, b"")
+
+            # rtex only keeps renders around for a while, so the image itself is what gets cached.
+            async with self._http_session.get(api_url + "/" + response_data['filename']) as image:
+                return HuskyHTTPClient.CachedResponse(image.status, dict(image.headers), await image.read())
 
-        response_data = json.loads(await response.text())
-        was_successful = response.status == 200 and response_data.get('status') == 'success'
+        def is_rendered(resp: HuskyHTTPClient.CachedResponse):
+            return resp.status == 200 and len(resp.body) > 0
 
-        response.close()
+        # The same TeX always renders the same image, so renders are cached on disk.
+        cache_key = "latex:" + hashlib.sha256(latex_wrapped.encode('utf-8')).hexdigest()
+        rendered = await self._http_session.cached(cache_key, render, ttl=0, persist=True, cacheable=is_rendered)
+        was_successful = is_rendered(rendered)
 
         embed = discord.Embed(
             title="Rendered LaTeX",
@@ -79,7 +87,7 @@ class Math(commands.Cog):
         if was_successful:
             embed.set_footer(text="Rendered by rTEX API",
                              icon_url="http://rtex.probablyaweb.site/static/favicon.png")
-            embed.set_image(url=api_url + "/" + response_data['filename'])
+            embed.set_image(url="attachment://latex.png")
         else:
             embed.add_field(
                 name="Rendering Error",
@@ -87,7 +95,10 @@ class Math(commands.Cog):
                       "You may use [the online implementation](http://rtex.probablyaweb.site/) to try out your TeX "
                       "code.\n\nThe rendering service may also be offline or experiencing difficulties.")
 
-        await ctx.send(embed=embed)
+        if was_successful:
+            await ctx.send(embed=embed, file=discord.File(io.BytesIO(rendered.body), filename="latex.png"))
+        else:
+            await ctx.send(embed=embed)
 
 
 def setup(bot: HuskyBot):
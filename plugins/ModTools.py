@@ -1,4 +1,6 @@
+import asyncio
 import datetime
+import io
 import logging
 import re
 
@@ -9,10 +11,22 @@ from HuskyBot import HuskyBot
 from libhusky import HuskyConverters
 from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
+from libhusky.managers.BanManager import BanManager
 from libhusky.managers.MuteManager import MuteManager
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
+# How many bans a mass ban may have in flight at once, and how often (in seconds) it reports progress.
+MASS_BAN_WORKERS = 5
+MASS_BAN_PROGRESS_INTERVAL = 3
+
+# Discord refuses to bulk delete messages older than this.
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14)
+
+# How many full bulk delete batches /cleanup may find ahead of deleting them, and how often it reports progress.
+CLEANUP_QUEUE_SIZE = 5
+CLEANUP_PROGRESS_INTERVAL = 3
+
 
 # noinspection PyMethodMayBeStatic
 class ModTools(commands.Cog):
@@ -31,6 +45,7 @@ class ModTools(commands.Cog):
         self._session_store = self.bot.session_store
 
         self._mute_manager = MuteManager(self.bot)
+        self._ban_manager = BanManager(self.bot)
 
         LOG.info("Loaded plugin!")
 
@@ -167,9 +182,7 @@ class ModTools(commands.Cog):
             ))
             return
 
-        ban_entry = discord.utils.get(await ctx.guild.bans(), user=user)
-
-        if ban_entry is not None:
+        if await self._ban_manager.is_banned(ctx.guild, user):
             await ctx.send(embed=discord.Embed(
                 title="Moderator Toolkit",
                 description=f"How can one kill which is already dead? User `{user}` was already banned from the guild.",
@@ -177,8 +190,8 @@ class ModTools(commands.Cog):
             ))
             return
 
-        await ctx.guild.ban(user, reason=f"[{'HACKBAN | ' if not in_guild else ''}By {ctx.author}] {reason}",
-                            delete_message_days=1)
+        ban_reason = f"[{'HACKBAN | ' if not in_guild else ''}By {ctx.author}] {reason}"
+        await self._ban_manager.ban(ctx.guild, user, reason=ban_reason, delete_message_days=1)
 
         await ctx.send(embed=discord.Embed(
             title=Emojis.BAN + " User banned!",
@@ -454,6 +467,7 @@ class ModTools(commands.Cog):
 
             --[user|member|author] <user reference>  :: Filter by a specific user
             --[regex] <regex>                        :: Filter by a regular expression
+            --dryrun                                 :: Only count matching messages, don't delete anything
 
         If multiple filters of the same type are used, *any* will match to delete the message. For example, running
         "/cleanup 100 --user 123 --user 456" will delete all messages posted by users 123 and 456 that it finds in the
@@ -467,47 +481,203 @@ class ModTools(commands.Cog):
 
         The "lookback" value is the number of messages to search for messages that match the defined filters. If no
         filters are defined, then *all* messages match, and lookback will be the total number of messages to delete.
+
+        Messages are deleted in batches of 100 while the search is still running. Discord does not allow messages older
+        than 14 days to be deleted in batches, so those are deleted one at a time (which is much slower).
         """
 
         # BE VERY CAREFUL TOUCHING THIS METHOD!
-        def generate_cleanup_filter():
-            if filter_def is None:
-                return None
+        (check, dry_run) = self.__compile_cleanup_filter(ctx, filter_def)
+
+        progress = {"scanned": 0, "matched": 0, "deleted": 0, "failed": 0, "done": False}
+
+        status_message = await ctx.send(embed=self.__get_cleanup_embed(progress, dry_run))
+
+        # Anything older than this (with a minute of slack for slow batches) can't be bulk deleted.
+        bulk_cutoff = HuskyUtils.get_snowflake_for_time(datetime.datetime.utcnow() - BULK_DELETE_MAX_AGE
+                                                        + datetime.timedelta(minutes=1))
+
+        bulk_queue = asyncio.Queue(maxsize=CLEANUP_QUEUE_SIZE)
+        single_queue = asyncio.Queue()
+
+        async def bulk_worker():
+            while True:
+                batch = await bulk_queue.get()
+
+                if batch is None:
+                    return
+
+                try:
+                    await ctx.channel.delete_messages(batch)
+                    progress['deleted'] += len(batch)
+                except discord.HTTPException as e:
+                    LOG.warning(f"Couldn't bulk delete {len(batch)} messages in {ctx.channel}: {e}")
+                    progress['failed'] += len(batch)
+
+        async def single_worker():
+            # Old messages share the channel's delete rate limit bucket, so they go one at a time.
+            while True:
+                message = await single_queue.get()
+
+                if message is None:
+                    return
+
+                try:
+                    await message.delete()
+                    progress['deleted'] += 1
+                except discord.NotFound:
+                    pass
+                except discord.HTTPException as e:
+                    LOG.warning(f"Couldn't delete message {message.id} in {ctx.channel}: {e}")
+                    progress['failed'] += 1
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(CLEANUP_PROGRESS_INTERVAL)
+
+                try:
+                    await status_message.edit(embed=self.__get_cleanup_embed(progress, dry_run))
+                except discord.HTTPException:
+                    LOG.warning("Couldn't update cleanup progress message.")
+
+        workers = [] if dry_run else [self.bot.loop.create_task(bulk_worker()),
+                                      self.bot.loop.create_task(single_worker())]
+        progress_task = self.bot.loop.create_task(report_progress())
+
+        async def enqueue(queue: asyncio.Queue, item):
+            if not queue.full():
+                queue.put_nowait(item)
+                return
+
+            # Wait for room, but stop waiting if a worker dies - nothing would ever drain the queue.
+            put = self.bot.loop.create_task(queue.put(item))
+            await asyncio.wait([put] + workers, return_when=asyncio.FIRST_COMPLETED)
+
+            if not put.done():
+                put.cancel()
 
-            content_list = filter_def.split('--')
+                for worker in workers:
+                    if worker.done():
+                        worker.result()  # re-raise whatever killed it
 
-            # Filter types
-            regex_list = []
-            user_list = []
+                raise RuntimeError("A cleanup worker exited early.")
 
-            for filter_candidate in content_list:
-                if filter_candidate is None or filter_candidate == '':
+        try:
+            batch = []
+
+            async for message in ctx.channel.history(limit=lookback + 1, before=status_message):
+                progress['scanned'] += 1
+
+                if check is not None and not check(message):
                     continue
 
-                filter_candidate = filter_candidate.strip()
-                filter_candidate = filter_candidate.split(" ", 1)
+                progress['matched'] += 1
 
-                if filter_candidate[0] in ["user", "author", "member"]:
-                    user_id = HuskyUtils.get_user_id_from_arbitrary_str(ctx.guild, filter_candidate[1])
-                    user_list.append(user_id)
-                elif filter_candidate[0] in ["regex"]:
-                    regex_list.append(filter_candidate[1])
-                else:
-                    raise KeyError(f"Filter {filter_candidate[0]} is not valid!")
+                if dry_run:
+                    continue
+
+                if message.id < bulk_cutoff:
+                    await single_queue.put(message)
+                    continue
+
+                batch.append(message)
 
-            def dynamic_check(message: discord.Message):
-                if len(user_list) > 0 and message.author.id not in user_list:
-                    return False
+                if len(batch) >= 100:
+                    await enqueue(bulk_queue, batch)
+                    batch = []
 
-                for regex in regex_list:
-                    if len(regex_list) > 0 and re.search(regex, message.content) is None:
-                        return False
+            if batch and not dry_run:
+                await enqueue(bulk_queue, batch)
 
-                return True
+            if workers:
+                await enqueue(bulk_queue, None)
+                await enqueue(single_queue, None)
+                await asyncio.gather(*workers)
+        finally:
+            progress_task.cancel()
 
-            return dynamic_check
+            for worker in workers:
+                worker.cancel()
 
-        await ctx.channel.purge(limit=lookback + 1, check=generate_cleanup_filter(), bulk=True)
+        progress['done'] = True
+        await status_message.edit(embed=self.__get_cleanup_embed(progress, dry_run))
+
+    @staticmethod
+    def __compile_cleanup_filter(ctx: commands.Context, filter_def: str):
+        """
+        Build the message check for /cleanup once, up front.
+
+        :return: Returns a tuple of (check, dry_run), where check is None if all messages match.
+        """
+        if filter_def is None:
+            return None, False
+
+        content_list = filter_def.split('--')
+
+        # Filter types
+        regex_list = []
+        user_ids = set()
+        dry_run = False
+
+        for filter_candidate in content_list:
+            if filter_candidate is None or filter_candidate.strip() == '':
+                continue
+
+            filter_candidate = filter_candidate.strip()
+            filter_candidate = filter_candidate.split(" ", 1)
+
+            if filter_candidate[0] in ["dryrun", "dry-run"]:
+                dry_run = True
+                continue
+
+            if len(filter_candidate) < 2:
+                raise commands.BadArgument(f"Filter {filter_candidate[0]} needs a value!")
+
+            if filter_candidate[0] in ["user", "author", "member"]:
+                user_ids.add(HuskyUtils.get_user_id_from_arbitrary_str(ctx.guild, filter_candidate[1]))
+            elif filter_candidate[0] in ["regex"]:
+                try:
+                    regex_list.append(re.compile(filter_candidate[1]))
+                except re.error as e:
+                    raise commands.BadArgument(f"Regex `{filter_candidate[1]}` is not valid: {e}")
+            else:
+                raise KeyError(f"Filter {filter_candidate[0]} is not valid!")
+
+        if not user_ids and not regex_list:
+            return None, dry_run
+
+        def dynamic_check(message: discord.Message):
+            if user_ids and message.author.id not in user_ids:
+                return False
+
+            if regex_list and not all(regex.search(message.content) for regex in regex_list):
+                return False
+
+            return True
+
+        return dynamic_check, dry_run
+
+    @staticmethod
+    def __get_cleanup_embed(progress: dict, dry_run: bool) -> discord.Embed:
+        if dry_run:
+            return discord.Embed(
+                title="Cleanup Dry Run" + (" Complete" if progress['done'] else " Running"),
+                description=f"Searched {progress['scanned']} messages, and found {progress['matched']} messages that "
+                            f"would be deleted. Nothing was deleted.",
+                color=Colors.SUCCESS if progress['done'] else Colors.INFO
+            )
+
+        description = f"Searched {progress['scanned']} messages, and deleted {progress['deleted']} of " \
+                      f"{progress['matched']} matching messages."
+
+        if progress['failed']:
+            description += f" {progress['failed']} messages could not be deleted."
+
+        return discord.Embed(
+            title="Cleanup" + (" Complete" if progress['done'] else " Running"),
+            description=description,
+            color=(Colors.WARNING if progress['failed'] else Colors.SUCCESS) if progress['done'] else Colors.INFO
+        )
 
     @commands.command(name="editban", brief="Edit a banned user's reason")
     @commands.has_permissions(ban_members=True)
@@ -534,7 +704,7 @@ class ModTools(commands.Cog):
         # noinspection PyTypeChecker
         user: discord.User = user
 
-        ban_entry = discord.utils.get(await ctx.guild.bans(), user=user)
+        ban_entry = await self._ban_manager.get_ban(ctx.guild, user)
 
         if ban_entry is None:
             await ctx.send(embed=discord.Embed(
@@ -561,7 +731,8 @@ class ModTools(commands.Cog):
             reason = f"[Non-Bot Ban] {reason} (edited by {ctx.author})"
 
         await ctx.guild.unban(user, reason=f"Ban reason edit by {ctx.author}")
-        await ctx.guild.ban(user, reason=reason, delete_message_days=0)
+        self._ban_manager.record_unban(ctx.guild, user)
+        await self._ban_manager.ban(ctx.guild, user, reason=reason, delete_message_days=0)
 
         embed = discord.Embed(
             description=f"A ban reason change was requested by {ctx.author}.",
@@ -788,6 +959,9 @@ class ModTools(commands.Cog):
         """
         Massively ban a list of users programatically. This will delete the past day of message history for all users.
 
+        For very large lists, user IDs may also be uploaded as one or more text files attached to the command message.
+        IDs in files may be separated by spaces, commas, or new lines.
+
         Parameters
         ----------
             ctx     :: Discord context <!nodoc>
@@ -797,32 +971,114 @@ class ModTools(commands.Cog):
         Examples
         --------
             /mban "bot accounts" 123 345 SomeUser
+            /mban "raid" (with an attached ids.txt)
 
         """
         report = {"succeeded": [], "failed": []}
-        converter = HuskyConverters.OfflineMemberConverter()
 
-        for user_selector in users:
+        selectors = list(users)
+        for attachment in ctx.message.attachments:  # type: discord.Attachment
             try:
-                user = await converter.convert(ctx, user_selector)
+                selectors.extend(re.split(r'[\s,]+', (await attachment.read()).decode('utf-8', 'ignore')))
+            except discord.HTTPException:
+                report['failed'].append(f"{attachment.filename} - ATTACHMENT_UNREADABLE")
+
+        # Drop blanks and duplicates, but keep the given order.
+        selectors = list(dict.fromkeys(s for s in selectors if s))
+
+        targets = await self.__resolve_mass_ban_targets(ctx, selectors, report)
 
-                if user == ctx.author:
-                    raise discord.DiscordException("IS_SELF")
+        status_message = await ctx.send(embed=self.__get_mass_ban_embed(report, len(targets), in_progress=True))
+        queue = asyncio.Queue()
 
-                if user == ctx.bot.user:
-                    raise discord.DiscordException("IS_BOT")
+        for target in targets:
+            queue.put_nowait(target)
 
+        async def ban_worker():
+            while not queue.empty():
+                (user_selector, user) = queue.get_nowait()
                 is_trueban = isinstance(user, discord.Member)
-                if is_trueban and (user.top_role.position >= ctx.message.author.top_role.position):
-                    raise discord.DiscordException("IS_ABOVE_USER")
-
-                ban_prefix = f"[{'HACKBAN | ' if not is_trueban else ''}MASSBAN | By {ctx.author}] "
-                await ctx.guild.ban(user, reason=ban_prefix + reason, delete_message_days=1)
-                report['succeeded'].append(user_selector)
-            except discord.DiscordException as e:
-                report['failed'].append(f"{user_selector} - {''.join(e.args) if e.args else 'OTHER_ERR'}")
-                LOG.error("Massban Error", e)
+
+                try:
+                    ban_reason = f"[{'HACKBAN | ' if not is_trueban else ''}MASSBAN | By {ctx.author}] {reason}"
+                    await self._ban_manager.ban(ctx.guild, user, reason=ban_reason, delete_message_days=1)
+                    report['succeeded'].append(user_selector)
+                except discord.DiscordException as e:
+                    report['failed'].append(f"{user_selector} - {''.join(e.args) if e.args else 'OTHER_ERR'}")
+                    LOG.error(f"Massban error for {user_selector}: {e}")
+
+        # discord.py serializes requests on the ban route's rate limit bucket for us, the pool just keeps the bucket
+        # busy instead of waiting on one round trip at a time.
+        workers = [self.bot.loop.create_task(ban_worker()) for _ in range(min(MASS_BAN_WORKERS, len(targets)))]
+        progress_task = self.bot.loop.create_task(self.__report_mass_ban_progress(status_message, report, len(targets)))
+
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            progress_task.cancel()
+
+        await status_message.edit(embed=self.__get_mass_ban_embed(report, len(targets)))
+
+        if len(report['failed']) >= 5:
+            buf = io.BytesIO("\n".join(report['failed']).encode('utf-8'))
+            await ctx.send("The full list of failed bans is attached.", file=discord.File(buf, "failed_bans.txt"))
+
+    async def __resolve_mass_ban_targets(self, ctx: commands.Context, selectors: list, report: dict) -> list:
+        """
+        Resolve mass ban selectors to banable targets. IDs are resolved from the cache where possible, and otherwise
+        banned as a bare ID (Discord will reject any that don't exist), so this never hits the API per user.
+        """
+        converter = commands.MemberConverter()
+        known_bans = self._ban_manager.is_loaded(ctx.guild)
+        targets = []
+        seen_ids = set()
+
+        for user_selector in selectors:
+            match = re.match(r'(?:<@!?)?([0-9]{15,21})>?$', user_selector)
+
+            try:
+                if match is not None:
+                    user_id = int(match.group(1))
+                    user = ctx.guild.get_member(user_id) or self.bot.get_user(user_id) or discord.Object(id=user_id)
+                else:
+                    user = await converter.convert(ctx, user_selector)
+            except commands.BadArgument:
+                report['failed'].append(f"{user_selector} - NOT_FOUND")
+                continue
+
+            if user.id in seen_ids:
                 continue
+            seen_ids.add(user.id)
+
+            if user.id == ctx.author.id:
+                report['failed'].append(f"{user_selector} - IS_SELF")
+                continue
+
+            if user.id == ctx.bot.user.id:
+                report['failed'].append(f"{user_selector} - IS_BOT")
+                continue
+
+            if isinstance(user, discord.Member) and (user.top_role.position >= ctx.author.top_role.position):
+                report['failed'].append(f"{user_selector} - IS_ABOVE_USER")
+                continue
+
+            if known_bans and await self._ban_manager.is_banned(ctx.guild, user):
+                report['failed'].append(f"{user_selector} - ALREADY_BANNED")
+                continue
+
+            targets.append((user_selector, user))
+
+        return targets
+
+    @staticmethod
+    def __get_mass_ban_embed(report: dict, total: int, in_progress: bool = False) -> discord.Embed:
+        if in_progress:
+            return discord.Embed(
+                title="Mass Ban In Progress",
+                description=f"Banned {len(report['succeeded'])} of {total} users so far.\n"
+                f"{len(report['failed'])} failed to ban. Nonexistent user or other error.",
+                color=Colors.WARNING
+            )
 
         embed = discord.Embed(
             title="Mass Ban Report",
@@ -834,7 +1090,16 @@ class ModTools(commands.Cog):
         if 0 < len(report['failed']) < 5:
             embed.add_field(name="Failed Bans", value="\n".join(report['failed']))
 
-        await ctx.send(embed=embed)
+        return embed
+
+    async def __report_mass_ban_progress(self, status_message: discord.Message, report: dict, total: int):
+        while True:
+            await asyncio.sleep(MASS_BAN_PROGRESS_INTERVAL)
+
+            try:
+                await status_message.edit(embed=self.__get_mass_ban_embed(report, total, in_progress=True))
+            except discord.HTTPException:
+                LOG.warning("Couldn't update mass ban progress message.")
 
 
 def setup(bot: HuskyBot):
@@ -1,14 +1,27 @@
+import asyncio
+import collections
 import logging
 
 import discord
 from discord.ext import commands
 
 from HuskyBot import HuskyBot
-from libhusky import HuskyUtils, HuskyConverters
+from libhusky import HuskyConverters, HuskyScheduler, HuskyUtils
 from libhusky.HuskyStatics import *
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
+SCHEDULER_OWNER = "ReactToPin"
+
+# How many messages to keep reaction counts for. Older entries are refetched if they get reactions again.
+MESSAGE_CACHE_SIZE = 1000
+
+# How often (in seconds) to throw away all cached state and refetch it from Discord, in case we missed an event.
+RECONCILE_INTERVAL = 60 * 30
+
+# How long (in seconds) to collect reactions on a message before deciding whether to pin or unpin it.
+REACTION_DEBOUNCE = 2
+
 
 class ReactToPin(commands.Cog):
     """
@@ -43,9 +56,51 @@ class ReactToPin(commands.Cog):
         """
         self.bot = bot
         self._config = bot.config
+        self._scheduler = HuskyScheduler.get_scheduler()
+
+        # Pinned messages per channel ID, newest first (the same order as channel.pins()).
+        self.__pin_cache__ = {}
+
+        # Pin updates we caused ourselves, per channel ID. These don't invalidate the pin cache.
+        self.__expected_pin_updates__ = collections.Counter()
+
+        # Per-message state ({"message": discord.Message, "emoji": str, "count": int}), in LRU order.
+        self.__message_cache__ = collections.OrderedDict()
+
+        # Message IDs whose queued check includes at least one reaction removal. Only removals may unpin a message, so
+        # a single reaction on a message staff pinned by hand can't unpin it.
+        self.__pending_removals__ = set()
+
+        # Serializes pin/unpin decisions per channel ID, so smart unpin can't free up more than one slot per pin.
+        self.__channel_locks__ = collections.defaultdict(asyncio.Lock)
+
+        self.__schedule_reconcile()
 
         LOG.info("Loaded plugin!")
 
+    def cog_unload(self):
+        self._scheduler.cancel_owner(SCHEDULER_OWNER)
+
+    def __schedule_reconcile(self):
+        async def reconcile():
+            LOG.debug("Reconciling ReactToPin caches.")
+            self.__pin_cache__.clear()
+            self.__message_cache__.clear()
+            self.__expected_pin_updates__.clear()
+
+            self.__schedule_reconcile()
+
+        self._scheduler.schedule(SCHEDULER_OWNER, "reconcile", HuskyScheduler.get_current_time() + RECONCILE_INTERVAL,
+                                 reconcile)
+
+    def get_channel_config(self, channel_id: int):
+        channel_config = self._config.get('reactToPin', {}).get(str(channel_id))  # type: dict
+
+        if channel_config is None or not channel_config.get('enabled', False):
+            return None
+
+        return channel_config
+
     async def count_reactions(self, message: discord.Message, emoji: discord.PartialEmoji):
         count = 0
 
@@ -64,10 +119,74 @@ class ReactToPin(commands.Cog):
         LOG.debug(f"Message {message.id} has {count} reactions of type {emoji} on it.")
         return count
 
+    async def get_pins(self, channel: discord.TextChannel) -> list:
+        """
+        Get the pinned messages of a channel, newest first. Only hits Discord if the channel isn't cached.
+        """
+        pins = self.__pin_cache__.get(channel.id)
+
+        if pins is None:
+            pins = await channel.pins()
+            self.__pin_cache__[channel.id] = pins
+
+        return pins
+
+    async def __get_message_state(self, channel: discord.TextChannel, message_id: int, emoji):
+        """
+        Get the cached reaction state of a message, fetching it from Discord if it isn't known yet.
+        """
+        state = self.__message_cache__.get(message_id)
+
+        # Counts are only valid for the emoji they were made with, so the pin emoji changing invalidates them.
+        if state is not None and state['emoji'] == str(emoji):
+            self.__message_cache__.move_to_end(message_id)
+            return state
+
+        message = await channel.fetch_message(message_id)  # type: discord.Message
+
+        state = {"message": message, "emoji": str(emoji), "count": await self.count_reactions(message, emoji)}
+        self.__message_cache__[message_id] = state
+
+        while len(self.__message_cache__) > MESSAGE_CACHE_SIZE:
+            self.__message_cache__.popitem(last=False)
+
+        return state
+
+    def __is_counted(self, state: dict, user_id: int):
+        return user_id != self.bot.user.id and user_id != state['message'].author.id
+
+    async def __pin(self, message: discord.Message):
+        self.__expected_pin_updates__[message.channel.id] += 1
+
+        try:
+            await message.pin()
+        except discord.HTTPException:
+            # No pin update is coming for a failed call, so it mustn't swallow the next real one.
+            self.__expected_pin_updates__[message.channel.id] -= 1
+            raise
+
+        pins = self.__pin_cache__.get(message.channel.id)
+        if pins is not None:
+            pins.insert(0, message)
+
+    async def __unpin(self, message: discord.Message):
+        self.__expected_pin_updates__[message.channel.id] += 1
+
+        try:
+            await message.unpin()
+        except discord.HTTPException:
+            # No pin update is coming for a failed call, so it mustn't swallow the next real one.
+            self.__expected_pin_updates__[message.channel.id] -= 1
+            raise
+
+        pins = self.__pin_cache__.get(message.channel.id)
+        if pins is not None:
+            self.__pin_cache__[message.channel.id] = [m for m in pins if m.id != message.id]
+
     async def smart_unpin_oldest(self, channel: discord.TextChannel):
         persistent_pinned_messages = self._config.get('reactToPin', {}).get(str(channel.id), {}).get('permanent', [])
 
-        pin_list = reversed(await channel.pins())
+        pin_list = reversed(await self.get_pins(channel))
 
         for item in pin_list:  # type: discord.Message
             if item.id in persistent_pinned_messages:
@@ -75,120 +194,195 @@ class ReactToPin(commands.Cog):
 
             # we have something we can unpin, go ahead and do it, and then break
             LOG.info(f"Unpinned message ID {item.id} from channel {channel} using SmartUnpin")
-            await item.unpin()
+            await self.__unpin(item)
             return
 
         raise EOFError("No messages are eligible to be unpinned!")
 
+    @commands.Cog.listener()
+    async def on_guild_channel_pins_update(self, channel: discord.abc.GuildChannel, last_pin):
+        if self.__expected_pin_updates__[channel.id] > 0:
+            # We made this change ourselves, and the cache already reflects it.
+            self.__expected_pin_updates__[channel.id] -= 1
+            return
+
+        self.__pin_cache__.pop(channel.id, None)
+
+    @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        channel = self.bot.get_channel(payload.channel_id)  # type: discord.TextChannel
-        message = await channel.fetch_message(payload.message_id)  # type: discord.Message
+        await self.__handle_reaction_event(payload, 1)
 
-        channel_config = self._config.get('reactToPin', {}).get(str(channel.id))  # type: dict
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        await self.__handle_reaction_event(payload, -1)
+
+    async def __handle_reaction_event(self, payload: discord.RawReactionActionEvent, delta: int):
+        channel_config = self.get_channel_config(payload.channel_id)
 
         LOG.debug("Got react event, processing.")
 
-        if not HuskyUtils.should_process_message(message):
+        if channel_config is None:
+            LOG.debug(f"A pin configuration was not found for channel {payload.channel_id}. Ignoring message.")
             return
 
-        if channel_config is None or not channel_config.get('enabled', False):
-            LOG.debug(f"A pin configuration was not found for channel {channel}. Ignoring message.")
+        if str(payload.emoji) != channel_config.get('emoji'):
+            LOG.debug(f"Got an invalid emoji for message {payload.message_id} in channel {payload.channel_id}, "
+                      f"ignoring.")
             return
 
-        # Check if the message is pinned
-        if message in await channel.pins():
-            LOG.debug("Can't repin an already-pinned message.")
+        # Uncached messages are counted from scratch when they're evaluated, which will include this event.
+        state = self.__message_cache__.get(payload.message_id)
+        if state is not None and state['emoji'] == str(payload.emoji) and self.__is_counted(state, payload.user_id):
+            state['count'] = max(state['count'] + delta, 0)
+
+        if delta < 0:
+            self.__pending_removals__.add(payload.message_id)
+
+        self.__queue_evaluation(payload.channel_id, payload.message_id)
+
+    def __queue_evaluation(self, channel_id: int, message_id: int):
+        """
+        Queue a pin check for a message. All reaction events for the message within the debounce window are collapsed
+        into this one check, so a burst of reactions only evaluates the message (and hits Discord) once.
+
+        The scheduler runs each check in its own task, so a check waiting on its channel lock or on Discord never holds
+        up checks in other channels, or other scheduled jobs (mute expiries, giveaway ends).
+        """
+        key = ("evaluate", message_id)
+
+        # Don't push back an already queued check, or a steady stream of reactions would keep delaying it forever.
+        if self._scheduler.is_scheduled(SCHEDULER_OWNER, key):
             return
 
-        if str(payload.emoji) != channel_config.get('emoji'):
-            LOG.debug(f"Got an invalid emoji for message {message.id} in channel {channel}, ignoring.")
+        async def evaluate():
+            await self.evaluate_message(channel_id, message_id)
+
+        self._scheduler.schedule(SCHEDULER_OWNER, key, HuskyScheduler.get_current_time() + REACTION_DEBOUNCE,
+                                 evaluate)
+
+    async def evaluate_message(self, channel_id: int, message_id: int):
+        """
+        Pin or unpin a message based on its current reaction count. Messages are only ever unpinned if the reactions
+        that triggered this check included a removal.
+
+        Only one message per channel is evaluated at a time, so concurrent checks can't race each other to pin the
+        same message or to free up pin slots.
+        """
+        # Removals that come in from here on queue a new check, and are counted for that one instead.
+        had_removal = message_id in self.__pending_removals__
+        self.__pending_removals__.discard(message_id)
+
+        channel_config = self.get_channel_config(channel_id)
+
+        if channel_config is None:
             return
 
-        # we are in a valid channel now, with a valid emote.
-        current_reactions = await self.count_reactions(message, payload.emoji)
+        channel = self.bot.get_channel(channel_id)  # type: discord.TextChannel
 
-        if current_reactions < channel_config.get('requiredToPin', 6):
-            LOG.debug("Got a valid emote reaction, but still below pin threshold. Ignoring (for now).")
+        if channel is None:
             return
 
-        if len(await channel.pins()) >= 50:
-            LOG.debug("Too many pins in the current channel, removing oldest one using smart unpin.")
+        async with self.__channel_locks__[channel_id]:
             try:
-                await self.smart_unpin_oldest(channel)
-            except EOFError:
-                dev_id = self._config.get("specialRoles", {}).get(SpecialRoleKeys.BOT_DEVS.value)
+                state = await self.__get_message_state(channel, message_id, channel_config.get('emoji'))
+            except discord.NotFound:
+                LOG.debug(f"Message {message_id} was deleted before it could be evaluated. Ignoring.")
+                return
+
+            message = state['message']  # type: discord.Message
+
+            if not HuskyUtils.should_process_message(message):
+                return
+
+            pins = await self.get_pins(channel)
+            required = channel_config.get('requiredToPin', 6)
 
-                if dev_id is None:
-                    dev_ping = "Please contact a staff member to investigate."
-                else:
-                    dev_ping = f"Please investigate, <@&{dev_id}>"
+            if any(m.id == message.id for m in pins):
+                if not had_removal:
+                    LOG.debug("Can't repin an already-pinned message.")
+                    return
 
-                await channel.send(f"I tried to pin a message, but there aren't any pins that I'm allowed to remove. "
-                                   f"{dev_ping}")
-                LOG.warning("Couldn't unpin any messages with smart unpin! Aborting.")
+                if message.id in channel_config.get('permanent', []):
+                    LOG.debug("Ignoring reactions on permanently pinned message.")
+                    return
 
+                if state['count'] >= required:
+                    LOG.debug("Message is pinned and still at the required reaction count.")
+                    return
+
+                await self.__unpin(message)
+                LOG.info(f"Unpinned previously pinned message {message.id} in {channel}, as it is no longer at the "
+                         f"required reaction count.")
                 return
 
-        await message.pin()
-        LOG.info(f"Pinned message {message.id} in {channel}, as it got enough reactions.")
+            # we are in a valid channel now, with a valid emote.
+            if state['count'] < required:
+                LOG.debug("Got a valid emote reaction, but still below pin threshold. Ignoring (for now).")
+                return
 
-    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
-        channel = self.bot.get_channel(payload.channel_id)  # type: discord.TextChannel
-        message = await channel.fetch_message(payload.message_id)  # type: discord.Message
+            if len(pins) >= 50:
+                LOG.debug("Too many pins in the current channel, removing oldest one using smart unpin.")
+                try:
+                    await self.smart_unpin_oldest(channel)
+                except EOFError:
+                    dev_id = self._config.get("specialRoles", {}).get(SpecialRoleKeys.BOT_DEVS.value)
 
-        channel_config = self._config.get('reactToPin', {}).get(str(channel.id))  # type: dict
+                    if dev_id is None:
+                        dev_ping = "Please contact a staff member to investigate."
+                    else:
+                        dev_ping = f"Please investigate, <@&{dev_id}>"
 
-        if not HuskyUtils.should_process_message(message):
-            return
+                    await channel.send(f"I tried to pin a message, but there aren't any pins that I'm allowed to "
+                                       f"remove. {dev_ping}")
+                    LOG.warning("Couldn't unpin any messages with smart unpin! Aborting.")
 
-        if channel_config is None or not channel_config.get('enabled', False):
-            LOG.debug(f"A pin configuration was not found for channel {channel}. Ignoring message.")
-            return
+                    return
 
-        # Check if the message is pinned
-        if message not in await channel.pins():
-            LOG.debug("Can't unpin a message that isn't currently pinned.")
-            return
+            await self.__pin(message)
+            LOG.info(f"Pinned message {message.id} in {channel}, as it got enough reactions.")
 
-        if str(payload.emoji) != channel_config.get('emoji'):
-            LOG.debug(f"Got an invalid emoji for message {message.id} in channel {channel}, ignoring.")
-            return
+    async def __handle_reaction_clear(self, channel_id: int, message_id: int):
+        channel_config = self.get_channel_config(channel_id)
 
-        if message.id in channel_config.get('permanent', []):
-            LOG.info("Reactions dropped below threshold on permanently pinned message, ignoring but logging.")
+        if channel_config is None:
             return
 
-        # we are in a valid channel now, with a valid emote.
-        current_reactions = await self.count_reactions(message, payload.emoji)
+        state = self.__message_cache__.get(message_id)
+        if state is not None:
+            state['count'] = 0
 
-        if current_reactions >= channel_config.get('requiredToPin', 6):
-            LOG.debug("Got a valid removal event for the emote, but there are too many reactions to unpin.")
+        if message_id in channel_config.get('permanent', []):
+            LOG.info("Reactions were cleared on a permanently pinned message, ignoring.")
             return
 
-        await message.unpin()
-        LOG.info(f"Unpinned previously pinned message {message.id} in {channel}, as it is no longer at the required "
-                 f"reaction count.")
+        channel = self.bot.get_channel(channel_id)  # type: discord.TextChannel
 
-    async def on_raw_reaction_clear(self, event: discord.RawReactionClearEvent):
-        channel = self.bot.get_channel(event.channel_id)  # type: discord.TextChannel
-        message = await channel.fetch_message(event.message_id)  # type: discord.Message
+        async with self.__channel_locks__[channel_id]:
+            # Check if the message is pinned
+            message = discord.utils.get(await self.get_pins(channel), id=message_id)
+            if message is None:
+                LOG.debug("Can't unpin a message that isn't currently pinned.")
+                return
 
-        channel_config = self._config.get('reactToPin', {}).get(str(channel.id))  # type: dict
+            if not HuskyUtils.should_process_message(message):
+                return
 
-        if not HuskyUtils.should_process_message(message):
-            return
+            await self.__unpin(message)
 
-        if message.id in channel_config.get('permanent', []):
-            LOG.info("Reactions were cleared on a permanently pinned message, ignoring.")
-            return
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, event: discord.RawReactionClearEvent):
+        await self.__handle_reaction_clear(event.channel_id, event.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, event):
+        channel_config = self.get_channel_config(event.channel_id)
 
-        # Check if the message is pinned
-        if message not in await channel.pins():
-            LOG.debug("Can't unpin a message that isn't currently pinned.")
+        if channel_config is None or str(event.emoji) != channel_config.get('emoji'):
             return
 
-        await message.unpin()
+        await self.__handle_reaction_clear(event.channel_id, event.message_id)
 
+    @commands.Cog.listener()
     async def on_raw_message_edit(self, event: discord.RawMessageUpdateEvent):
         message_id = event.message_id
         channel_id = event.data.get('channel_id', None)
@@ -211,10 +405,13 @@ class ReactToPin(commands.Cog):
 
         self._config.set('reactToPin', plugin_config)
 
+    @commands.Cog.listener()
     async def on_raw_message_delete(self, event: discord.RawMessageDeleteEvent):
         message_id = event.message_id
         channel_id = event.channel_id
 
+        self.__message_cache__.pop(message_id, None)
+
         plugin_config = self._config.get('reactToPin', {})  # type: dict
         channel_config = plugin_config.get(str(channel_id), {})
         permapinned = channel_config.setdefault('permanent', [])
@@ -228,9 +425,13 @@ class ReactToPin(commands.Cog):
 
         self._config.set('reactToPin', plugin_config)
 
+    @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, event: discord.RawBulkMessageDeleteEvent):
         channel_id = event.channel_id
 
+        for message_id in event.message_ids:
+            self.__message_cache__.pop(message_id, None)
+
         plugin_config = self._config.get('reactToPin', {})  # type: dict
         channel_config = plugin_config.get(str(channel_id), {})
         permapinned = channel_config.setdefault('permanent', [])
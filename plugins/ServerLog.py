@@ -7,6 +7,7 @@ from discord.ext import commands
 from HuskyBot import HuskyBot
 from libhusky import HuskyUtils
 from libhusky.HuskyStatics import *
+from libhusky.managers.BanManager import BanManager
 
 LOG = logging.getLogger("HuskyBot.Plugin." + __name__)
 
@@ -20,6 +21,10 @@ class ServerLog(commands.Cog):
         self.bot = bot
         self._config = bot.config
         self._session_store = self.bot.session_store
+        self._ban_manager = BanManager(self.bot)
+
+        # Join order of every guild's members, built on first use. See get_join_index.
+        self.__join_indexes__ = {}
 
         LOG.info("Loaded plugin!")
 
@@ -31,6 +36,34 @@ class ServerLog(commands.Cog):
                               "messageDelete", "messageDelete.logIntegrity",
                               "messageEdit"]
 
+    def get_join_index(self, guild: discord.Guild) -> HuskyUtils.JoinOrderIndex:
+        index = self.__join_indexes__.get(guild.id)
+
+        if index is None:
+            index = HuskyUtils.JoinOrderIndex(guild.members)
+            self.__join_indexes__[guild.id] = index
+
+        return index
+
+    @commands.Cog.listener(name="on_ready")
+    async def reset_join_indexes(self):
+        # The member cache is rebuilt after a (re)connect, so our indexes may have missed joins and leaves.
+        self.__join_indexes__.clear()
+
+    @commands.Cog.listener(name="on_member_join")
+    async def track_join_order(self, member: discord.Member):
+        index = self.__join_indexes__.get(member.guild.id)
+
+        if index is not None:
+            index.add(member)
+
+    @commands.Cog.listener(name="on_member_remove")
+    async def untrack_join_order(self, member: discord.Member):
+        index = self.__join_indexes__.get(member.guild.id)
+
+        if index is not None:
+            index.remove(member)
+
     @commands.Cog.listener(name="on_member_join")
     async def user_milestone_logger(self, member: discord.Member):
         if "userJoin.milestones" not in self._config.get("loggers", {}).keys():
@@ -76,7 +109,11 @@ class ServerLog(commands.Cog):
         embed.add_field(name="Joined Guild", value=member.joined_at.strftime(DATETIME_FORMAT), inline=True)
         embed.add_field(name="User ID", value=member.id, inline=True)
 
-        member_num = sorted(member.guild.members, key=lambda m: m.joined_at).index(member) + 1
+        # Listeners run in no set order, so make sure this member is indexed already.
+        join_index = self.get_join_index(member.guild)
+        join_index.add(member)
+
+        member_num = join_index.get_rank(member)
         embed.set_footer(text=f"Member #{member_num} on the guild")
 
         LOG.info(f"User {member} ({member.id}) has joined {member.guild.name}.")
@@ -145,7 +182,9 @@ class ServerLog(commands.Cog):
             color=Colors.DANGER
         )
 
-        ban_entry = discord.utils.get(await guild.bans(), user=user)
+        # The ban may be newer than our index (listeners run in no set order), so a miss is confirmed with Discord. Bans
+        # made through the bot are already known, and any lookup is shared with the BanManager's own listener.
+        ban_entry = await self._ban_manager.get_ban(guild, user, trust_index=False)
 
         if ban_entry is None:
             raise ValueError(f"A ban record for user {user.id} was expected, but no entry was found")
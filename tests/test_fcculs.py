@@ -0,0 +1,112 @@
+import datetime
+import zipfile
+
+import pytest
+
+from libhusky.apis import FCCULS
+
+DUMP_DATE = datetime.date(2024, 4, 7)
+
+
+def build_dump(path, records: dict, counts: str = None) -> str:
+    """
+    Write a small ULS-format dump, from {record_type: [{field_index: value}]}.
+    """
+    with zipfile.ZipFile(str(path), 'w') as archive:
+        for (record_type, rows) in records.items():
+            width = max(FCCULS.RECORD_FIELDS[record_type].values()) + 1
+            lines = []
+
+            for row in rows:
+                parts = [""] * width
+                parts[0] = record_type
+
+                for (index, value) in row.items():
+                    parts[index] = value
+
+                lines.append("|".join(parts))
+
+            archive.writestr(f"{record_type}.dat", "\r\n".join(lines) + "\r\n")
+
+        if counts is not None:
+            archive.writestr("counts", counts)
+
+    return str(path)
+
+
+@pytest.fixture
+def full_dump(tmp_path):
+    return build_dump(tmp_path / "l_amat.zip", {
+        "HD": [{1: "1001", 4: "W1AW", 5: "A", 7: "01/02/2015", 8: "01/02/2025"},
+               {1: "1002", 4: "K1ABC", 5: "A", 7: "03/04/2016", 8: "03/04/2026"},
+               {1: "1003", 4: "N0OLD", 5: "C", 7: "05/06/2000", 8: "05/06/2010"}],
+        "EN": [{1: "1001", 5: "L", 7: "ARRL INC", 16: "NEWINGTON", 17: "CT", 18: "06111", 23: "B"},
+               {1: "1002", 5: "L", 8: "JANE", 10: "DOE", 16: "HARTFORD", 17: "CT", 23: "I"},
+               {1: "1002", 5: "CL", 7: "NOT THE LICENSEE"}],
+        "AM": [{1: "1001", 8: "K1ABC"},
+               {1: "1002", 5: "G"}]
+    }, counts="File Creation Date: Sun Apr  7 04:13:58 EDT 2024\n      3 HD.dat\n")
+
+
+@pytest.fixture
+def database(tmp_path, full_dump):
+    database = FCCULS.CallsignDatabase(str(tmp_path / "uls.db"))
+    assert database.import_full(full_dump) == 3
+
+    yield database
+
+    database.close()
+
+
+def test_dump_date_comes_from_counts_file(full_dump):
+    assert FCCULS.get_dump_date(full_dump) == DUMP_DATE
+
+
+def test_lookup_club_license(database):
+    w1aw = database.lookup("w1aw")
+
+    assert w1aw["name"] == "ARRL INC"
+    assert w1aw["type"] == "CLUB"
+    assert w1aw["trustee"] == {"callsign": "K1ABC", "name": "JANE DOE"}
+    assert w1aw["address"]["line2"] == "NEWINGTON, CT 06111"
+
+
+def test_lookup_individual_license(database):
+    k1abc = database.lookup("K1ABC")
+
+    assert k1abc["name"] == "JANE DOE"
+    assert k1abc["current"]["operClass"] == "GENERAL"
+
+
+def test_cancelled_licenses_are_not_returned(database):
+    assert database.lookup("N0OLD") is None
+
+
+def test_search_by_name(database):
+    assert [r[0] for r in database.search_name("doe")] == ["K1ABC"]
+
+
+def test_deltas_are_replayed_from_the_dump_date(database):
+    # The dump was made on the 7th, so every day from the 7th on still needs its daily file.
+    assert database.get_meta("lastDeltaDate") == "2024-04-06"
+    assert database.get_pending_deltas(datetime.date(2024, 4, 10)) == \
+        [datetime.date(2024, 4, 7), datetime.date(2024, 4, 8), datetime.date(2024, 4, 9)]
+
+
+def test_too_many_missed_deltas_need_a_full_import(database):
+    assert database.get_pending_deltas(DUMP_DATE + datetime.timedelta(days=FCCULS.MAX_DELTA_DAYS + 1)) is None
+
+
+def test_partial_delta_keeps_the_rest_of_the_license(tmp_path, database):
+    delta_path = build_dump(tmp_path / "l_am_mon.zip", {
+        "HD": [{1: "1002", 4: "K1ABC", 5: "A", 7: "03/04/2016", 8: "03/04/2026"}],
+        "AM": [{1: "1002", 5: "E"}]
+    })
+
+    assert database.import_delta(delta_path, datetime.date(2024, 4, 8)) == 1
+    database.reopen()
+
+    k1abc = database.lookup("K1ABC")
+    assert k1abc["name"] == "JANE DOE"
+    assert k1abc["current"]["operClass"] == "EXTRA"
+    assert database.get_pending_deltas(datetime.date(2024, 4, 10)) == [datetime.date(2024, 4, 9)]
@@ -0,0 +1,84 @@
+import asyncio
+import math
+import random
+
+import pytest
+
+from libhusky.managers.GiveawayManager import draw_winners
+
+ENTRANT_COUNT = 40
+WINNER_COUNT = 3
+TRIALS = 20000
+
+
+async def stream(items):
+    for item in items:
+        yield item
+
+
+def chi_squared(counts, expected):
+    return sum((c - expected) ** 2 / expected for c in counts)
+
+
+def chi_squared_critical(dof: int, z: float = 3.090):
+    # Wilson-Hilferty approximation of the chi-squared critical value. z = 3.090 is p = 0.001.
+    return dof * (1 - 2 / (9 * dof) + z * math.sqrt(2 / (9 * dof))) ** 3
+
+
+def run_draws(make_entrants, seed: int = 0):
+    rng = random.Random(seed)
+    loop = asyncio.new_event_loop()
+
+    try:
+        return [loop.run_until_complete(draw_winners(make_entrants(), WINNER_COUNT, rng)) for _ in range(TRIALS)]
+    finally:
+        loop.close()
+
+
+@pytest.fixture(scope="module", params=["tracked", "paged"])
+def draws(request):
+    population = list(range(ENTRANT_COUNT))
+
+    if request.param == "tracked":
+        return run_draws(lambda: set(population))
+
+    return run_draws(lambda: stream(population))
+
+
+def test_draws_pick_distinct_winners(draws):
+    for (winners, seen) in draws:
+        assert seen == ENTRANT_COUNT
+        assert len(set(winners)) == WINNER_COUNT
+
+
+def test_every_entrant_wins_equally_often(draws):
+    wins = [0] * ENTRANT_COUNT
+
+    for (winners, _) in draws:
+        for winner in winners:
+            wins[winner] += 1
+
+    expected = TRIALS * WINNER_COUNT / ENTRANT_COUNT
+    assert chi_squared(wins, expected) < chi_squared_critical(ENTRANT_COUNT - 1)
+
+
+def test_every_entrant_is_named_first_equally_often(draws):
+    firsts = [0] * ENTRANT_COUNT
+
+    for (winners, _) in draws:
+        firsts[winners[0]] += 1
+
+    expected = TRIALS / ENTRANT_COUNT
+    assert chi_squared(firsts, expected) < chi_squared_critical(ENTRANT_COUNT - 1)
+
+
+def test_fewer_entrants_than_winners():
+    loop = asyncio.new_event_loop()
+
+    try:
+        (winners, seen) = loop.run_until_complete(draw_winners({1, 2}, WINNER_COUNT, random.Random(0)))
+    finally:
+        loop.close()
+
+    assert seen == 2
+    assert sorted(winners) == [1, 2]
@@ -0,0 +1,69 @@
+import asyncio
+import bisect
+import datetime
+import random
+
+import discord
+import pytest
+
+from libhusky import HuskyUtils
+
+SLICES = 4
+AFTER = datetime.datetime(2020, 1, 1)
+BEFORE = datetime.datetime(2020, 1, 2)
+
+
+class SimulatedHistoryChannel:
+    """
+    A stand-in for a TextChannel with a fixed history, paged the way discord.py pages forward through it.
+    """
+
+    def __init__(self, message_ids: list):
+        self.message_ids = message_ids
+
+    async def history(self, limit: int, after: discord.Object, oldest_first: bool):
+        await asyncio.sleep(0)
+
+        index = bisect.bisect_right(self.message_ids, after.id)
+
+        for message_id in self.message_ids[index:index + limit]:
+            yield discord.Object(id=message_id)
+
+
+@pytest.fixture(scope="module")
+def message_ids():
+    (start_id, end_id) = (HuskyUtils.get_snowflake_for_time(AFTER), HuskyUtils.get_snowflake_for_time(BEFORE))
+
+    # Messages sitting exactly on a slice boundary are the easiest ones to drop or duplicate.
+    boundaries = [start_id + ((end_id - start_id) * i) // SLICES for i in range(SLICES)]
+    return sorted(set(random.Random(0).sample(range(start_id, end_id), 2000) + boundaries))
+
+
+def read_history(channel, slices: int, ordered: bool) -> list:
+    async def collect():
+        return [m.id async for m in HuskyUtils.iter_history_slices(channel, AFTER, BEFORE, slices=slices,
+                                                                    ordered=ordered)]
+
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(collect())
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize("slices", [1, SLICES])
+def test_ordered_slices_yield_every_message_once_in_order(message_ids, slices):
+    assert read_history(SimulatedHistoryChannel(message_ids), slices, ordered=True) == message_ids
+
+
+@pytest.mark.parametrize("slices", [1, SLICES])
+def test_unordered_slices_yield_every_message_once(message_ids, slices):
+    assert sorted(read_history(SimulatedHistoryChannel(message_ids), slices, ordered=False)) == message_ids
+
+
+def test_messages_outside_the_range_are_skipped(message_ids):
+    end_id = HuskyUtils.get_snowflake_for_time(BEFORE)
+    channel = SimulatedHistoryChannel([message_ids[0] - 1] + message_ids + [end_id, end_id + 1])
+
+    assert read_history(channel, SLICES, ordered=True) == message_ids